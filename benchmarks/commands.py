@@ -0,0 +1,274 @@
+"""measure lain command latency against fake kubectl / helm / docker / git /
+stern, and a fake registry, without touching any cluster or network.
+
+    python benchmarks/commands.py --rounds 5 --latency 0.05
+    python benchmarks/commands.py --update-baseline
+
+each command runs against a copy of tests/dummy (or an empty app, if the
+submodule isn't checked out), which is initialized using lain init. for every
+command, the median of these are reported:
+
+* wall: wall time of the whole lain process
+* subprocesses: how many times lain called out to external tools
+* self_time: wall time minus time spent inside the fake tools, i.e. python
+  startup, imports, and everything lain does on its own
+
+results are compared against baseline.json, exits 1 if any tracked metric
+regresses by more than --threshold. wall time is only compared when the
+baseline is recorded using the same --latency.
+"""
+import json
+import os
+import shutil
+import subprocess
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from os.path import dirname, isdir, join
+from statistics import median
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+import click
+from fakes import APPNAME, IMAGE_TAG
+from startup import REPO_DIR, make_sandbox
+
+BENCHMARKS_DIR = dirname(__file__)
+FAKES_SCRIPT = join(BENCHMARKS_DIR, 'fakes.py')
+BASELINE_PATH = join(BENCHMARKS_DIR, 'baseline.json')
+DUMMY_REPO = join(REPO_DIR, 'tests', APPNAME)
+FAKE_TOOLS = ('kubectl', 'helm', 'docker', 'git', 'stern')
+CLUSTER = 'bench0'
+CLUSTER_VALUES = '''registry: {registry}
+domain: bench.invalid
+'''
+SCENARIOS = {
+    'deploy': ['deploy'],
+    'status': ['status', '--simple'],
+    'env-add': ['env', 'add', 'BENCH=1'],
+}
+TRACKED_METRICS = ('wall', 'subprocesses', 'self_time')
+
+
+class FakeRegistryHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0].endswith('/tags/list'):
+            body = {'name': APPNAME, 'tags': [IMAGE_TAG]}
+        else:
+            body = {}
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.end_headers()
+        self.wfile.write(json.dumps(body).encode('utf-8'))
+
+    do_HEAD = do_GET
+
+    def log_message(self, *args):
+        pass
+
+
+def start_fake_registry():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeRegistryHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    host, port = server.server_address
+    return server, f'{host}:{port}/bench'
+
+
+def write_script(path, content):
+    with open(path, 'w') as f:
+        f.write(content)
+
+    os.chmod(path, 0o755)
+
+
+def make_fake_tools(bin_dir):
+    os.makedirs(bin_dir)
+    for tool in FAKE_TOOLS:
+        write_script(
+            join(bin_dir, tool),
+            f'#!/bin/sh\nexec {sys.executable} -S {FAKES_SCRIPT} {tool} "$@"\n',
+        )
+
+
+def make_app(root, env):
+    app_dir = join(root, APPNAME)
+    if isdir(DUMMY_REPO) and os.listdir(DUMMY_REPO):
+        shutil.copytree(DUMMY_REPO, app_dir, ignore=shutil.ignore_patterns('.git'))
+    else:
+        os.makedirs(app_dir)
+
+    run_lain(['init', '--force'], env, app_dir, check=True)
+    return app_dir
+
+
+def run_lain(args, env, cwd, check=False):
+    return subprocess.run(
+        [sys.executable, '-m', 'lain_cli.client', *args],
+        env=env,
+        cwd=cwd,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        check=check,
+    )
+
+
+def tell_tool_time(entries):
+    """total time spent inside fake tools, overlapping calls counted once"""
+    total = 0
+    current_start = current_end = None
+    for start, end in sorted((e['start'], e['end']) for e in entries):
+        if current_end is None or start > current_end:
+            if current_end is not None:
+                total += current_end - current_start
+            current_start, current_end = start, end
+        else:
+            current_end = max(current_end, end)
+
+    if current_end is not None:
+        total += current_end - current_start
+    return total
+
+
+def measure(args, env, cwd):
+    log = env['FAKE_TOOL_LOG']
+    with open(log, 'w'):
+        pass
+
+    start = perf_counter()
+    res = run_lain(args, env, cwd)
+    wall = perf_counter() - start
+    if res.returncode:
+        stderr = res.stderr.decode('utf-8', errors='replace')
+        raise click.ClickException(f'lain {" ".join(args)} failed:\n{stderr}')
+    with open(log) as f:
+        entries = [json.loads(line) for line in f]
+
+    return {
+        'wall': wall,
+        'subprocesses': len(entries),
+        'self_time': max(wall - tell_tool_time(entries), 0),
+    }
+
+
+def run_scenarios(rounds, latency):
+    with TemporaryDirectory() as root:
+        server, registry = start_fake_registry()
+        env = make_sandbox(root, 1)
+        values_dir = env['LAIN_CLUSTER_VALUES_DIR']
+        with open(join(values_dir, f'values-{CLUSTER}.yaml'), 'w') as f:
+            f.write(CLUSTER_VALUES.format(registry=registry))
+
+        bin_dir = join(root, 'bin')
+        make_fake_tools(bin_dir)
+        env.update(
+            {
+                'PATH': os.pathsep.join([bin_dir, env['PATH']]),
+                'PYTHONPATH': os.pathsep.join(
+                    filter(None, [REPO_DIR, env.get('PYTHONPATH')])
+                ),
+                'FAKE_TOOL_LOG': join(root, 'fake-tools.log'),
+                'FAKE_TOOL_LATENCY': str(latency),
+                'LAIN_NO_DAEMON': 'true',
+            }
+        )
+        for k in ('DOCKERHUB_USERNAME', 'DOCKERHUB_PASSWORD', 'KUBECONFIG'):
+            env.pop(k, None)
+
+        try:
+            run_lain(['use', CLUSTER], env, root, check=True)
+            app_dir = make_app(root, env)
+            results = {}
+            for scenario, args in SCENARIOS.items():
+                # warm up, so that every round starts with the same cache
+                measure(args, env, app_dir)
+                samples = [measure(args, env, app_dir) for _ in range(rounds)]
+                results[scenario] = {
+                    metric: round(median(s[metric] for s in samples), 3)
+                    for metric in TRACKED_METRICS
+                }
+        finally:
+            server.shutdown()
+
+    return results
+
+
+def compare(results, baseline, latency, threshold):
+    """returns a list of regressions, in human readable strings"""
+    regressions = []
+    same_latency = baseline.get('latency') == latency
+    for scenario, metrics in results.items():
+        base_metrics = baseline.get('scenarios', {}).get(scenario)
+        if not base_metrics:
+            continue
+        for metric in TRACKED_METRICS:
+            if metric == 'wall' and not same_latency:
+                continue
+            old, new = base_metrics[metric], metrics[metric]
+            if metric == 'subprocesses':
+                regressed = new > old
+            else:
+                regressed = new > old * (1 + threshold)
+            if regressed:
+                regressions.append(f'{scenario} {metric}: {old:g} -> {new:g}')
+
+    return regressions
+
+
+@click.command()
+@click.option('--rounds', default=5, help='run each command this many times')
+@click.option(
+    '--latency',
+    default=0.05,
+    help='seconds every fake kubectl / helm / ... call takes',
+)
+@click.option(
+    '--threshold',
+    default=0.2,
+    help='fail if a timing metric exceeds baseline by this ratio',
+)
+@click.option(
+    '--baseline',
+    'baseline_path',
+    default=BASELINE_PATH,
+    type=click.Path(dir_okay=False),
+    help='baseline file to compare against',
+)
+@click.option('--update-baseline', is_flag=True, help='write results as new baseline')
+def main(rounds, latency, threshold, baseline_path, update_baseline):
+    results = run_scenarios(rounds, latency)
+    click.echo(f'{rounds} rounds, {latency}s tool latency, median:')
+    for scenario, metrics in results.items():
+        click.echo(
+            f'  lain {" ".join(SCENARIOS[scenario]):<18}'
+            f'wall {metrics["wall"]:.3f}s  '
+            f'subprocesses {metrics["subprocesses"]:<4g}'
+            f'self {metrics["self_time"]:.3f}s'
+        )
+
+    if update_baseline:
+        with open(baseline_path, 'w') as f:
+            json.dump(
+                {'latency': latency, 'scenarios': results}, f, indent=2, sort_keys=True
+            )
+            f.write('\n')
+
+        click.echo(f'baseline written to {baseline_path}')
+        return
+
+    if not os.path.exists(baseline_path):
+        click.echo(f'{baseline_path} not found, skip comparison')
+        return
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+
+    regressions = compare(results, baseline, latency, threshold)
+    if regressions:
+        click.echo('regressions:', err=True)
+        for line in regressions:
+            click.echo(f'  {line}', err=True)
+
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
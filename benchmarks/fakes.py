@@ -0,0 +1,264 @@
+"""fake kubectl / helm / docker / git / stern for benchmarks.
+
+    python fakes.py TOOL [ARGS...]
+
+writes canned output for the handful of commands lain actually parses, and
+nothing for everything else. each invocation sleeps FAKE_TOOL_LATENCY
+seconds (to simulate a remote cluster / registry), and appends a json line to
+FAKE_TOOL_LOG, so that callers can count subprocesses, and tell how much time
+is spent waiting on them.
+
+stdlib only, this is meant to be run with python -S, to keep its own
+overhead low.
+"""
+import base64
+import gzip
+import json
+import os
+import sys
+from time import sleep, time
+
+APPNAME = os.environ.get('FAKE_APPNAME', 'dummy')
+IMAGE_TAG = '1600000000-0123456789abcdef0123456789abcdef01234567'
+KUBECTL_VERSION = 'v1.20.4'
+HELM_VERSION = 'v3.9.0+g7ceeda6'
+ENV_SECRET = {
+    'apiVersion': 'v1',
+    'kind': 'Secret',
+    'type': 'Opaque',
+    'metadata': {
+        'name': f'{APPNAME}-env',
+        'namespace': 'default',
+        'resourceVersion': '1024',
+        'uid': '6c6b2f4e-0000-0000-0000-000000000000',
+    },
+    'data': {'FOO': base64.b64encode(b'BAR').decode()},
+}
+HELM_STATUS = {
+    'name': APPNAME,
+    'info': {'status': 'deployed', 'last_deployed': '2021-01-01T00:00:00Z'},
+    'version': 3,
+    'namespace': 'default',
+}
+HELM_VALUES = {'appname': APPNAME, 'imageTag': IMAGE_TAG}
+HELM_RELEASE = {
+    **HELM_STATUS,
+    'chart': {'metadata': {'name': APPNAME, 'version': '0.1.11'}},
+    'config': HELM_VALUES,
+}
+MANIFESTS = f'''---
+apiVersion: apps/v1
+kind: Deployment
+metadata:
+  name: {APPNAME}-web
+  labels:
+    app.kubernetes.io/name: {APPNAME}
+spec:
+  replicas: 1
+'''
+CANARY_SUFFIX = '-canary'
+POD_NAMES = [f'{APPNAME}-web-5f8c9d7b6-{suffix}' for suffix in ('abcde', 'fghij')]
+
+
+class NotFound(Exception):
+    pass
+
+
+def tell_pods_table(args):
+    lines = []
+    if '--no-headers=true' not in args:
+        lines.append('NAME   READY   STATUS   RESTARTS   AGE   IP   NODE')
+    for n, name in enumerate(POD_NAMES):
+        lines.append(f'{name}   1/1   Running   0   1d   10.0.0.{n + 2}   node-1')
+    return '\n'.join(lines) + '\n'
+
+
+def tell_pods_json():
+    items = []
+    for n, name in enumerate(POD_NAMES):
+        items.append(
+            {
+                'kind': 'Pod',
+                'metadata': {
+                    'name': name,
+                    'labels': {'app.kubernetes.io/name': APPNAME},
+                    'creationTimestamp': '2021-01-01T00:00:00Z',
+                    'ownerReferences': [
+                        {
+                            'kind': 'ReplicaSet',
+                            'name': name.rsplit('-', 1)[0],
+                            'controller': True,
+                        }
+                    ],
+                },
+                'spec': {'nodeName': 'node-1', 'containers': [{'name': APPNAME}]},
+                'status': {
+                    'phase': 'Running',
+                    'podIP': f'10.0.0.{n + 2}',
+                    'containerStatuses': [
+                        {'name': APPNAME, 'ready': True, 'restartCount': 0}
+                    ],
+                },
+            }
+        )
+    return json.dumps({'kind': 'List', 'items': items})
+
+
+def tell_deployments_json():
+    replicas = len(POD_NAMES)
+    deployment = {
+        'kind': 'Deployment',
+        'metadata': {'name': f'{APPNAME}-web', 'generation': 1},
+        'spec': {'replicas': replicas},
+        'status': {
+            'observedGeneration': 1,
+            'replicas': replicas,
+            'updatedReplicas': replicas,
+            'readyReplicas': replicas,
+            'availableReplicas': replicas,
+        },
+    }
+    return json.dumps({'kind': 'List', 'items': [deployment]})
+
+
+def tell_release_secrets_json(selector):
+    """helm 3 release secrets, for the releases named in selector"""
+    items = []
+    if (
+        'name' not in selector
+        or f'({APPNAME})' in selector
+        or '=' + APPNAME in selector
+    ):
+        payload = gzip.compress(json.dumps(HELM_RELEASE).encode('utf-8'))
+        items.append(
+            {
+                'kind': 'Secret',
+                'type': 'helm.sh/release.v1',
+                'metadata': {
+                    'name': f'sh.helm.release.v1.{APPNAME}.v{HELM_STATUS["version"]}',
+                    'labels': {'owner': 'helm', 'name': APPNAME},
+                },
+                'data': {
+                    'release': base64.b64encode(base64.b64encode(payload)).decode()
+                },
+            }
+        )
+    return json.dumps({'kind': 'List', 'items': items})
+
+
+def tell_replicasets_json():
+    replicaset = {
+        'kind': 'ReplicaSet',
+        'metadata': {
+            'name': POD_NAMES[0].rsplit('-', 1)[0],
+            'ownerReferences': [{'kind': 'Deployment', 'name': f'{APPNAME}-web'}],
+        },
+    }
+    return json.dumps({'kind': 'List', 'items': [replicaset]})
+
+
+def respond_kubectl(words, args):
+    if words[:1] == ['version']:
+        return f'Client Version: {KUBECTL_VERSION}\nServer Version: {KUBECTL_VERSION}\n'
+    if words[:2] == ['get', 'secret'] and 'owner=helm' in args[-1]:
+        return tell_release_secrets_json(args[-1])
+    if words[:2] == ['get', 'secret']:
+        # json is valid yaml as well
+        return json.dumps(ENV_SECRET)
+    if words[:2] in (['get', 'po'], ['get', 'pod'], ['get', 'pods']):
+        if '-ojson' in args or 'json' in args:
+            return tell_pods_json()
+        return tell_pods_table(args)
+    if words[:2] in (['get', 'job'], ['get', 'jobs'], ['get', 'statefulset']):
+        return json.dumps({'kind': 'List', 'items': []})
+    if words[:2] == ['get', 'replicaset']:
+        return tell_replicasets_json()
+    if words[:1] == ['exec']:
+        return f'hello from {words[1]}\n'
+    if words[:2] == ['get', 'deployment']:
+        return tell_deployments_json()
+    if words[:2] in (['get', 'node'], ['get', 'nodes']):
+        if '-ojson' in args:
+            node = {'kind': 'Node', 'metadata': {'name': 'node-1', 'labels': {}}}
+            return json.dumps({'kind': 'List', 'items': [node]})
+        return 'node-1\n'
+    if words[:1] == ['apply']:
+        return f'secret/{APPNAME}-env configured\n'
+    return ''
+
+
+def respond_helm(words, args):
+    if words[:1] == ['version']:
+        return f'{HELM_VERSION}\n'
+    if words[:1] == ['status']:
+        if words[1].endswith(CANARY_SUFFIX):
+            raise NotFound('release: not found')
+        return json.dumps(HELM_STATUS)
+    if words[:2] == ['get', 'values']:
+        return json.dumps(HELM_VALUES)
+    if words[:1] == ['upgrade']:
+        return f'Release "{APPNAME}" has been upgraded. Happy Helming!\n'
+    if words[:1] == ['template']:
+        return MANIFESTS
+    if words[:1] == ['lint']:
+        return '1 chart(s) linted, 0 chart(s) failed\n'
+    return ''
+
+
+def respond_git(words, args):
+    if words[:1] == ['remote']:
+        return f'origin\tgit@example.com:{APPNAME}/{APPNAME}.git (fetch)\n'
+    if words[:1] == ['log']:
+        return IMAGE_TAG
+    if words[:1] == ['rev-parse']:
+        return IMAGE_TAG.split('-')[-1] + '\n'
+    return ''
+
+
+def respond_docker(words, args):
+    if words[:1] == ['version']:
+        return '20.10.7\n'
+    return ''
+
+
+def respond_stern(words, args):
+    if '--version' in args or words[:1] == ['version']:
+        return 'version: 1.11.0\n'
+    return ''
+
+
+RESPONDERS = {
+    'kubectl': respond_kubectl,
+    'helm': respond_helm,
+    'git': respond_git,
+    'docker': respond_docker,
+    'stern': respond_stern,
+}
+
+
+def main():
+    start = time()
+    tool, *args = sys.argv[1:]
+    words = [a for a in args if not a.startswith('-')]
+    try:
+        output, code = RESPONDERS[tool](words, args), 0
+    except NotFound as e:
+        output, code = '', 1
+        sys.stderr.write(f'Error: {e}\n')
+
+    latency = float(os.environ.get('FAKE_TOOL_LATENCY') or 0)
+    if latency:
+        sleep(latency)
+
+    sys.stdout.write(output)
+    log = os.environ.get('FAKE_TOOL_LOG')
+    if log:
+        entry = {'tool': tool, 'args': args, 'start': start, 'end': time()}
+        with open(log, 'a') as f:
+            f.write(json.dumps(entry) + '\n')
+
+    sys.exit(code)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+"""compare kubectl get against the pooled kubernetes api client, doing the
+same reads against a fake api server.
+
+    python benchmarks/kube_client.py --reads 20 --kubectl kubectl
+
+every kubectl get pays for a process, kubeconfig parsing and a fresh
+connection, while KubeClient reuses its connection. the fake api server
+speaks plain http, so this is a lower bound of the difference: against a
+real cluster, every kubectl call does a TLS handshake as well.
+"""
+import json
+import shutil
+import subprocess
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from os.path import join
+from tempfile import TemporaryDirectory
+from time import perf_counter, sleep
+
+import click
+
+from lain_cli.kube import KubeClient
+from lain_cli.utils import yadu
+
+POD_NAME = 'dummy-web-5f8c9d7b6-abcde'
+POD = {
+    'kind': 'Pod',
+    'apiVersion': 'v1',
+    'metadata': {'name': POD_NAME, 'namespace': 'default'},
+    'status': {'phase': 'Running'},
+}
+
+
+class FakeApiHandler(BaseHTTPRequestHandler):
+    # keep-alive, just like a real api server
+    protocol_version = 'HTTP/1.1'
+    # headers and body are written separately, don't let nagle delay them
+    disable_nagle_algorithm = True
+    latency = 0
+
+    def do_GET(self):
+        if self.path.startswith('/api/v1/namespaces/default/pods'):
+            body = json.dumps(POD).encode('utf-8')
+        else:
+            # kubectl discovery, serve nothing so that it goes straight to
+            # the legacy api
+            body = b'{}'
+        if self.latency:
+            sleep(self.latency)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def make_kubeconfig(root, server):
+    kubeconfig = {
+        'apiVersion': 'v1',
+        'kind': 'Config',
+        'current-context': 'bench',
+        'contexts': [{'name': 'bench', 'context': {'cluster': 'c', 'user': 'u'}}],
+        'clusters': [{'name': 'c', 'cluster': {'server': server}}],
+        'users': [{'name': 'u', 'user': {'token': 'bench'}}],
+    }
+    path = join(root, 'kubeconfig')
+    with open(path, 'w') as f:
+        f.write(yadu(kubeconfig))
+
+    return path
+
+
+def timed(func, reads):
+    start = perf_counter()
+    for _ in range(reads):
+        func()
+
+    return perf_counter() - start
+
+
+@click.command()
+@click.option('--reads', default=20, help='how many reads to do')
+@click.option(
+    '--latency', default=0.0, help='seconds the fake api server takes per request'
+)
+@click.option('--kubectl', default='kubectl', help='kubectl binary to compare with')
+def main(reads, latency, kubectl):
+    FakeApiHandler.latency = latency
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeApiHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    host, port = server.server_address
+    try:
+        with TemporaryDirectory() as root:
+            kubeconfig = make_kubeconfig(root, f'http://{host}:{port}')
+            client = KubeClient.from_kubeconfig(kubeconfig)
+            client_time = timed(lambda: client.read('po', POD_NAME), reads)
+            click.echo(f'{reads} reads, {latency}s api latency, in seconds:')
+            click.echo(f'  KubeClient  {client_time:.3f}')
+            if not shutil.which(kubectl):
+                click.echo(f'  {kubectl} not found, skip')
+                return
+            cmd = [
+                kubectl,
+                f'--kubeconfig={kubeconfig}',
+                f'--cache-dir={join(root, "cache")}',
+                'get',
+                'po',
+                POD_NAME,
+                '-ojson',
+            ]
+            kubectl_time = timed(
+                lambda: subprocess.run(cmd, capture_output=True, check=True), reads
+            )
+            click.echo(
+                f'  kubectl     {kubectl_time:.3f}  ({kubectl_time / client_time:.1f}x)'
+            )
+    finally:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
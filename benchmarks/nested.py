@@ -0,0 +1,111 @@
+"""measure the cost of lain calling lain (lain_), in process vs subprocess.
+
+    python benchmarks/nested.py --calls 5
+
+commands like `lain deploy` call `lain lint`, `lain wait`, `lain status` via
+lain_, this script runs a lain command that calls lain_ repeatedly, against a
+sandbox app with fake kubectl / helm, once with in-process dispatch and once
+with LAIN_NO_INPROCESS=1 (re-exec the lain binary, which is the old
+behavior).
+"""
+import os
+import subprocess
+import sys
+from os.path import join
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+import click
+from startup import REPO_DIR, make_sandbox
+
+FAKE_KUBECTL = '''#!/bin/sh
+echo "Client Version: v1.20.4"
+echo "Server Version: v1.20.4"
+'''
+FAKE_HELM = '''#!/bin/sh
+case "$1" in
+    version) echo "v3.9.0" ;;
+    get) echo '{"appname": "dummy"}' ;;
+esac
+'''
+LAIN_SHIM = f'''#!/bin/sh
+exec {sys.executable} -m lain_cli.lain "$@"
+'''
+DUMMY_VALUES = '''appname: dummy
+build:
+  base: python:3.9
+  script: [echo]
+deployments:
+  web:
+    replicaCount: 1
+    command: [echo]
+    resources:
+      limits: {cpu: 1, memory: 80Mi}
+      requests: {cpu: 1, memory: 80Mi}
+'''
+DRIVER = '''
+import sys
+from lain_cli.lain import lain
+from lain_cli.utils import lain_
+
+calls = int(sys.argv[1])
+ctx = lain.make_context('lain', ['--ignore-lint', 'version'], obj={})
+with ctx:
+    ctx.invoke(lain.callback, **ctx.params)
+    for _ in range(calls):
+        lain_('get-values', 'dummy', check=False)
+'''
+
+
+def write_script(path, content):
+    with open(path, 'w') as f:
+        f.write(content)
+
+    os.chmod(path, 0o755)
+
+
+def make_app(root, env):
+    bin_dir = join(root, 'bin')
+    app_dir = join(root, 'app')
+    os.makedirs(bin_dir)
+    os.makedirs(join(app_dir, 'chart'))
+    write_script(join(bin_dir, 'kubectl'), FAKE_KUBECTL)
+    write_script(join(bin_dir, 'helm'), FAKE_HELM)
+    write_script(join(bin_dir, 'lain'), LAIN_SHIM)
+    write_script(join(app_dir, 'chart', 'values.yaml'), DUMMY_VALUES)
+    env['PATH'] = os.pathsep.join([bin_dir, env['PATH']])
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [REPO_DIR, env.get('PYTHONPATH')]))
+    return app_dir
+
+
+def time_driver(calls, env, cwd):
+    start = perf_counter()
+    subprocess.run(
+        [sys.executable, '-c', DRIVER, str(calls)],
+        env=env,
+        cwd=cwd,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        check=True,
+    )
+    return perf_counter() - start
+
+
+@click.command()
+@click.option('--calls', default=5, help='how many times lain_ is called')
+def main(calls):
+    with TemporaryDirectory() as root:
+        env = make_sandbox(root, 3)
+        app_dir = make_app(root, env)
+        # warm up caches, so that both runs start from the same state
+        time_driver(1, env, app_dir)
+        inprocess = time_driver(calls, env, app_dir)
+        subprocess_env = dict(env, LAIN_NO_INPROCESS='true')
+        reexec = time_driver(calls, subprocess_env, app_dir)
+        click.echo(f'{calls} nested lain calls:')
+        click.echo(f'  in process  {inprocess:.3f}s')
+        click.echo(f'  subprocess  {reexec:.3f}s')
+
+
+if __name__ == '__main__':
+    main()
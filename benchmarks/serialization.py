@@ -0,0 +1,134 @@
+"""compare yaml / json (de)serialization used by lain, on big documents.
+
+    python benchmarks/serialization.py --procs 40 --secret-keys 500
+
+* values: loading a values.yaml with lots of procs, round-trip vs safe loader
+* secret: parsing kubectl get secret output, -oyaml (round-trip) vs -ojson
+* apply: dumping a secret for kubectl apply, yaml (round-trip) vs json
+"""
+import base64
+import json
+import timeit
+from os import unlink
+from tempfile import mkstemp
+
+import click
+
+from lain_cli.utils import dump_manifest, jalo, yadu, yalo
+
+
+def make_values(procs):
+    values = {
+        'appname': 'dummy',
+        'env': {f'ENV_{n}': f'value-{n}' for n in range(30)},
+        'volumeMounts': [
+            {'mountPath': f'/lain/app/conf/{n}.toml', 'subPath': f'{n}.toml'}
+            for n in range(10)
+        ],
+        'deployments': {},
+        'cronjobs': {},
+        'ingresses': [],
+        'build': {
+            'base': 'python:3.9',
+            'prepare': {'script': ['pip install -r requirements.txt'] * 5},
+            'script': ['pip install -e .'] * 5,
+        },
+    }
+    for n in range(procs):
+        resources = {
+            'limits': {'cpu': 1000, 'memory': '1Gi'},
+            'requests': {'cpu': 100, 'memory': '512Mi'},
+        }
+        values['deployments'][f'web{n}'] = {
+            'replicaCount': 2,
+            'command': ['/lain/app/run.sh', f'web{n}'],
+            'env': {f'PROC_ENV_{k}': f'{k}' for k in range(10)},
+            'containerPort': 8000,
+            'resources': resources,
+            'readinessProbe': {
+                'httpGet': {'path': '/status', 'port': 8000},
+                'initialDelaySeconds': 5,
+            },
+        }
+        values['cronjobs'][f'job{n}'] = {
+            'schedule': '0 0 * * *',
+            'command': ['python', 'manage.py', f'job{n}'],
+            'resources': resources,
+        }
+        values['ingresses'].append(
+            {'host': f'web{n}', 'deployName': f'web{n}', 'paths': ['/']}
+        )
+
+    # a human written values.yaml comes with comments
+    lines = []
+    for line in yadu(values).splitlines():
+        lines.append(line)
+        if line.endswith(':'):
+            lines.append(f'{" " * (len(line) - len(line.lstrip()))}# comment')
+
+    return '\n'.join(lines) + '\n'
+
+
+def make_secret(keys):
+    return {
+        'apiVersion': 'v1',
+        'kind': 'Secret',
+        'type': 'Opaque',
+        'metadata': {'name': 'dummy-env', 'namespace': 'default'},
+        'data': {
+            f'SECRET_KEY_{n}': base64.b64encode(f'secret-value-{n}'.encode()).decode()
+            for n in range(keys)
+        },
+    }
+
+
+def best(stmt, rounds):
+    return min(timeit.repeat(stmt, number=1, repeat=rounds)) * 1000
+
+
+def dump_and_remove(dic):
+    unlink(dump_manifest(dic))
+
+
+def dump_yaml_and_remove(dic):
+    fd, name = mkstemp(suffix='.yaml')
+    yadu(dic, fd)
+    unlink(name)
+
+
+@click.command()
+@click.option('--procs', default=40, help='how many procs in the values.yaml')
+@click.option('--secret-keys', default=500, help='how many keys in the secret')
+@click.option('--rounds', default=10, help='best of this many rounds')
+def main(procs, secret_keys, rounds):
+    values = make_values(procs)
+    secret = make_secret(secret_keys)
+    secret_yaml = yadu(secret)
+    secret_json = json.dumps(secret)
+    cases = [
+        (
+            f'values ({len(values) // 1024}KiB)',
+            lambda: yalo(values, round_trip=True),
+            lambda: yalo(values),
+        ),
+        (
+            f'secret ({secret_keys} keys)',
+            lambda: yalo(secret_yaml, round_trip=True),
+            lambda: jalo(secret_json),
+        ),
+        (
+            f'apply ({secret_keys} keys)',
+            lambda: dump_yaml_and_remove(secret),
+            lambda: dump_and_remove(secret),
+        ),
+    ]
+    click.echo(f'best of {rounds} rounds, in ms:')
+    for name, slow, fast in cases:
+        slow_ms, fast_ms = best(slow, rounds), best(fast, rounds)
+        click.echo(
+            f'  {name:<20} before {slow_ms:8.2f}  after {fast_ms:8.2f}  ({slow_ms / fast_ms:.1f}x)'
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+"""measure lain startup time against a sandbox with lots of clusters.
+
+    python benchmarks/startup.py --clusters 30 --rounds 5
+
+a temporary HOME is populated with fake kubeconfig files and cluster values
+files (copied from the bundled values-test.yaml), then `lain --help` and
+`lain use` (which reads the config of every cluster) are timed, both cold
+(empty cache dir) and warm.
+"""
+import os
+import shutil
+import subprocess
+import sys
+from os.path import abspath, dirname, join
+from statistics import median
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+import click
+
+REPO_DIR = dirname(dirname(abspath(__file__)))
+TEMPLATE_VALUES = join(REPO_DIR, 'lain_cli', 'cluster_values', 'values-test.yaml')
+SCENARIOS = {
+    'help': ['--help'],
+    'use': ['use'],
+}
+
+
+def make_sandbox(root, clusters):
+    home = join(root, 'home')
+    kube_dir = join(home, '.kube')
+    values_dir = join(root, 'cluster_values')
+    os.makedirs(kube_dir)
+    os.makedirs(values_dir)
+    for n in range(clusters):
+        name = f'bench{n}'
+        with open(join(kube_dir, f'kubeconfig-{name}'), 'w') as f:
+            f.write(f'# fake kubeconfig for {name}\n')
+
+        shutil.copyfile(TEMPLATE_VALUES, join(values_dir, f'values-{name}.yaml'))
+
+    os.symlink(join(kube_dir, 'kubeconfig-bench0'), join(kube_dir, 'config'))
+    env = os.environ.copy()
+    env.update(
+        {
+            'HOME': home,
+            'LAIN_CLUSTER_VALUES_DIR': values_dir,
+            'LAIN_CACHE_DIR': join(root, 'cache'),
+            'DOCKERHUB_USERNAME': 'bench',
+            'DOCKERHUB_PASSWORD': 'bench',
+        }
+    )
+    env.pop('XDG_CACHE_HOME', None)
+    return env
+
+
+def time_lain(args, env, cwd):
+    start = perf_counter()
+    subprocess.run(
+        [sys.executable, '-m', 'lain_cli.lain', *args],
+        env=env,
+        cwd=cwd,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        check=False,
+    )
+    return perf_counter() - start
+
+
+@click.command()
+@click.option('--clusters', default=30, help='how many fake clusters to create')
+@click.option('--rounds', default=5, help='run each scenario this many times')
+def main(clusters, rounds):
+    with TemporaryDirectory() as root:
+        env = make_sandbox(root, clusters)
+        env['PYTHONPATH'] = os.pathsep.join(
+            filter(None, [REPO_DIR, env.get('PYTHONPATH')])
+        )
+        cache_dir = env['LAIN_CACHE_DIR']
+        cwd = join(root, 'home')
+        click.echo(f'{clusters} clusters, {rounds} rounds, median wall time:')
+        for args in SCENARIOS.values():
+            cold = []
+            for _ in range(rounds):
+                shutil.rmtree(cache_dir, ignore_errors=True)
+                cold.append(time_lain(args, env, cwd))
+
+            warm = [time_lain(args, env, cwd) for _ in range(rounds)]
+            click.echo(
+                f'  lain {" ".join(args):<8} cold {median(cold):.3f}s  warm {median(warm):.3f}s'
+            )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,696 @@
+import json
+import re
+import threading
+from collections import defaultdict
+from os import makedirs
+from os.path import dirname, join
+
+import click
+import requests
+from humanfriendly import parse_timespan
+from requests.adapters import HTTPAdapter
+
+from lain_cli.utils import (
+    CACHE_DIR,
+    DEFAULT_BACKEND_RESPONSE,
+    VM_STATES,
+    ClusterConfigSchema,
+    KVPairType,
+    PodRecord,
+    RateLimiter,
+    banyun,
+    brief,
+    click_parse_timespan,
+    debug,
+    echo,
+    ensure_absent,
+    ensure_str,
+    error,
+    fetch_helm_releases,
+    find_values,
+    format_table,
+    get_pods,
+    helm,
+    iter_parallel,
+    kube_read,
+    kubectl,
+    make_external_url,
+    pick_helm_release,
+    rc,
+    tell_cluster_config,
+    tell_paas_client,
+    tell_registry_client,
+    tell_release_values,
+    tell_secret,
+    wait_for_cluster_up,
+    warn,
+    yalo,
+)
+
+# probing ingresses is all about waiting on the network
+PROBE_CONCURRENCY = 16
+
+
+@click.group()
+def admin():
+    """admin functionalities, stay away"""
+
+
+@admin.command()
+@click.option(
+    '--dry-run',
+    is_flag=True,
+)
+@click.pass_context
+def delete_bad_ing(ctx, dry_run):
+    ctx.obj['silent'] = True
+    ingresses = {}
+    for ing in kube_read('ingress')['items']:
+        rules = ing['spec'].get('rules') or []
+        host = next((rule['host'] for rule in rules if rule.get('host')), None)
+        if not host:
+            continue
+        paths = list(find_values(rules, 'path')) or ['/']
+        url = next(make_external_url(host, paths=paths))
+        ingresses[ing['metadata']['name']] = (ing, url)
+
+    # keep-alive connections, shared by all probes
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_maxsize=PROBE_CONCURRENCY)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    def probe(ing_name):
+        url = ingresses[ing_name][1]
+        try:
+            return session.get(url, timeout=2)
+        except requests.exceptions.RequestException as e:
+            debug(f'skip {ing_name} / {url} due to {brief(e)}')
+
+    bad_ings = []
+    unavailable_ings = []
+    probes = iter_parallel(probe, ingresses, max_workers=PROBE_CONCURRENCY)
+    for ing_name, future in probes:
+        res = future.result()
+        if res is None:
+            continue
+        if res.status_code == 404 and res.text.strip() == DEFAULT_BACKEND_RESPONSE:
+            bad_ings.append(ing_name)
+        elif res.status_code == 503:
+            unavailable_ings.append(ing_name)
+
+    def delete_loose_ing(ing_names, dry_run=True):
+        loose_ings = []
+        for ing_name in sorted(ing_names):
+            ing, url = ingresses[ing_name]
+            debug(f'want to delete {ing_name} / {url}')
+            annotations = ing['metadata'].get('annotations') or {}
+            helm_release = annotations.get('meta.helm.sh/release-name')
+            if helm_release:
+                warn(f'{ing_name} is not a loose ing, if you want to delete, use helm:')
+                echo(f' helm delete {helm_release}', clean=False)
+            else:
+                loose_ings.append(ing_name)
+
+        if loose_ings:
+            kubectl('delete', 'ing', *loose_ings, dry_run=dry_run)
+
+    delete_loose_ing(bad_ings, dry_run=dry_run)
+    # 503 may well be temporary, never delete them for real
+    delete_loose_ing(unavailable_ings, dry_run=True)
+
+
+@admin.command()
+@click.option(
+    '--dry-run',
+    is_flag=True,
+)
+def delete_bad_pod(dry_run):
+    pods = get_pods(show_only_bad_pods=True, check=True)
+    seen = set()
+    for record in pods:
+        owner_kind, owner_name = record.owner or (None, None)
+        if owner_kind == 'Job':
+            resource_type = 'job'
+            resource_name = owner_name
+        else:
+            resource_type = 'pod'
+            resource_name = record.name
+
+        this_ = (resource_type, resource_name)
+        if this_ in seen:
+            continue
+        seen.add(this_)
+        kubectl('delete', resource_type, resource_name, check=False, dry_run=dry_run)
+
+
+@admin.command()
+@click.option(
+    '--write-plan',
+    'write_plan_path',
+    help='only build the deletion plan, and write it to this json file for review',
+)
+@click.option(
+    '--plan',
+    'plan_path',
+    help='execute this deletion plan instead of building a new one, progress is saved next to it, run again to resume',
+)
+@click.option(
+    '--parallel', default=8, show_default=True, help='concurrent registry requests'
+)
+@click.option(
+    '--rate',
+    default=20.0,
+    type=click.FloatRange(min=0, min_open=True),
+    show_default=True,
+    help='at most this many requests per second to the registry',
+)
+def cleanup_registry(write_plan_path, plan_path, parallel, rate):
+    """delete ancient images from registry, in two phases: build a deletion
+    plan, then execute it. images that are recent, running, or share their
+    manifest with such images are kept.
+
+    \b
+    examples:
+    \b
+        lain admin cleanup-registry --write-plan plan.json
+        lain admin cleanup-registry --plan plan.json
+    """
+    from lain_cli.registry import Registry, build_cleanup_plan, execute_cleanup_plan
+
+    if write_plan_path and plan_path:
+        raise click.BadParameter('cannot use --write-plan with --plan')
+    registry = tell_registry_client()
+    if not isinstance(registry, Registry):
+        error(f'cannot cleanup {type(registry).__name__}, only docker registry', exit=1)
+
+    registry.rate_limiter = RateLimiter(rate)
+    registry.session = requests.Session()
+    adapter = HTTPAdapter(pool_maxsize=parallel)
+    registry.session.mount('http://', adapter)
+    registry.session.mount('https://', adapter)
+    if plan_path:
+        with open(plan_path) as f:
+            plan = json.load(f)
+
+        if plan['registry'] != registry.registry:
+            error(f'plan is for {plan["registry"]}, not {registry.registry}', exit=1)
+    else:
+        res = kubectl('get', 'po', '-ojsonpath={..image}', capture_output=True)
+        running_image_tags = frozenset(
+            [image.split(':', 1)[-1] for image in ensure_str(res.stdout).split()]
+        )
+        plan = build_cleanup_plan(
+            registry, keep_tags=running_image_tags, max_workers=parallel
+        )
+        plan_path = write_plan_path or join(CACHE_DIR, 'cleanup-registry-plan.json')
+        makedirs(dirname(plan_path) or '.', exist_ok=True)
+        with open(plan_path, 'w') as f:
+            json.dump(plan, f, indent=2)
+
+        # progress of earlier plans would make this one skip manifests
+        ensure_absent(f'{plan_path}.progress')
+        count = len(plan['manifests'])
+        echo(f'{count} manifests to delete, plan written to {plan_path}')
+        if write_plan_path:
+            return
+
+    failures = execute_cleanup_plan(
+        registry, plan, f'{plan_path}.progress', max_workers=parallel
+    )
+    if failures:
+        error(
+            f'{len(failures)} manifests not deleted, resume with: lain admin cleanup-registry --plan {plan_path}',
+            exit=1,
+        )
+
+
+@admin.command()
+@click.pass_context
+def list_images(ctx):
+    ctx.obj['silent'] = True
+    registry = tell_registry_client()
+    images = registry.list_images()
+    for image in images:
+        echo(image)
+
+
+@admin.command()
+@click.pass_context
+def list_singletons(ctx):
+    ctx.obj['silent'] = True
+    deploys = kube_read('deployment')['items']
+    ignore_words = ['consumer', 'worker', 'sentry', 'gitlab']
+    ignore_pattern = re.compile('|'.join(ignore_words))
+    singletons = []
+    for deploy in deploys:
+        deploy_name = deploy['metadata']['name']
+        annotations = deploy['metadata'].get('annotations') or {}
+        release_name = annotations.get('meta.helm.sh/release-name')
+        if not release_name or deploy['spec'].get('replicas') != 1:
+            continue
+        if ignore_pattern.search(deploy_name):
+            continue
+        singletons.append((deploy_name, release_name))
+
+    if not singletons:
+        return
+    # every release in one request, rather than a helm get values for each
+    releases = fetch_helm_releases([r for _, r in singletons])
+    for deploy_name, release_name in singletons:
+        if releases is None:
+            values_dic = tell_release_values(release_name, check=False)
+        else:
+            release = pick_helm_release(releases.get(release_name))
+            values_dic = release and release.get('config')
+        user = values_dic.get('user') if values_dic else None
+        echo(f'{deploy_name} from {release_name}, user: {user}')
+
+
+@admin.command()
+@click.option(
+    '--simple',
+    '-s',
+    is_flag=True,
+    help='print static status, rather than display in prompt app',
+)
+@click.pass_context
+def status(ctx, simple):
+    from lain_cli.prompt import (
+        bad_node_text,
+        bad_pod_text,
+        build_cluster_status_command,
+        display_cluster_status,
+        global_ingress_text,
+    )
+
+    ctx.obj['silent'] = True
+    ctx.obj['simple'] = simple
+    ing_list = ensure_str(
+        kubectl(
+            'get',
+            'ing',
+            '--all-namespaces',
+            '--no-headers',
+            r'-o=custom-columns=HOST:..rules[*].host,PATHS:..rules[*]..path',
+            capture_output=True,
+        ).stdout
+    ).splitlines()
+    cc = tell_cluster_config()
+    ingress_external_port = cc.get('ingress_external_port', 80)
+    urls = []
+    for ing in ing_list:
+        host, paths = ing.split()
+        for url in make_external_url(
+            host, paths=paths.split(','), port=ingress_external_port
+        ):
+            urls.append(url)
+
+    ctx.obj['global_urls'] = set(urls)
+    if simple:
+        build_cluster_status_command()
+        report = [bad_pod_text()]
+        report.extend(['bad nodes', bad_node_text()])
+        report.extend(['bad url requests', global_ingress_text()])
+        echo('\n'.join(report))
+        ctx.exit(0)
+
+    display_cluster_status()
+
+
+@admin.command()
+@click.argument('command', nargs=-1)
+@click.option(
+    '--parallel',
+    '-p',
+    default=8,
+    show_default=True,
+    help='run on this many containers at the same time',
+)
+@click.option(
+    '--timeout',
+    default='1m',
+    show_default=True,
+    callback=click_parse_timespan,
+    help='give up on a container after this long, e.g. 30s, 2m',
+)
+@click.pass_context
+def x(ctx, command, parallel, timeout):
+    """run command on all containers (one for each deployment) within current
+    namespace.  only show output when command succeeds
+
+    \b
+    examples:
+    \b
+        lain admin x -- bash -c 'pip3 freeze | grep -i requests'
+        lain admin x --parallel 20 --timeout 10s -- cat /etc/os-release
+    """
+    ctx.obj['silent'] = True
+    replica_sets = {}
+    for rs in kube_read('replicaset')['items']:
+        for ref in rs['metadata'].get('ownerReferences') or []:
+            if ref.get('kind') == 'Deployment':
+                replica_sets[rs['metadata']['name']] = ref['name']
+
+    # one pod for each deployment, ready ones preferred
+    targets = {}
+    for record in get_pods(check=True):
+        owner_kind, owner_name = record.owner or (None, None)
+        if owner_kind != 'ReplicaSet' or record.phase != 'Running':
+            continue
+        deploy_name = replica_sets.get(owner_name)
+        if not deploy_name:
+            continue
+        picked = targets.get(deploy_name)
+        if not picked or (record.is_ready and not picked.is_ready):
+            targets[deploy_name] = record
+
+    def run(deploy_name):
+        pod_name = targets[deploy_name].name
+        return kubectl(
+            'exec',
+            pod_name,
+            '--',
+            *command,
+            check=False,
+            timeout=timeout,
+            capture_output=True,
+        )
+
+    results = []
+    executions = iter_parallel(run, sorted(targets), max_workers=parallel)
+    for deploy_name, future in executions:
+        pod_name = targets[deploy_name].name
+        res = future.result()
+        if code := rc(res):
+            stderr = ensure_str(res.stderr)
+            if stderr.startswith('this command reached its'):
+                results.append((pod_name, deploy_name, 'timeout'))
+                continue
+            # abort execution in the case of network error
+            if 'unable to connect' in stderr.lower() or 'timeout' in stderr:
+                error(stderr, exit=1)
+            results.append((pod_name, deploy_name, f'exit {code}'))
+            continue
+        results.append((pod_name, deploy_name, 'ok'))
+        for line in ensure_str(res.stdout).splitlines():
+            echo(f'{pod_name}: {line}', clean=False)
+
+    if not results:
+        return
+    results.sort(key=lambda row: (row[2] == 'ok', row[0]))
+    echo('\n'.join(format_table([('POD', 'DEPLOYMENT', 'RESULT'), *results])))
+    ok = sum(result == 'ok' for *_, result in results)
+    echo(f'command succeeds for {ok} of {len(results)} containers')
+
+
+@admin.command()
+@click.argument('instance_ids', nargs=-1)
+def stop_cvm(instance_ids):
+    from lain_cli.tencent import TencentPaaS
+
+    client = TencentPaaS()
+    client.turn_(InstanceIds=instance_ids, state='off')
+
+
+@admin.command()
+@click.argument('instance_ids', nargs=-1)
+def start_cvm(instance_ids):
+    from lain_cli.tencent import TencentPaaS
+
+    client = TencentPaaS()
+    client.turn_(InstanceIds=instance_ids)
+
+
+@admin.command()
+@click.argument('state', nargs=1, type=click.Choice(VM_STATES))
+@click.pass_context
+def turn(ctx, state):
+    """\b
+    turn off currently used cluster, to save money"""
+    current_state = wait_for_cluster_up()
+    if current_state != state:
+        from lain_cli.tencent import TencentPaaS
+
+        cluster = ctx.obj['cluster']
+        client = TencentPaaS()
+        client.turn_(cluster=cluster, state=state)
+
+    if state == 'on':
+        final_state = wait_for_cluster_up(tries=120)
+        if final_state != 'on':
+            error(f'cluster {cluster} still not up')
+
+
+@admin.command()
+def list_waste():
+    from lain_cli.prometheus import Prometheus
+
+    deploy_list = ensure_str(
+        kubectl('get', 'deploy', '--no-headers', capture_output=True).stdout
+    ).splitlines()
+    helm_release_names = set(
+        ensure_str(helm('list', '--short', capture_output=True).stdout).split()
+    )
+    prometheus = Prometheus()
+    for line in deploy_list:
+        name, actual_desired, *_ = line.split()
+        desired = int(actual_desired.split('/')[-1])
+        if desired < 2:
+            continue
+        appname, proc_name = name.rsplit('-', 1)
+        if appname not in helm_release_names:
+            continue
+        cpu_top, _ = prometheus.cpu_p95(appname, proc_name)
+        if not cpu_top:
+            warn(f'skipping {appname} because cpu data is not available')
+            continue
+
+        error(f'{appname}-{proc_name} has {desired} pods, cpu P90: {cpu_top}')
+
+
+@admin.command()
+@click.option(
+    '--cluster-config',
+    'cc_path',
+    type=click.Path(),
+    required=True,
+    help='specify cluster config yaml',
+)
+@click.pass_context
+def migrate_registry(ctx, cc_path):
+    data = yalo(cc_path)
+    schema = ClusterConfigSchema(context={'is_current': True})
+    cc = schema.load(data)
+    registry_addr = cc['registry']
+    dest_registry = tell_registry_client(cc)
+    existing_images = dest_registry.list_images()
+
+    def tell_tag(image):
+        return image.split('/')[-1]
+
+    tags = set(tell_tag(s) for s in existing_images)
+    registry = tell_registry_client()
+    images = registry.list_images()
+    for image in images:
+        if tell_tag(image) in tags:
+            echo(f'skip {image}')
+            continue
+        banyun(
+            image,
+            pull=True,
+            registry=registry_addr,
+        )
+
+
+@admin.command()
+@click.option(
+    '--count-below',
+    default=1,
+    help='list ingress that has been requested fewer than this amount',
+)
+@click.option('--period', default='7d', help='query timespan')
+@click.pass_context
+def list_unused_ingress(ctx, count_below, period):
+    """list ingresses that barely get any requests, along with their pods.
+    ingresses, services and pods are listed once, and joined locally, request
+    counts come from a single kibana search for each ingress class, only
+    candidates are looked into further, concurrently, rows are printed as
+    soon as they're ready"""
+    from lain_cli.kibana import Kibana
+
+    ctx.obj['silent'] = True
+    WEEK = parse_timespan('7d')
+    period_s = int(parse_timespan(period))
+    ingresses = kube_read('ingress')['items']
+    services = {svc['metadata']['name']: svc for svc in kube_read('service')['items']}
+    pods = [(pod, PodRecord.from_pod(pod)) for pod in kube_read('pod')['items']]
+    kibana = Kibana()
+    seen_svcs = set()
+    lock = threading.Lock()
+
+    def tell_pods(selector):
+        if not selector:
+            return []
+        return [
+            record
+            for pod, record in pods
+            if selector.items() <= (pod['metadata'].get('labels') or {}).items()
+        ]
+
+    def tell_ingress_class(ing):
+        annotations = ing['metadata'].get('annotations') or {}
+        ingress_class = annotations.get('kubernetes.io/ingress.class')
+        return ingress_class or ing['spec'].get('ingressClassName')
+
+    def tell_hosts(ing):
+        rules = ing['spec'].get('rules') or []
+        return [rule['host'] for rule in rules if rule.get('host')]
+
+    def inspect(ing):
+        """returns the line to print, if any"""
+        ing_name = ing['metadata']['name']
+        counts = host_counts[tell_ingress_class(ing)]
+        hosts = tell_hosts(ing)
+        host = ','.join(hosts)
+        query_count = sum(counts[h] for h in hosts)
+        if query_count >= count_below:
+            return
+        # networking.k8s.io/v1beta1 and v1 backends, respectively
+        svc_names = list(find_values(ing['spec'], 'serviceName'))
+        svc_names.extend(b['name'] for b in find_values(ing['spec'], 'service'))
+        if not svc_names:
+            return
+        svc_name = svc_names[0]
+        svc = services.get(svc_name)
+        if not svc:
+            debug(f'{ing_name} had bad svc: {svc_name}')
+            return f'k delete ing {ing_name}'
+        # only existing services are remembered, every ingress pointing at a
+        # missing service should be deleted
+        with lock:
+            if svc_name in seen_svcs:
+                debug(f'svc already seen, skip: {svc_name}')
+                return
+            seen_svcs.add(svc_name)
+
+        records = tell_pods(svc['spec'].get('selector'))
+        if not records:
+            debug(f'{ing_name} has no pods')
+            return f'k delete ing {ing_name}'
+        if min(record.age for record in records) < WEEK:
+            debug(f'{ing_name} has young pods, skip')
+            return
+        pod_name = records[0].name
+        # a single byte will do
+        log_res = kubectl(
+            'logs',
+            f'--since={period_s}s',
+            '--limit-bytes=1',
+            pod_name,
+            capture_output=True,
+        )
+        if log_res.stdout:
+            debug(f'pod {pod_name} is still printing logs, skip')
+            return
+        pod_names = ' '.join(record.name for record in records)
+        return f'{host}\t{query_count}\t{pod_names}'
+
+    candidates = [
+        ing
+        for ing in ingresses
+        if tell_hosts(ing) and not all(h.endswith('.lain') for h in tell_hosts(ing))
+    ]
+    # one kibana search for each ingress class, rather than one for each host
+    hosts_by_class = defaultdict(set)
+    for ing in candidates:
+        hosts_by_class[tell_ingress_class(ing)].update(tell_hosts(ing))
+
+    host_counts = {
+        ingress_class: kibana.count_records_for_hosts(
+            hosts, ingress_class=ingress_class, period=period
+        )
+        for ingress_class, hosts in hosts_by_class.items()
+    }
+    for _, future in iter_parallel(inspect, candidates):
+        echo(future.result())
+
+
+@admin.command()
+@click.argument('resource')
+@click.option(
+    '--annotations',
+    required=True,
+    multiple=True,
+    type=KVPairType(),
+    help='query by annotations',
+)
+@click.pass_context
+def get(ctx, resource, annotations):
+    """Like kubectl get, but support filtering by annotations.
+
+    \b
+    examples:
+    \b
+        lain admin get pod --annotations prometheus.io/scrape=true
+    """
+    ctx.obj['silent'] = True
+    items = kubectl(
+        'get',
+        '--all-namespaces',
+        resource,
+        '-o=custom-columns=NS:.metadata.namespace,NAME:.metadata.name,:.metadata.annotations',
+        '--no-headers',
+        check=True,
+        capture_output=True,
+    )
+
+    def parse_annotations(s):
+        bracketed = s.strip().removeprefix('map').strip('[]')
+        if bracketed == '<none>':
+            return
+        pairs = bracketed.split()
+        dic = dict([pair.split(':', 1) for pair in pairs])
+        return dic
+
+    for line in ensure_str(items.stdout).splitlines():
+        try:
+            _, _, annotations_part = line.split(None, 2)
+        except ValueError:
+            continue
+        annotations_dic = parse_annotations(annotations_part)
+        if not annotations_dic:
+            continue
+        for k, v in annotations:
+            if annotations_dic.get(k) == v:
+                echo(line)
+            else:
+                debug(line)
+
+
+@admin.command()
+@click.option(
+    '--labels',
+    'labels',
+    multiple=True,
+    type=KVPairType(),
+    help='custom labels',
+)
+@click.pass_context
+def post_alerts(ctx, labels):
+    from lain_cli.prometheus import Alertmanager
+
+    am = Alertmanager()
+    am.post_alerts(labels)
+
+
+@admin.command()
+@click.argument('secret_name', nargs=1)
+@click.pass_context
+def upload_paas_tls_certificate(ctx, secret_name):
+    secret_dic = tell_secret(secret_name)
+    data = secret_dic['data']
+    crt = data['tls.crt']
+    key = data['tls.key']
+    paas = tell_paas_client()
+    paas.upload_tls_certificate(crt, key)
@@ -0,0 +1,155 @@
+"""the lain entry point.
+
+when `lain daemon` is running, argv, environment and cwd are forwarded to it
+via a unix socket, along with our stdin / stdout / stderr, so that the
+command runs inside an already warmed up process, while its output goes
+straight to our terminal. when there's no daemon (or LAIN_NO_DAEMON is set),
+lain runs in this process, as usual.
+
+this module is imported before anything else, keep it stdlib only.
+"""
+import json
+import os
+import socket
+import stat
+import struct
+import sys
+from os.path import abspath, dirname, join
+
+from lain_cli import __version__
+
+# utils calculates these at import time, a daemon started with different
+# values cannot serve us
+DAEMON_IMPORT_TIME_ENV = (
+    'HOME',
+    'LAIN_CLUSTER_VALUES_DIR',
+    'LAIN_CACHE_DIR',
+    'XDG_CACHE_HOME',
+)
+DAEMON_HEADER_FORMAT = '!I'
+
+
+def tell_daemon_socket_path():
+    path = os.environ.get('LAIN_DAEMON_SOCKET')
+    if path:
+        return path
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime_dir:
+        return join(runtime_dir, f'lain-{os.getuid()}.sock')
+    # /tmp is shared by every user, use a private directory inside it, just
+    # like tmux does
+    return join('/tmp', f'lain-{os.getuid()}', 'lain.sock')
+
+
+def is_private_dir(path):
+    """owned by us, and inaccessible to anyone else"""
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return False
+    return (
+        stat.S_ISDIR(st.st_mode)
+        and st.st_uid == os.getuid()
+        and not stat.S_IMODE(st.st_mode) & 0o077
+    )
+
+
+def is_trusted_socket(path):
+    """we send our environment (credentials included) and stdio to the
+    daemon, so the socket must be ours, in a directory no one else can
+    write to, otherwise another local user could've planted it"""
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return False
+    if not stat.S_ISSOCK(st.st_mode) or st.st_uid != os.getuid():
+        return False
+    return is_private_dir(dirname(abspath(path)))
+
+
+def tell_peer_uid(sock):
+    """uid of the process on the other end, None if the platform cannot
+    tell"""
+    if not hasattr(socket, 'SO_PEERCRED'):
+        return
+    creds_format = '3i'
+    creds = sock.getsockopt(
+        socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize(creds_format)
+    )
+    _, uid, _ = struct.unpack(creds_format, creds)
+    return uid
+
+
+def make_daemon_request(argv):
+    return {
+        'version': __version__,
+        'argv': list(argv),
+        'env': dict(os.environ),
+        'cwd': os.getcwd(),
+    }
+
+
+def connect_daemon(path):
+    if not hasattr(socket, 'send_fds') or not is_trusted_socket(path):
+        return
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        peer_uid = tell_peer_uid(sock)
+    except OSError:
+        sock.close()
+        return
+    if peer_uid not in {None, os.getuid()}:
+        sock.close()
+        return
+    return sock
+
+
+def run_in_daemon(argv, path=None):
+    """returns exit code of the command, or None if the daemon isn't
+    available, or refuses to serve us"""
+    sock = connect_daemon(path or tell_daemon_socket_path())
+    if not sock:
+        return
+    payload = json.dumps(make_daemon_request(argv)).encode('utf-8')
+    with sock:
+        try:
+            socket.send_fds(
+                sock,
+                [struct.pack(DAEMON_HEADER_FORMAT, len(payload))],
+                [0, 1, 2],
+            )
+            sock.sendall(payload)
+        except OSError:
+            return
+        try:
+            line = sock.makefile('rb').readline()
+        except KeyboardInterrupt:
+            # closing the connection tells the daemon to stop the command
+            return 130
+        except OSError:
+            line = b''
+
+    if not line:
+        # daemon died while running our command
+        return 1
+    reply = json.loads(line)
+    if 'fallback' in reply:
+        return
+    return reply['code']
+
+
+def main():
+    argv = sys.argv[1:]
+    if not os.environ.get('LAIN_NO_DAEMON') and 'daemon' not in argv[:1]:
+        code = run_in_daemon(argv)
+        if code is not None:
+            sys.exit(code)
+
+    from lain_cli.lain import main as lain_main
+
+    lain_main()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,275 @@
+import json
+import os
+import signal
+import socket
+import struct
+import sys
+import threading
+import traceback
+from contextlib import suppress
+from importlib import import_module
+from os import makedirs
+from os.path import abspath, dirname
+from time import time
+
+import click
+
+from lain_cli import __version__
+from lain_cli.client import (
+    DAEMON_HEADER_FORMAT,
+    DAEMON_IMPORT_TIME_ENV,
+    is_private_dir,
+    tell_daemon_socket_path,
+)
+from lain_cli.utils import (
+    CLUSTERS,
+    ENV,
+    click_parse_timespan,
+    debug,
+    error,
+    goodjob,
+    wait_for_version_check,
+)
+
+PREWARM_MODULES = (
+    'lain_cli.lain',
+    'lain_cli.kube',
+    'lain_cli.admin',
+    'lain_cli.prompt',
+    'lain_cli.webhook',
+    'lain_cli.registry',
+    'lain_cli.harbor',
+    'lain_cli.kibana',
+    'lain_cli.prometheus',
+    'lain_cli.scm',
+    'lain_cli.tencent',
+    'lain_cli.aliyun',
+)
+
+
+def prewarm():
+    for module_name in PREWARM_MODULES:
+        try:
+            import_module(module_name)
+        except ImportError as e:
+            debug(f'skip prewarming {module_name}: {e}')
+
+    # accessing this property compiles all cluster config, which is then
+    # kept in memory for every command this daemon serves
+    _ = CLUSTERS.compiled
+
+
+def recv_exactly(conn, size):
+    buf = b''
+    while len(buf) < size:
+        chunk = conn.recv(size - len(buf))
+        if not chunk:
+            raise ConnectionError('client hung up during handshake')
+        buf += chunk
+
+    return buf
+
+
+def send_reply(conn, reply):
+    with suppress(OSError):
+        conn.sendall(json.dumps(reply).encode('utf-8') + b'\n')
+
+
+def tell_fallback_reason(request):
+    if request.get('version') != __version__:
+        return f'daemon is running lain {__version__}'
+    env = request['env']
+    for k in DAEMON_IMPORT_TIME_ENV:
+        if env.get(k) != os.environ.get(k):
+            return f'daemon is started with a different {k}'
+
+
+def reopen_std_streams():
+    sys.stdin = open(0, 'r', closefd=False)
+    sys.stdout = open(1, 'w', closefd=False)
+    sys.stderr = open(2, 'w', closefd=False)
+
+
+def watch_client(conn):
+    """the client sends nothing after the request, so EOF means it's gone
+    (most likely ctrl-c), stop the command along with its subprocesses"""
+
+    def watch():
+        with suppress(OSError):
+            conn.recv(1)
+        os.killpg(0, signal.SIGINT)
+
+    threading.Thread(target=watch, daemon=True).start()
+
+
+def run_lain(argv):
+    from lain_cli.lain import lain
+
+    sys.argv = ['lain', *argv]
+    try:
+        lain.main(args=argv, prog_name='lain', obj={})
+    except SystemExit as e:
+        if isinstance(e.code, int):
+            return e.code
+        return int(e.code is not None)
+    return 0
+
+
+def handle(conn):
+    """runs inside a forked process, serves exactly one lain command"""
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    # own process group, so that a disconnected client can take down
+    # kubectl / helm subprocesses as well
+    os.setpgid(0, 0)
+    header_size = struct.calcsize(DAEMON_HEADER_FORMAT)
+    msg, fds, _, _ = socket.recv_fds(conn, header_size, 3)
+    if len(fds) != 3:
+        for fd in fds:
+            os.close(fd)
+        send_reply(conn, {'fallback': 'stdio not received'})
+        return
+    msg += recv_exactly(conn, header_size - len(msg))
+    (length,) = struct.unpack(DAEMON_HEADER_FORMAT, msg)
+    request = json.loads(recv_exactly(conn, length))
+    reason = tell_fallback_reason(request)
+    if reason:
+        for fd in fds:
+            os.close(fd)
+        send_reply(conn, {'fallback': reason})
+        return
+    sys.stdout.flush()
+    sys.stderr.flush()
+    for target, fd in enumerate(fds):
+        os.dup2(fd, target)
+        os.close(fd)
+
+    reopen_std_streams()
+    env = request['env']
+    os.environ.clear()
+    os.environ.update(env)
+    # other modules hold a reference to ENV, update in place
+    ENV.clear()
+    ENV.update(env)
+    os.chdir(request['cwd'])
+    CLUSTERS.reset()
+    watch_client(conn)
+    try:
+        code = run_lain(request['argv'])
+    except KeyboardInterrupt:
+        code = 130
+
+    wait_for_version_check()
+    with suppress(OSError):
+        sys.stdout.flush()
+        sys.stderr.flush()
+
+    send_reply(conn, {'code': code})
+
+
+def reap(children):
+    for pid in list(children):
+        with suppress(ChildProcessError):
+            done, _ = os.waitpid(pid, os.WNOHANG)
+            if not done:
+                continue
+        children.discard(pid)
+
+
+def make_server(socket_path):
+    socket_dir = dirname(abspath(socket_path))
+    makedirs(socket_dir, mode=0o700, exist_ok=True)
+    if not is_private_dir(socket_dir):
+        # clients refuse sockets that others could have planted
+        error(
+            f'{socket_dir} must be owned by you, with permission 0700, '
+            'or lain would not connect to the daemon',
+            exit=1,
+        )
+    if os.path.exists(socket_path):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(socket_path)
+        except OSError:
+            os.unlink(socket_path)
+        else:
+            error(f'lain daemon already running at {socket_path}', exit=1)
+        finally:
+            probe.close()
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    old_umask = os.umask(0o177)
+    try:
+        server.bind(socket_path)
+    finally:
+        os.umask(old_umask)
+
+    server.listen(64)
+    return server
+
+
+def serve(server, idle_timeout=None):
+    server.settimeout(1)
+    children = set()
+    last_active = time()
+    while True:
+        reap(children)
+        if children:
+            last_active = time()
+        elif idle_timeout and time() - last_active > idle_timeout:
+            debug(f'idle for {idle_timeout}s, bye')
+            return
+        try:
+            conn, _ = server.accept()
+        except socket.timeout:
+            continue
+        conn.settimeout(None)
+        pid = os.fork()
+        if pid == 0:
+            server.close()
+            try:
+                handle(conn)
+            except BaseException:
+                traceback.print_exc()
+            finally:
+                os._exit(0)
+
+        conn.close()
+        children.add(pid)
+
+
+@click.command()
+@click.option(
+    '--socket',
+    'socket_path',
+    default=tell_daemon_socket_path,
+    help='unix socket to listen on, defaults to $XDG_RUNTIME_DIR/lain-[UID].sock',
+)
+@click.option(
+    '--idle-timeout',
+    default='1h',
+    callback=click_parse_timespan,
+    help='exit after being idle for this long, use 0 to run forever',
+)
+def daemon(socket_path, idle_timeout):
+    """keep a warmed up lain around, so that commands start faster.
+
+    once the daemon is running, lain forwards every command (along with
+    environment, cwd and stdio) to it, each command runs in a process forked
+    from the daemon. set LAIN_NO_DAEMON=1 to bypass.
+
+    \b
+    examples:
+    \b
+        lain daemon &
+        lain daemon --idle-timeout 8h
+    """
+    prewarm()
+    server = make_server(socket_path)
+    goodjob(f'lain daemon listening on {socket_path}')
+    try:
+        serve(server, idle_timeout=idle_timeout)
+    finally:
+        server.close()
+        with suppress(OSError):
+            os.unlink(socket_path)
@@ -1,5 +1,4 @@
 from datetime import datetime, timedelta
-from time import sleep
 
 from humanfriendly import parse_timespan
 
@@ -10,6 +9,9 @@ class Kibana(RequestClientMixin):
 
     timezone = 'Asia/Shanghai'
     timeout = 40
+    # how long kibana may hold a search response, this must stay well below
+    # timeout, or the http request times out before kibana answers
+    search_wait = 30
 
     def __init__(self):
         cc = tell_cluster_config()
@@ -35,6 +37,15 @@ class Kibana(RequestClientMixin):
     def count_records_for_host(
         self, host=None, ingress_class='lain-internal', period='7d'
     ):
+        return self.count_records_for_hosts(
+            [host], ingress_class=ingress_class, period=period
+        )[host]
+
+    def count_records_for_hosts(
+        self, hosts, ingress_class='lain-internal', period='7d'
+    ):
+        """request count for every host, in a single search: no hits, just a
+        filters aggregation with one bucket for each host"""
         path = '/internal/search/es'
         start = datetime.utcnow()
         delta = timedelta(seconds=parse_timespan(period))
@@ -46,31 +57,24 @@ class Kibana(RequestClientMixin):
         else:
             raise ValueError(f'weird ingress_class: {ingress_class}')
 
-        # query copied from browser
+        hosts = sorted(set(hosts))
+        if not hosts:
+            return {}
+        host_filters = {
+            host: {
+                'query_string': {
+                    'analyze_wildcard': True,
+                    'query': f'vhost:"{host}"',
+                    'time_zone': self.timezone,
+                }
+            }
+            for host in hosts
+        }
         query = {
             'params': {
                 'body': {
-                    '_source': {'excludes': []},
-                    'aggs': {
-                        '2': {
-                            'date_histogram': {
-                                'field': 'ts',
-                                'fixed_interval': '3h',
-                                'min_doc_count': 1,
-                                'time_zone': self.timezone,
-                            }
-                        }
-                    },
-                    'docvalue_fields': [
-                        {'field': '@timestamp', 'format': 'date_time'},
-                        {'field': 'ts', 'format': 'date_time'},
-                    ],
-                    'highlight': {
-                        'fields': {'*': {}},
-                        'fragment_size': 2147483647,
-                        'post_tags': ['@/kibana-highlighted-field@'],
-                        'pre_tags': ['@kibana-highlighted-field@'],
-                    },
+                    'size': 0,
+                    'aggs': {'hosts': {'filters': {'filters': host_filters}}},
                     'query': {
                         'bool': {
                             'filter': [
@@ -84,50 +88,47 @@ class Kibana(RequestClientMixin):
                                     }
                                 }
                             ],
-                            'must': [
-                                {
-                                    'query_string': {
-                                        'analyze_wildcard': True,
-                                        'query': f'vhost:"{host}"',
-                                        'time_zone': self.timezone,
-                                    }
-                                }
-                            ],
-                            'must_not': [],
-                            'should': [],
                         }
                     },
-                    'script_fields': {},
-                    'size': 500,
-                    'sort': [{'ts': {'order': 'desc', 'unmapped_type': 'boolean'}}],
-                    'stored_fields': ['*'],
-                    'version': True,
                 },
-                'ignoreThrottled': True,
                 'ignore_throttled': True,
                 'ignore_unavailable': True,
                 'index': index_pattern,
-                # https://github.com/elastic/kibana/blob/master/src/plugins/data/public/search/es_search/get_es_preference.ts#L25
                 'preference': None,
                 'rest_total_hits_as_int': True,
                 'timeout': f'{self.timeout_ms}ms',
+                # let the server hold the response until results are ready,
+                # rather than polling it
+                'wait_for_completion_timeout': f'{self.search_wait}s',
             },
             'serverStrategy': 'es',
         }
-        res = self.post(path, json=query)
-        responson = res.json()
-        tries = 9
-        request_id = responson.get('id')  # 没给 id 的话, 说明查询已经结束, 不用轮询结果了
-        if not request_id:
-            while responson['loaded'] != responson['total'] and tries:
-                debug(f'polling kibana search results: {request_id}')
-                sleep(3)
-                res = self.post(path, json={'id': request_id})
-                responson = res.json()
-                tries -= 1
+        responson = self.post(path, json=query).json()
+        tries = 3
+        request_id = responson.get('id')
+        while request_id and self.is_running(responson) and tries:
+            debug(f'waiting for kibana search results: {request_id}')
+            res = self.post(
+                path,
+                json={
+                    'id': request_id,
+                    'params': {'wait_for_completion_timeout': f'{self.search_wait}s'},
+                },
+            )
+            responson = res.json()
+            tries -= 1
 
+        # every host would count as zero otherwise, and be taken as unused
+        if self.is_running(responson):
+            error(f'kibana search not finished in time: {request_id}', exit=1)
         try:
-            count = responson['rawResponse']['hits']['total']
-        except KeyError:
-            return 0
-        return count
+            buckets = responson['rawResponse']['aggregations']['hosts']['buckets']
+        except (KeyError, TypeError):
+            error(f'bad kibana search response: {responson}', exit=1)
+        return {host: buckets.get(host, {}).get('doc_count', 0) for host in hosts}
+
+    @staticmethod
+    def is_running(responson):
+        if responson.get('isRunning'):
+            return True
+        return responson.get('loaded', 0) != responson.get('total', 0)
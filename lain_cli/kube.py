@@ -0,0 +1,312 @@
+"""a minimal Kubernetes API client, for the handful of reads (and patches)
+lain makes all the time, so that they don't pay for a kubectl process (and a
+fresh TLS handshake) each.
+
+only static credentials are supported (token, client certificate, basic
+auth), kubeconfig using exec / auth-provider plugins raises KubeUnsupported,
+callers should fall back to kubectl, see kube_read in utils.
+"""
+import base64
+import json
+import os
+from os.path import dirname, isabs, join
+from tempfile import TemporaryDirectory
+
+import requests
+from requests.adapters import HTTPAdapter
+from ruamel.yaml import YAMLError
+
+from lain_cli.utils import RequestClientMixin, yalo
+
+# kind: (api prefix, resource, namespaced)
+KUBE_RESOURCES = {
+    'pod': ('api/v1', 'pods', True),
+    'secret': ('api/v1', 'secrets', True),
+    'configmap': ('api/v1', 'configmaps', True),
+    'service': ('api/v1', 'services', True),
+    'event': ('api/v1', 'events', True),
+    'persistentvolumeclaim': ('api/v1', 'persistentvolumeclaims', True),
+    'node': ('api/v1', 'nodes', False),
+    'deployment': ('apis/apps/v1', 'deployments', True),
+    'statefulset': ('apis/apps/v1', 'statefulsets', True),
+    'replicaset': ('apis/apps/v1', 'replicasets', True),
+    'job': ('apis/batch/v1', 'jobs', True),
+    'cronjob': ('apis/batch/v1', 'cronjobs', True),
+    'ingress': ('apis/networking.k8s.io/v1', 'ingresses', True),
+    'storageclass': ('apis/storage.k8s.io/v1', 'storageclasses', False),
+}
+KUBE_RESOURCE_ALIASES = {
+    'po': 'pod',
+    'cm': 'configmap',
+    'svc': 'service',
+    'ev': 'event',
+    'pvc': 'persistentvolumeclaim',
+    'no': 'node',
+    'deploy': 'deployment',
+    'sts': 'statefulset',
+    'rs': 'replicaset',
+    'cj': 'cronjob',
+    'ing': 'ingress',
+    'sc': 'storageclass',
+}
+
+
+class KubeUnsupported(Exception):
+    """this client cannot handle it, use kubectl instead"""
+
+
+class KubeApiError(Exception):
+    def __init__(self, status_code, reason='', message=''):
+        super().__init__(f'{status_code} {reason}: {message}')
+        self.status_code = status_code
+        self.reason = reason
+        self.message = message
+
+
+def tell_kube_resource(kind):
+    """
+    >>> tell_kube_resource('po')
+    ('api/v1', 'pods', True)
+    >>> tell_kube_resource('ingresses')
+    ('apis/networking.k8s.io/v1', 'ingresses', True)
+    """
+    kind = kind.lower()
+    kind = KUBE_RESOURCE_ALIASES.get(kind, kind)
+    if kind not in KUBE_RESOURCES and kind.endswith('s'):
+        kind = kind[:-1]
+        if kind.endswith('sse'):
+            # storageclasses, ingresses
+            kind = kind[:-1]
+
+    try:
+        return KUBE_RESOURCES[kind]
+    except KeyError as e:
+        raise KubeUnsupported(f'unsupported kind: {kind}') from e
+
+
+def tell_kubeconfig_path(kubeconfig_env=None):
+    if not kubeconfig_env:
+        return os.path.expanduser('~/.kube/config')
+    paths = [p for p in kubeconfig_env.split(os.pathsep) if p]
+    if len(paths) != 1:
+        # kubectl merges multiple kubeconfig files, we don't
+        raise KubeUnsupported(f'multiple kubeconfig files: {kubeconfig_env}')
+    return paths[0]
+
+
+def find_by_name(entries, name, what):
+    for entry in entries or []:
+        if entry.get('name') == name:
+            return entry[what]
+    raise KubeUnsupported(f'{what} {name} not found in kubeconfig')
+
+
+class KubeClient(RequestClientMixin):
+    timeout = 20
+
+    def __init__(
+        self, server, namespace='default', verify=True, cert=None, headers=None
+    ):
+        self.endpoint = server.rstrip('/')
+        self.namespace = namespace
+        self.headers = {'Accept': 'application/json', **(headers or {})}
+        self.session = requests.Session()
+        # lain may run a few reads concurrently, keep them all alive
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=8)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.verify = verify
+        self.session.cert = cert
+        # holds certificate files written by from_kubeconfig
+        self.tempdir = None
+
+    @classmethod
+    def from_kubeconfig(cls, path):
+        try:
+            kubeconfig = yalo(path)
+        except (OSError, YAMLError) as e:
+            raise KubeUnsupported(f'cannot read kubeconfig {path}: {e}') from e
+        if not isinstance(kubeconfig, dict):
+            raise KubeUnsupported(f'bad kubeconfig: {path}')
+        context_name = kubeconfig.get('current-context')
+        context = find_by_name(kubeconfig.get('contexts'), context_name, 'context')
+        cluster = find_by_name(
+            kubeconfig.get('clusters'), context['cluster'], 'cluster'
+        )
+        user = {}
+        if context.get('user'):
+            user = find_by_name(kubeconfig.get('users'), context['user'], 'user') or {}
+
+        if 'exec' in user or 'auth-provider' in user:
+            raise KubeUnsupported('kubeconfig uses credential plugins')
+
+        tempdir = TemporaryDirectory(prefix='lain-kube-')
+        base_dir = dirname(path)
+
+        def tell_file(clause, key):
+            """kubeconfig can either inline file content (base64 encoded), or
+            refer to a file, relative to kubeconfig itself"""
+            data = clause.get(f'{key}-data')
+            if data:
+                dest = join(tempdir.name, key)
+                with open(dest, 'wb') as f:
+                    f.write(base64.b64decode(data))
+
+                return dest
+            filename = clause.get(key)
+            if filename and not isabs(filename):
+                filename = join(base_dir, filename)
+            return filename
+
+        if cluster.get('insecure-skip-tls-verify'):
+            verify = False
+        else:
+            verify = tell_file(cluster, 'certificate-authority') or True
+
+        headers = {}
+        token = user.get('token')
+        token_file = user.get('tokenFile')
+        if not token and token_file:
+            with open(tell_file(user, 'tokenFile')) as f:
+                token = f.read().strip()
+
+        if token:
+            headers['Authorization'] = f'Bearer {token}'
+        elif user.get('username'):
+            basic = f'{user["username"]}:{user.get("password", "")}'
+            headers['Authorization'] = (
+                'Basic ' + base64.b64encode(basic.encode()).decode()
+            )
+
+        cert = None
+        client_cert = tell_file(user, 'client-certificate')
+        if client_cert:
+            cert = (client_cert, tell_file(user, 'client-key'))
+
+        client = cls(
+            cluster['server'],
+            namespace=context.get('namespace') or 'default',
+            verify=verify,
+            cert=cert,
+            headers=headers,
+        )
+        # certificate files must live as long as the client
+        client.tempdir = tempdir
+        return client
+
+    def request(self, *args, **kwargs):
+        res = super().request(*args, **kwargs)
+        if res.status_code < 400:
+            return res
+        try:
+            status = res.json()
+        except ValueError:
+            status = None
+        if not isinstance(status, dict) or status.get('kind') != 'Status':
+            # not an api server error, e.g. this api group doesn't exist on
+            # this cluster
+            raise KubeUnsupported(f'{res.status_code} {res.text[:200]}')
+        raise KubeApiError(
+            res.status_code, status.get('reason', ''), status.get('message', '')
+        )
+
+    def tell_path(self, kind, name=None, namespace=None):
+        prefix, resource, namespaced = tell_kube_resource(kind)
+        parts = [f'/{prefix}']
+        if namespaced:
+            parts.append(f'namespaces/{namespace or self.namespace}')
+
+        parts.append(resource)
+        if name:
+            parts.append(name)
+
+        return '/'.join(parts)
+
+    def read(self, kind, name=None, selector=None, field_selector=None, namespace=None):
+        """same as kubectl get -ojson, lists come with kind / apiVersion
+        filled in for every item, just like kubectl does"""
+        params = {}
+        if selector:
+            params['labelSelector'] = selector
+
+        if field_selector:
+            params['fieldSelector'] = field_selector
+
+        path = self.tell_path(kind, name=name, namespace=namespace)
+        responson = self.get(path, params=params).json()
+        if name:
+            return responson
+        item_kind = responson.get('kind', '')[: -len('List')]
+        for item in responson.get('items') or []:
+            item.setdefault('kind', item_kind)
+            item.setdefault('apiVersion', responson.get('apiVersion'))
+
+        return responson
+
+    def patch(self, kind, name, body, namespace=None):
+        """json merge patch, same as kubectl patch --type=merge"""
+        path = self.tell_path(kind, name=name, namespace=namespace)
+        res = self.request(
+            'PATCH',
+            path,
+            json=body,
+            headers={**self.headers, 'Content-Type': 'application/merge-patch+json'},
+        )
+        return res.json()
+
+    def open_logs(self, name, container=None, tail_lines=None, namespace=None):
+        """kubectl logs -f --timestamps, as a streaming response, iterate it
+        with iter_lines, and close it to stop following"""
+        params = {'follow': 'true', 'timestamps': 'true'}
+        if container:
+            params['container'] = container
+
+        if tail_lines is not None and tail_lines >= 0:
+            params['tailLines'] = tail_lines
+
+        path = self.tell_path('pod', name=name, namespace=namespace) + '/log'
+        # log lines may be hours apart
+        return self.get(path, params=params, stream=True, timeout=(self.timeout, None))
+
+    def watch(
+        self,
+        kind,
+        selector=None,
+        resource_version=None,
+        timeout_seconds=None,
+        namespace=None,
+        bookmarks=False,
+    ):
+        """yields (event type, object) as they happen, until the api server
+        ends the stream (after timeout_seconds). with bookmarks, the api
+        server sends BOOKMARK events to keep resource_version fresh"""
+        params = {'watch': 'true'}
+        if bookmarks:
+            params['allowWatchBookmarks'] = 'true'
+
+        if selector:
+            params['labelSelector'] = selector
+
+        if resource_version:
+            params['resourceVersion'] = resource_version
+
+        if timeout_seconds:
+            params['timeoutSeconds'] = timeout_seconds
+
+        path = self.tell_path(kind, namespace=namespace)
+        # events may be minutes apart, only the api server ends this stream
+        res = self.get(path, params=params, stream=True, timeout=(self.timeout, None))
+        with res:
+            for line in res.iter_lines():
+                if not line:
+                    continue
+                event = json.loads(line)
+                obj = event.get('object') or {}
+                if event.get('type') == 'ERROR':
+                    # e.g. 410 Gone, resourceVersion is too old
+                    raise KubeApiError(
+                        obj.get('code', 500),
+                        obj.get('reason', ''),
+                        obj.get('message', ''),
+                    )
+                yield event['type'], obj
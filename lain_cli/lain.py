@@ -1,58 +1,44 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 import os
-import re
 import shutil
+import subprocess
 import sys
 from copy import deepcopy
+from functools import partial
 from os import getcwd as cwd
 from os.path import basename, dirname, exists, expanduser, isfile, join
 from time import sleep, time
 
 import click
 import packaging
-import requests
 from click import BadParameter
-from humanfriendly import InvalidTimespan, parse_size, parse_timespan
+from humanfriendly import parse_size
 from jinja2 import Template
+from requests.exceptions import RequestException
 
 from lain_cli import __version__
-from lain_cli.kibana import Kibana
 from lain_cli.lint import (
     suggest_cpu_limits,
     suggest_cpu_requests,
     suggest_memory_limits,
     suggest_memory_requests,
 )
-from lain_cli.prometheus import Alertmanager, Prometheus
-from lain_cli.prompt import (
-    bad_node_text,
-    build_app_status_command,
-    build_cluster_status_command,
-    display_app_status,
-    display_cluster_status,
-    global_ingress_text,
-    ingress_text,
-    pod_text,
-    top_text,
-)
-from lain_cli.scm import tell_scm
-from lain_cli.tencent import TencentPaaS
 from lain_cli.utils import (
     CHART_DIR_NAME,
     CHART_TEMPLATE_DIR,
     CHART_VERSION,
     CLUSTERS,
-    DEFAULT_BACKEND_RESPONSE,
     DOCKER_COMPOSE_FILE_PATH,
     ENV,
     HELM_STUCK_STATE,
     KUBECONFIG_DIR,
     RECENT_TAGS_COUNT,
-    ClusterConfigSchema,
+    TRACER,
     KVPairType,
+    LazyGroup,
+    ReadCache,
     banyun,
-    brief,
     called_by_sh,
     check_correct_override,
     click_parse_timespan,
@@ -71,12 +57,12 @@ from lain_cli.utils import (
     error,
     find,
     get_pod_rc,
-    get_pods,
     get_youngest_pod_ages,
     git,
     goodjob,
     helm,
     helm_delete,
+    helm_history,
     helm_status,
     init_done_toast,
     is_inside_cluster,
@@ -91,13 +77,13 @@ from lain_cli.utils import (
     lain_docs,
     lain_meta,
     make_canary_name,
-    make_external_url,
     make_image_str,
     make_job_name,
     open_kibana_url,
     parse_kubernetes_cpu,
     pick_pod,
     rc,
+    rollout_restart,
     stern,
     storage_class_can_reattach,
     tell_best_deploy,
@@ -112,12 +98,13 @@ from lain_cli.utils import (
     tell_image_tag,
     tell_job_timeout,
     tell_kibana_url,
-    tell_pod_deploy_name,
+    tell_kube_client,
+    tell_max_unavailable,
     tell_registry_client,
-    tell_paas_client,
     tell_release_image,
     tell_release_name,
     tell_secret,
+    tell_trace_name,
     template_env,
     template_update_toast,
     too_much_logs_headsup,
@@ -130,17 +117,22 @@ from lain_cli.utils import (
     user_challenge,
     validate_proc_name,
     version_challenge,
-    wait_for_cluster_up,
     wait_for_pod_up,
+    wait_for_rollout,
     wait_for_svc_up,
     warn,
     yadu,
     yalo,
 )
-from lain_cli.webhook import tell_webhook_client
 
 
-@click.group()
+@click.group(
+    cls=LazyGroup,
+    lazy_subcommands={
+        'admin': 'lain_cli.admin:admin',
+        'daemon': 'lain_cli.daemon:daemon',
+    },
+)
 @click.option('--silent', '-s', is_flag=True, help='log as little text as possible')
 @click.option('--verbose', '-v', is_flag=True)
 @click.option(
@@ -169,9 +161,27 @@ from lain_cli.webhook import tell_webhook_client
     is_flag=True,
     help='automatically does the best thing (if there is one).',
 )
+@click.option(
+    '--trace',
+    type=click.Path(dir_okay=False),
+    envvar='LAIN_TRACE',
+    help='write a timeline of all external commands and http requests to this file, view it in https://ui.perfetto.dev',
+)
 @click.pass_context
-def lain(ctx, silent, verbose, ignore_lint, remote_docker, values, use, auto_pilot):
+def lain(
+    ctx, silent, verbose, ignore_lint, remote_docker, values, use, auto_pilot, trace
+):
     """DevOps with minimal effort"""
+    if trace and not ctx.obj.get('nested'):
+        TRACER.start(trace)
+        name = tell_trace_name(['lain', ctx.invoked_subcommand or ''])
+        cmd = subprocess.list2cmdline(sys.argv[1:])
+        ctx.call_on_close(partial(TRACER.dump, name, cmd=cmd))
+
+    if 'read_cache' not in ctx.obj:
+        read_cache = ctx.obj['read_cache'] = ReadCache()
+        ctx.call_on_close(read_cache.report)
+
     ctx.obj['silent'] = silent
     ctx.obj['verbose'] = verbose
     ctx.obj['ignore_lint'] = ignore_lint
@@ -190,427 +200,6 @@ def lain(ctx, silent, verbose, ignore_lint, remote_docker, values, use, auto_pil
         pass
 
 
-@lain.group()
-def admin():
-    """admin functionalities, stay away"""
-
-
-@admin.command()
-@click.option(
-    '--dry-run',
-    is_flag=True,
-)
-@click.pass_context
-def delete_bad_ing(ctx, dry_run):
-    ctx.obj['silent'] = True
-    ing_list = ensure_str(
-        kubectl(
-            'get',
-            'ing',
-            '--no-headers',
-            r'-o=custom-columns=NAME:.metadata.name,HOST:..rules[*].host,PATHS:..rules[*]..path',
-            capture_output=True,
-        ).stdout
-    ).splitlines()
-
-    def delete_loose_ing(ing_name, dry_run=True):
-        son = kubectl(
-            'get',
-            'ing',
-            '-ojson',
-            ing_name,
-            capture_output=True,
-        ).stdout
-        ing = jalo(son)
-        annotations = ing['metadata'].get('annotations') or {}
-        helm_release = annotations.get('meta.helm.sh/release-name')
-        if helm_release:
-            warn(f'{ing_name} is not a loose ing, if you want to delete, use helm:')
-            echo(f' helm delete {helm_release}', clean=False)
-        else:
-            kubectl('delete', 'ing', ing_name, dry_run=dry_run)
-
-    for line in ing_list:
-        ing_name, host, paths = line.split()
-        url = next(make_external_url(host, paths=paths.split(',')))
-        try:
-            res = requests.get(url, timeout=2)
-        except requests.exceptions.RequestException as e:
-            debug(f'skip {ing_name} / {url} due to {brief(e)}')
-            continue
-        if res.status_code == 404 and res.text.strip() == DEFAULT_BACKEND_RESPONSE:
-            debug(f'ok to delete {ing_name} / {url}')
-            delete_loose_ing(ing_name, dry_run=dry_run)
-        if res.status_code == 503:
-            debug(f'want to delete {ing_name} / {url}')
-            delete_loose_ing(ing_name, dry_run=True)
-
-
-@admin.command()
-@click.option(
-    '--dry-run',
-    is_flag=True,
-)
-def delete_bad_pod(dry_run):
-    jobs = kubectl(
-        'get',
-        'job',
-        '--no-headers',
-        '-ojsonpath={..metadata.name}',
-        capture_output=True,
-    )
-    job_names = tuple(ensure_str(jobs.stdout).split())
-    _, pods = get_pods(show_only_bad_pods=True, check=True)
-
-    def is_job(pod_name):
-        for job_name in job_names:
-            if pod_name.startswith(job_name):
-                return job_name
-
-    seen = set()
-    for line in pods:
-        pod_name, _, state, *_ = line.split()
-        job_name = is_job(pod_name)
-        if job_name:
-            resource_type = 'job'
-            resource_name = job_name
-        else:
-            resource_type = 'pod'
-            resource_name = pod_name
-
-        this_ = (resource_type, resource_name)
-        if this_ in seen:
-            continue
-        seen.add(this_)
-        kubectl('delete', resource_type, resource_name, check=False, dry_run=dry_run)
-
-
-@admin.command()
-def cleanup_registry():
-    res = kubectl('get', 'po', '-ojsonpath={..image}', capture_output=True)
-    running_image_tags = frozenset(
-        [image.split(':', 1)[-1] for image in ensure_str(res.stdout).split()]
-    )
-    protected_tags = {'prepare', 'latest'}
-    registry = tell_registry_client()
-    repos = registry.list_repos()
-    for repo in repos:
-        if registry.is_protected_repo(repo):
-            continue
-        tags = set(registry.list_tags(repo))
-        recent_tags = frozenset(registry.sort_and_filter(tags)[:20])
-        ancient_tags = tags - recent_tags - protected_tags - running_image_tags
-        for tag in ancient_tags:
-            res = registry.delete_image(repo, tag)
-            debug(f'delete {repo}:{tag}, {res}')
-
-
-@admin.command()
-@click.pass_context
-def list_images(ctx):
-    ctx.obj['silent'] = True
-    registry = tell_registry_client()
-    images = registry.list_images()
-    for image in images:
-        echo(image)
-
-
-@admin.command()
-@click.pass_context
-def list_singletons(ctx):
-    ctx.obj['silent'] = True
-    res = kubectl(
-        'get',
-        'deploy',
-        '--no-headers',
-        r'-o=custom-columns=NAME:.metadata.name,HELM_RELEASE:.metadata.annotations.meta\.helm\.sh/release-name,REPLICAS:.spec.replicas',
-        capture_output=True,
-    )
-    ignore_words = ['consumer', 'worker', 'sentry', 'gitlab']
-    ignore_pattern = re.compile('|'.join(ignore_words))
-    for line in ensure_str(res.stdout).splitlines():
-        deploy_name, release_name, replicas = line.split()
-        if int(replicas) == 1:
-            if ignore_pattern.search(deploy_name):
-                continue
-            res = helm(
-                'get',
-                'values',
-                release_name,
-                '--output=json',
-                capture_output=True,
-            )
-            values_dic = jalo(res.stdout)
-            user = values_dic.get('user') if values_dic else None
-            echo(f'{deploy_name} from {release_name}, user: {user}')
-
-
-@admin.command()
-@click.option(
-    '--simple',
-    '-s',
-    is_flag=True,
-    help='print static status, rather than display in prompt app',
-)
-@click.pass_context
-def status(ctx, simple):
-    ctx.obj['silent'] = True
-    ctx.obj['simple'] = simple
-    ing_list = ensure_str(
-        kubectl(
-            'get',
-            'ing',
-            '--all-namespaces',
-            '--no-headers',
-            r'-o=custom-columns=HOST:..rules[*].host,PATHS:..rules[*]..path',
-            capture_output=True,
-        ).stdout
-    ).splitlines()
-    cc = tell_cluster_config()
-    ingress_external_port = cc.get('ingress_external_port', 80)
-    urls = []
-    for ing in ing_list:
-        host, paths = ing.split()
-        for url in make_external_url(
-            host, paths=paths.split(','), port=ingress_external_port
-        ):
-            urls.append(url)
-
-    ctx.obj['global_urls'] = set(urls)
-    if simple:
-        build_cluster_status_command()
-        res, pods = get_pods(headers=True, show_only_bad_pods=True)
-        report = ['\n'.join(pods) or ensure_str(res.stderr)]
-        report.extend(['bad nodes', bad_node_text()])
-        report.extend(['bad url requests', global_ingress_text()])
-        echo('\n'.join(report))
-        ctx.exit(0)
-
-    display_cluster_status()
-
-
-@admin.command()
-@click.argument('command', nargs=-1)
-@click.pass_context
-def x(ctx, command):
-    """run command on all containers (one for each deployment) within current
-    namespace.  only show output when command succeeds
-
-    \b
-    examples:
-    \b
-        lain admin x -- bash -c 'pip3 freeze | grep -i requests'
-    """
-    res = kubectl('get', 'po', '--no-headers', capture_output=True)
-    ctx.obj['silent'] = True
-    deploy_names = set()
-    for line in ensure_str(res.stdout).splitlines():
-        podname, *_ = line.split()
-        deploy_name = tell_pod_deploy_name(podname)
-        if deploy_name in deploy_names:
-            continue
-        deploy_names.add(deploy_name)
-        res = kubectl(
-            'exec',
-            '-it',
-            podname,
-            '--',
-            *command,
-            check=False,
-            timeout=None,
-            capture_output=True,
-        )
-        if rc(res):
-            stderr = ensure_str(res.stderr)
-            # abort execution in the case of network error
-            if 'unable to connect' in stderr.lower() or 'timeout' in stderr:
-                error(stderr, exit=1)
-            continue
-        echo(f'command succeeds for {podname}')
-        echo(res.stdout)
-
-
-@admin.command()
-@click.argument('instance_ids', nargs=-1)
-def stop_cvm(instance_ids):
-    client = TencentPaaS()
-    client.turn_(InstanceIds=instance_ids, state='off')
-
-
-@admin.command()
-@click.argument('instance_ids', nargs=-1)
-def start_cvm(instance_ids):
-    client = TencentPaaS()
-    client.turn_(InstanceIds=instance_ids)
-
-
-@admin.command()
-@click.argument('state', nargs=1, type=click.Choice(TencentPaaS.VM_STATES))
-@click.pass_context
-def turn(ctx, state):
-    """\b
-    turn off currently used cluster, to save money"""
-    current_state = wait_for_cluster_up()
-    if current_state != state:
-        cluster = ctx.obj['cluster']
-        client = TencentPaaS()
-        client.turn_(cluster=cluster, state=state)
-
-    if state == 'on':
-        final_state = wait_for_cluster_up(tries=120)
-        if final_state != 'on':
-            error(f'cluster {cluster} still not up')
-
-
-@admin.command()
-def list_waste():
-    deploy_list = ensure_str(
-        kubectl('get', 'deploy', '--no-headers', capture_output=True).stdout
-    ).splitlines()
-    helm_release_names = set(
-        ensure_str(helm('list', '--short', capture_output=True).stdout).split()
-    )
-    prometheus = Prometheus()
-    for line in deploy_list:
-        name, actual_desired, *_ = line.split()
-        desired = int(actual_desired.split('/')[-1])
-        if desired < 2:
-            continue
-        appname, proc_name = name.rsplit('-', 1)
-        if appname not in helm_release_names:
-            continue
-        cpu_top, _ = prometheus.cpu_p95(appname, proc_name)
-        if not cpu_top:
-            warn(f'skipping {appname} because cpu data is not available')
-            continue
-
-        error(f'{appname}-{proc_name} has {desired} pods, cpu P90: {cpu_top}')
-
-
-@admin.command()
-@click.option(
-    '--cluster-config',
-    'cc_path',
-    type=click.Path(),
-    required=True,
-    help='specify cluster config yaml',
-)
-@click.pass_context
-def migrate_registry(ctx, cc_path):
-    data = yalo(cc_path)
-    schema = ClusterConfigSchema(context={'is_current': True})
-    cc = schema.load(data)
-    registry_addr = cc['registry']
-    dest_registry = tell_registry_client(cc)
-    existing_images = dest_registry.list_images()
-
-    def tell_tag(image):
-        return image.split('/')[-1]
-
-    tags = set(tell_tag(s) for s in existing_images)
-    registry = tell_registry_client()
-    images = registry.list_images()
-    for image in images:
-        if tell_tag(image) in tags:
-            echo(f'skip {image}')
-            continue
-        banyun(
-            image,
-            pull=True,
-            registry=registry_addr,
-        )
-
-
-@admin.command()
-@click.option(
-    '--count-below',
-    default=1,
-    help='list ingress that has been requested fewer than this amount',
-)
-@click.option('--period', default='7d', help='query timespan')
-@click.pass_context
-def list_unused_ingress(ctx, count_below, period):
-    ctx.obj['silent'] = True
-    WEEK = parse_timespan('7d')
-    ing_list = ensure_str(
-        kubectl(
-            'get',
-            'ing',
-            '--no-headers',
-            r'-o=custom-columns=NAME:.metadata.name,HOST:..rules[*].host,CLASS:..annotations.kubernetes\.io/ingress\.class',
-            capture_output=True,
-        ).stdout
-    ).splitlines()
-    kibana = Kibana()
-    svcs = set()
-    for line in ing_list:
-        ing_name, host, ingress_class = line.split()
-        if host.endswith('.lain'):
-            continue
-        query_count = kibana.count_records_for_host(
-            host, ingress_class=ingress_class, period=period
-        )
-        if query_count < count_below:
-            stdout = ensure_str(
-                kubectl(
-                    'get',
-                    'ing',
-                    ing_name,
-                    '-ocustom-columns=FOO:..serviceName,BAR:..service.name',
-                    '--no-headers',
-                    capture_output=True,
-                ).stdout
-            )
-            svc_name = [s for s in stdout.split() if s != '<none>'][0]
-            if svc_name in svcs:
-                debug(f'svc already seen, skip: {svc_name}')
-                continue
-            svc_res = kubectl(
-                'get', 'svc', svc_name, '-ojson', capture_output=True, check=False
-            )
-            if rc(svc_res):
-                stderr = ensure_str(svc_res.stderr)
-                if 'not found' in stderr:
-                    debug(f'{ing_name} had bad svc: {svc_name}')
-                    echo(f'k delete ing {ing_name}')
-                    continue
-                error(f'weird error during getting svc: {stderr}', exit=1)
-            else:
-                svcs.add(svc_name)
-
-            svc = ensure_str(svc_res.stdout)
-            svc_dic = jalo(svc)
-            selectors = ','.join(
-                [f'{k}={v}' for k, v in svc_dic['spec']['selector'].items()]
-            )
-            pods = ensure_str(
-                kubectl(
-                    'get', 'po', '--no-headers', '-l', selectors, capture_output=True
-                ).stdout
-            ).replace('\n', '')
-            try:
-                age = parse_timespan(pods.rsplit(' ', 1)[-1])
-                if age < WEEK:
-                    debug(f'{ing_name} has young pods, skip')
-                    continue
-            except InvalidTimespan:
-                pass
-            if not pods:
-                debug(f'{ing_name} has no pods')
-                echo(f'k delete ing {ing_name}')
-                continue
-
-            pod_name = pods.split(None, 1)[0]
-            period_s = int(parse_timespan(period))
-            log_res = kubectl(
-                'logs', f'--since={period_s}s', pod_name, capture_output=True
-            )
-            if log_res.stdout:
-                debug(f'pod {pod_name} is still printing logs, skip')
-                continue
-            echo(f'{host}\t{query_count}\t{pods}')
-
-
 @lain.command()
 @click.option(
     '--simple',
@@ -719,6 +308,8 @@ def wait_mr_approval(project, mr_id):
     \b
         lain wait-mr-approval $CI_PROJECT_PATH $CI_MERGE_REQUEST_IID
     """
+    from lain_cli.scm import tell_scm
+
     scm = tell_scm()
     while True:
         approved = scm.is_approved(project, mr_id)
@@ -739,6 +330,8 @@ def assign_mr(project, mr_id):
     \b
         lain assign-mr $CI_PROJECT_PATH $CI_MERGE_REQUEST_IID
     """
+    from lain_cli.scm import tell_scm
+
     scm = tell_scm()
     scm.assign_mr(project, mr_id)
 
@@ -829,6 +422,14 @@ def init(ctx, appname, force, template_only, commit):
 def status(ctx, simple):
     """view app status"""
     # we don't want stderr outputs to mess with our full screen application
+    from lain_cli.prompt import (
+        build_app_status_command,
+        display_app_status,
+        ingress_text,
+        pod_text,
+        top_text,
+    )
+
     ctx.obj['silent'] = True
     if simple:
         grafana_url = tell_grafana_url()
@@ -905,25 +506,35 @@ def logs(ctx, proc, tail, use_stern, use_kibana):
         return open_kibana_url(release_name=release_name, proc=proc)
     if use_stern:
         stern(f'--selector={selector}', f'--tail={tail}', check=False)
-    else:
-        res = kubectl(
-            'logs',
-            '-f',
-            f'--tail={tail}',
-            '--max-log-requests=70',
-            '-l',
-            selector,
-            timeout=None,
-            capture_error=True,
-            check=False,
-        )
-        if rc(res):
-            stderr = ensure_str(res.stderr)
-            if '(BadRequest)' in stderr:
-                error(f'weird container status: {stderr}')
-                error('try lain status instead')
-            else:
-                too_much_logs_headsup()
+        return
+    client = tell_kube_client()
+    if client:
+        from lain_cli.kube import KubeApiError, KubeUnsupported
+        from lain_cli.logs import LogMultiplexer
+
+        try:
+            return LogMultiplexer(client, selector, tail=tail).run()
+        except (KubeApiError, KubeUnsupported, RequestException) as e:
+            debug(f'cannot follow logs using api client, fallback to kubectl: {e}')
+
+    res = kubectl(
+        'logs',
+        '-f',
+        f'--tail={tail}',
+        '--max-log-requests=70',
+        '-l',
+        selector,
+        timeout=None,
+        capture_error=True,
+        check=False,
+    )
+    if rc(res):
+        stderr = ensure_str(res.stderr)
+        if '(BadRequest)' in stderr:
+            error(f'weird container status: {stderr}')
+            error('try lain status instead')
+        else:
+            too_much_logs_headsup()
 
 
 @lain.command()
@@ -1274,10 +885,22 @@ def use(ctx, cluster, set_context, turn):
 @click.option(
     '--graceful',
     is_flag=True,
-    help='delete pod one by one, and wait for green light between every operation, implies --wait',
+    help='recycle pods a few at a time (see --max-unavailable), waiting for replacements to get ready, implies --wait',
+)
+@click.option(
+    '--max-unavailable',
+    default='1',
+    help='for --graceful, how many pods (e.g. 2), or what percentage of pods (e.g. 25%) can be recycling at the same time',
+)
+@click.option(
+    '--rollout',
+    is_flag=True,
+    help='like kubectl rollout restart, let the deployment / statefulset controllers restart pods according to their own update strategy, implies --wait',
 )
 @click.pass_context
-def restart(ctx, procs_or_release_name, selectors, wait, graceful):
+def restart(
+    ctx, procs_or_release_name, selectors, wait, graceful, max_unavailable, rollout
+):
     """restart your app using kubectl delete po.
 
     \b
@@ -1285,6 +908,10 @@ def restart(ctx, procs_or_release_name, selectors, wait, graceful):
     \b
         # delete all pods, as gracefully as possible
         lain restart --graceful
+        # recycle a quarter of the pods at a time
+        lain restart --graceful --max-unavailable 25%
+        # let kubernetes do a rolling restart
+        lain restart --rollout
         # delete pods for some procs
         lain restart web worker
         # delete pods of some-other-app, note that name must not collide with proc names
@@ -1294,6 +921,13 @@ def restart(ctx, procs_or_release_name, selectors, wait, graceful):
         raise BadParameter(
             'cannot use --selector when PROCS_OR_RELEASE_NAME is provided'
         )
+    try:
+        tell_max_unavailable(max_unavailable, 1)
+    except ValueError as e:
+        raise BadParameter(
+            f'expected a count or percentage, got {max_unavailable}',
+            param_hint='--max-unavailable',
+        ) from e
     release_name = tell_release_name()
     procs = procs_or_release_name  # by default, procs_or_release_name are interpreted as proc names
     if not release_name:
@@ -1316,6 +950,11 @@ def restart(ctx, procs_or_release_name, selectors, wait, graceful):
         else:
             selectors = [f'helm.sh/chart={release_name}']
 
+    if rollout:
+        for selector in selectors:
+            rollout_restart(selector)
+
+        return
     if ctx.obj.get('auto_pilot'):
         graceful = True
 
@@ -1323,7 +962,7 @@ def restart(ctx, procs_or_release_name, selectors, wait, graceful):
         wait = True
 
     for selector in selectors:
-        delete_pod(selector, graceful=graceful)
+        delete_pod(selector, graceful=graceful, max_unavailable=max_unavailable)
 
     if wait:
         for selector in selectors:
@@ -1385,6 +1024,8 @@ def send_msg(msg):
     if not msg:
         echo('skip due to empty message', exit=0)
 
+    from lain_cli.webhook import tell_webhook_client
+
     webhook = tell_webhook_client()
     webhook and webhook.send_msg(msg)
 
@@ -1416,8 +1057,7 @@ def template(ctx, pairs, debug):
 def rollback(ctx):
     """rollback to previous non-pending state revision."""
     appname = ctx.obj['appname']
-    res = helm('history', appname, '-ojson', capture_output=True)
-    history = jalo(res.stdout)
+    history = helm_history(appname)
     current = history.pop(-1)
     if 'rollback' in current['description'].lower():
         error(
@@ -1432,6 +1072,8 @@ def rollback(ctx):
         error(f'cannot find a non pending state revision in history: {history}', exit=1)
 
     res = helm('rollback', appname, str(revision), check=False)
+    from lain_cli.webhook import tell_webhook_client
+
     webhook = tell_webhook_client()
     tell_release_image(appname, revision)
     if code := rc(res):
@@ -1448,84 +1090,6 @@ def rollback(ctx):
         lain_('status')
 
 
-@admin.command()
-@click.argument('resource')
-@click.option(
-    '--annotations',
-    required=True,
-    multiple=True,
-    type=KVPairType(),
-    help='query by annotations',
-)
-@click.pass_context
-def get(ctx, resource, annotations):
-    """Like kubectl get, but support filtering by annotations.
-
-    \b
-    examples:
-    \b
-        lain admin get pod --annotations prometheus.io/scrape=true
-    """
-    ctx.obj['silent'] = True
-    items = kubectl(
-        'get',
-        '--all-namespaces',
-        resource,
-        '-o=custom-columns=NS:.metadata.namespace,NAME:.metadata.name,:.metadata.annotations',
-        '--no-headers',
-        check=True,
-        capture_output=True,
-    )
-
-    def parse_annotations(s):
-        bracketed = s.strip().removeprefix('map').strip('[]')
-        if bracketed == '<none>':
-            return
-        pairs = bracketed.split()
-        dic = dict([pair.split(':', 1) for pair in pairs])
-        return dic
-
-    for line in ensure_str(items.stdout).splitlines():
-        try:
-            _, _, annotations_part = line.split(None, 2)
-        except ValueError:
-            continue
-        annotations_dic = parse_annotations(annotations_part)
-        if not annotations_dic:
-            continue
-        for k, v in annotations:
-            if annotations_dic.get(k) == v:
-                echo(line)
-            else:
-                debug(line)
-
-
-@admin.command()
-@click.option(
-    '--labels',
-    'labels',
-    multiple=True,
-    type=KVPairType(),
-    help='custom labels',
-)
-@click.pass_context
-def post_alerts(ctx, labels):
-    am = Alertmanager()
-    am.post_alerts(labels)
-
-
-@admin.command()
-@click.argument('secret_name', nargs=1)
-@click.pass_context
-def upload_paas_tls_certificate(ctx, secret_name):
-    secret_dic = tell_secret(secret_name)
-    data = secret_dic['data']
-    crt = data['tls.crt']
-    key = data['tls.key']
-    paas = tell_paas_client()
-    paas.upload_tls_certificate(crt, key)
-
-
 @lain.command()
 @click.pass_context
 def cherry(ctx):
@@ -1686,6 +1250,8 @@ def deploy(ctx, pairs, delete_after, build, canary, wait):
         capture_output=True,
         check=False,
     )
+    from lain_cli.webhook import tell_webhook_client
+
     webhook = tell_webhook_client()
     if code := rc(res):
         stderr = ensure_str(res.stderr)
@@ -1779,6 +1345,8 @@ def set_canary_group(ctx, canary_group_name, abort, final):
         wait_for_pod_up(selector)
         update_canary_annotations(canary_name)
         delete_res = helm('delete', canary_name)
+        from lain_cli.webhook import tell_webhook_client
+
         webhook = tell_webhook_client()
         webhook and webhook.send_deploy_message()
         ctx.exit(rc(delete_res))
@@ -1803,11 +1371,11 @@ def set_canary_group(ctx, canary_group_name, abort, final):
 @click.option(
     '--tries',
     default=40,
-    help='tries before giving up (will sleep 3s after each try).',
+    help='tries before giving up, each try takes 3s.',
 )
 @click.pass_context
 def wait(ctx, appname, selectors, tries):
-    """wait until pods are up and running.
+    """wait until deployments / statefulsets / jobs have rolled out, and pods are up and running.
 
     this command is designed to run in helm tests, if used inside a pod, it will wait for services as well."""
     if appname:
@@ -1823,7 +1391,16 @@ def wait(ctx, appname, selectors, tries):
         appname = ctx.obj['appname']
         selector = f'app.kubernetes.io/name={appname}'
 
-    wait_for_pod_up(selector, tries=tries)
+    workloads = None
+    if not selectors:
+        # workloads carry the chart labels, selectors are for pods
+        workloads = wait_for_rollout(selector, tries=tries)
+        if workloads is None:
+            error('rollout not finished, check `lain status` for clues', exit=1)
+
+    if not workloads:
+        wait_for_pod_up(selector, tries=tries)
+
     if is_inside_cluster():
         up = wait_for_svc_up(tries=tries)
         if not up:
@@ -2208,6 +1785,8 @@ def addfile(ctx, f, overwrite):
 
     new = deepcopy(env_dic)
     res = kubectl_apply(env_dic, tee=True)
+    from lain_cli.webhook import tell_webhook_client
+
     webhook = tell_webhook_client()
     webhook and webhook.diff_k8s_secret(old, new)
     auto_pilot = ctx.obj.get('auto_pilot')
@@ -2238,6 +1817,8 @@ def add(ctx, pairs):
 
     new = deepcopy(env_dic)
     res = kubectl_apply(env_dic, capture_output=True, tee=True)
+    from lain_cli.webhook import tell_webhook_client
+
     webhook = tell_webhook_client()
     webhook and webhook.diff_k8s_secret(old, new)
     auto_pilot = ctx.obj.get('auto_pilot')
@@ -2307,6 +1888,8 @@ def add(ctx, files):
 
     new = deepcopy(secret_dic)
     res = kubectl_apply(secret_dic, tee=True)
+    from lain_cli.webhook import tell_webhook_client
+
     webhook = tell_webhook_client()
     webhook and webhook.diff_k8s_secret(old, new)
     auto_pilot = ctx.obj.get('auto_pilot')
@@ -0,0 +1,225 @@
+"""follow logs of every pod matching a selector (every container, for
+multi-container pods), merged into one stream, like stern does, but without
+stern, or the --max-log-requests limit of kubectl logs.
+
+every log stream is read by its own thread, through the pooled KubeClient.
+lines go through a bounded queue, so a slow terminal makes the streams wait,
+rather than piling lines up in memory. a pod watch follows new pods as they
+appear, streams of deleted pods simply end with their containers.
+"""
+import heapq
+import queue
+import threading
+from contextlib import suppress
+from itertools import count, cycle
+from time import perf_counter
+
+import click
+from requests.exceptions import RequestException
+
+from lain_cli.kube import KubeApiError
+from lain_cli.utils import debug, warn
+
+COLORS = (
+    'cyan',
+    'green',
+    'yellow',
+    'magenta',
+    'blue',
+    'bright_cyan',
+    'bright_green',
+    'bright_yellow',
+    'bright_magenta',
+    'bright_blue',
+)
+# lines are held back for this long, so that lines from different streams
+# can be printed in timestamp order
+REORDER_SECONDS = 0.3
+QUEUE_SIZE = 1000
+WATCH_RETRY_SECONDS = 5
+
+
+def split_timestamp(line):
+    """
+    >>> split_timestamp('2021-06-01T08:00:00.5Z hello world')
+    ('2021-06-01T08:00:00.5Z', 'hello world')
+    """
+    timestamp, _, text = line.partition(' ')
+    return timestamp, text
+
+
+def tell_sort_key(timestamp):
+    """RFC3339Nano drops trailing zeros, pad them back so that timestamps
+    compare as strings
+
+    >>> tell_sort_key('2021-06-01T08:00:00Z') < tell_sort_key('2021-06-01T08:00:00.5Z')
+    True
+    >>> tell_sort_key('2021-06-01T08:00:00.12345Z') > tell_sort_key('2021-06-01T08:00:00.1234Z')
+    True
+    """
+    head, _, fraction = timestamp.rstrip('Z').partition('.')
+    return f'{head}.{fraction:0<9}'
+
+
+def tell_started_containers(pod):
+    """{container name: restart count}, for containers that have logs"""
+    containers = {}
+    for cs in (pod.get('status') or {}).get('containerStatuses') or []:
+        state = cs.get('state') or {}
+        if 'running' in state or 'terminated' in state:
+            containers[cs['name']] = cs.get('restartCount', 0)
+
+    return containers
+
+
+class LogMultiplexer:
+    def __init__(self, client, selector, tail=200):
+        self.client = client
+        self.selector = selector
+        self.tail = tail
+        self.events = queue.Queue(maxsize=QUEUE_SIZE)
+        # (pod name, container name): (pod uid, restart count) of the followed
+        # container, statefulset pods come back with the same name
+        self.streams = {}
+        self.prefixes = {}
+        self.colors = cycle(COLORS)
+        self.seq = count()
+        self.pending = []
+        self.stopped = threading.Event()
+
+    def run(self):
+        """follow logs until stop is called, or interrupted"""
+        responson = self.client.read('pod', selector=self.selector)
+        for pod in responson['items']:
+            self.follow(pod, tail=self.tail)
+
+        resource_version = responson['metadata'].get('resourceVersion')
+        self.start_thread(self.watch, resource_version)
+        try:
+            while not self.stopped.is_set():
+                self.flush()
+                try:
+                    event = self.events.get(
+                        timeout=REORDER_SECONDS if self.pending else None
+                    )
+                except queue.Empty:
+                    continue
+                self.handle(*event)
+        finally:
+            self.stopped.set()
+            self.flush(everything=True)
+
+    def stop(self):
+        self.stopped.set()
+        # wake up run, which checks stopped anyway if the queue is full
+        with suppress(queue.Full):
+            self.events.put_nowait(('stop', None, None))
+
+    def start_thread(self, target, *args):
+        threading.Thread(target=target, args=args, daemon=True).start()
+
+    def handle(self, kind, key, payload):
+        if kind == 'line':
+            timestamp, text = payload
+            sort_key = tell_sort_key(timestamp)
+            entry = (sort_key, next(self.seq), perf_counter(), key, text)
+            heapq.heappush(self.pending, entry)
+        elif kind == 'pod':
+            event_type, pod = payload
+            if event_type in {'ADDED', 'MODIFIED'}:
+                self.follow(pod)
+            elif event_type == 'DELETED':
+                self.forget(pod)
+        elif kind == 'error':
+            debug(f'log stream of {self.prefixes.get(key, key)} ended: {payload}')
+        elif kind == 'watch expired':
+            debug(f'pod watch expired, list pods again: {payload}')
+        elif kind == 'watch error':
+            warn(f'cannot watch pods, will retry: {payload}')
+
+    def flush(self, everything=False):
+        """print lines that have waited long enough, oldest timestamp first"""
+        deadline = perf_counter() - REORDER_SECONDS
+        while self.pending and (everything or self.pending[0][2] <= deadline):
+            _, _, _, key, text = heapq.heappop(self.pending)
+            click.echo(f'{self.prefixes[key]} {text}')
+
+    def follow(self, pod, tail=None):
+        """open streams for containers not followed yet, containers that
+        restarted are followed from the start of the new instance"""
+        pod_name = pod['metadata']['name']
+        uid = pod['metadata'].get('uid')
+        containers = tell_started_containers(pod)
+        if not containers:
+            return
+        color = None
+        for container, restarts in containers.items():
+            key = (pod_name, container)
+            if self.streams.get(key) == (uid, restarts):
+                continue
+            if key not in self.prefixes:
+                color = color or next(self.colors)
+                prefix = pod_name
+                if len(pod['spec']['containers']) > 1:
+                    prefix = f'{pod_name} {container}'
+
+                self.prefixes[key] = click.style(prefix, fg=color)
+
+            self.streams[key] = (uid, restarts)
+            self.start_thread(self.read_stream, key, tail)
+
+    def forget(self, pod):
+        """a pod recreated under the same name is followed from scratch"""
+        pod_name = pod['metadata']['name']
+        for key in [k for k in self.streams if k[0] == pod_name]:
+            del self.streams[key]
+
+    def read_stream(self, key, tail):
+        pod_name, container = key
+        try:
+            res = self.client.open_logs(pod_name, container=container, tail_lines=tail)
+            with res:
+                for line in res.iter_lines():
+                    if self.stopped.is_set():
+                        return
+                    text = line.decode('utf-8', errors='replace')
+                    # blocks when the terminal cannot keep up
+                    self.events.put(('line', key, split_timestamp(text)))
+        except (KubeApiError, RequestException) as e:
+            self.events.put(('error', key, e))
+
+    def watch(self, resource_version):
+        """follow pod events until stopped. the api server ends watches every
+        now and then, and once resource_version is too old (410 Gone), pods
+        are listed again, so that pods created in between are followed"""
+        warned = False
+        while not self.stopped.is_set():
+            try:
+                if not resource_version:
+                    responson = self.client.read('pod', selector=self.selector)
+                    for pod in responson['items']:
+                        self.events.put(('pod', None, ('ADDED', pod)))
+
+                    resource_version = responson['metadata'].get('resourceVersion')
+                for event_type, pod in self.client.watch(
+                    'pod',
+                    selector=self.selector,
+                    resource_version=resource_version,
+                    bookmarks=True,
+                ):
+                    if self.stopped.is_set():
+                        return
+                    resource_version = pod['metadata'].get(
+                        'resourceVersion', resource_version
+                    )
+                    if event_type != 'BOOKMARK':
+                        self.events.put(('pod', None, (event_type, pod)))
+            except (KubeApiError, RequestException) as e:
+                resource_version = None
+                if isinstance(e, KubeApiError) and e.status_code == 410:
+                    self.events.put(('watch expired', None, e))
+                    continue
+                if not warned:
+                    warned = True
+                    self.events.put(('watch error', None, e))
+                self.stopped.wait(WATCH_RETRY_SECONDS)
@@ -17,14 +17,14 @@ from prompt_toolkit.layout.layout import Layout
 
 from lain_cli.utils import (
     DEFAULT_BACKEND_RESPONSE,
+    KubeReadError,
     context,
     ensure_str,
+    format_pod_table,
+    get_pod_records,
     get_pods,
     kubectl,
     parse_kubernetes_cpu,
-    parse_multi_timespan,
-    parse_podline,
-    parse_ready,
     rc,
     tell_pod_deploy_name,
     tell_pods_count,
@@ -62,25 +62,20 @@ async def refresh_podinfo_text():
         CONTENT_VENDERER['podinfo_text'] = DEFAULT_POD_TEXT
         return
     cmd = []
-    for podline in pods[1:]:
-        pod_name, ready_str, status, restarts, age, *_ = parse_podline(podline)
+    for record in pods:
+        pod_name, status = record.name, record.status
         if status == 'Completed':
             continue
-        age = parse_multi_timespan(age)
         event_cmd = [
             'get',
             'events',
             f'--field-selector=involvedObject.name={pod_name}',
         ]
         log_cmd = ['logs', '--tail=50', f'{pod_name}']
-        if status in {'Pending', 'ContainerCreating'} and age > 30:
+        if status in {'Pending', 'ContainerCreating'} and record.age > 30:
             cmd = event_cmd
             break
-        if (
-            status == 'CrashLoopBackOff'
-            or not parse_ready(ready_str)
-            or int(restarts) > 0
-        ):
+        if status == 'CrashLoopBackOff' or not record.is_ready or record.restarts > 0:
             if pod_name in POD_WITH_GOOD_EVENTS:
                 cmd = log_cmd
             elif pod_name in POD_WITH_EMPTY_LOG:
@@ -144,13 +139,16 @@ def pod_text(too_many_pods=None):
     if too_many_pods is None:
         too_many_pods = ctx.obj['too_many_pods']
 
-    res, pods = get_pods(
-        appname=appname, headers=True, show_only_bad_pods=too_many_pods
-    )
-    if rc(res):
-        return ensure_str(res.stderr)
+    selector = f'app.kubernetes.io/name={appname}'
+    try:
+        pods = get_pod_records(selector, refresh=True)
+    except KubeReadError as e:
+        return str(e)
+    if too_many_pods:
+        pods = get_pods(selector=selector, show_only_bad_pods=True)
+
     CONTENT_VENDERER['pods'] = pods
-    report = '\n'.join(pods)
+    report = '\n'.join(format_pod_table(pods))
     return report
 
 
@@ -368,6 +366,8 @@ def build_app_status():
 
 
 def display_app_status():
+    # refreshes forever, reads must not be served from cache
+    context().obj.pop('read_cache', None)
     prompt_app = build_app_status()
     prompt_app.run()
 
@@ -383,9 +383,17 @@ def build_cluster_status_command():
     ctx.obj['watch_bad_pod_title'] = f'k {list2cmdline(pod_cmd)}'
 
 
+def bad_pod_text():
+    try:
+        get_pod_records(refresh=True)
+    except KubeReadError as e:
+        return str(e)
+    pods = get_pods(show_only_bad_pods=True)
+    return '\n'.join(format_pod_table(pods))
+
+
 async def refresh_bad_pod_text():
-    res, pods = get_pods(headers=True, show_only_bad_pods=True)
-    set_content('pod_text', '\n'.join(pods) or ensure_str(res.stderr))
+    set_content('pod_text', bad_pod_text())
 
 
 def bad_node_text():
@@ -539,5 +547,7 @@ def build_cluster_status():
 
 
 def display_cluster_status():
+    # refreshes forever, reads must not be served from cache
+    context().obj.pop('read_cache', None)
     prompt_app = build_cluster_status()
     prompt_app.run()
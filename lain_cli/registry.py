@@ -1,13 +1,62 @@
+import threading
+from collections import defaultdict
+from datetime import datetime, timezone
 from json.decoder import JSONDecodeError
+from operator import itemgetter
+from os.path import exists
+from time import time
+from urllib.parse import parse_qsl, urlsplit
 
 import requests
-from tenacity import retry, stop_after_attempt, wait_fixed
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_fixed
 
-from lain_cli.utils import PaaSUtils, RequestClientMixin, tell_cluster_config
+from lain_cli.utils import (
+    PaaSUtils,
+    RequestClientMixin,
+    debug,
+    echo,
+    iter_parallel,
+    tell_cluster_config,
+    warn,
+)
+
+# HEAD must accept every manifest type, or the registry may answer with the
+# digest of a converted manifest
+MANIFEST_TYPES = ', '.join(
+    [
+        'application/vnd.docker.distribution.manifest.v2+json',
+        'application/vnd.docker.distribution.manifest.list.v2+json',
+        'application/vnd.oci.image.manifest.v1+json',
+        'application/vnd.oci.image.index.v1+json',
+    ]
+)
+# docker hub tokens, {(username, scope): (token, expires at)}, shared by all
+# Registry instances, so that a token is fetched once per repo, rather than
+# once per list_tags call
+DOCKERHUB_TOKENS = {}
+DOCKERHUB_TOKENS_LOCK = threading.Lock()
+
+
+class RegistryError(ValueError):
+    def __init__(self, message, status_code=None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def is_transient_error(e):
+    """network errors, and registry errors that may go away on retry,
+    other 4xx (e.g. 405 when deletion is disabled) are permanent"""
+    if isinstance(e, RegistryError):
+        return e.status_code == 429 or (e.status_code or 0) >= 500
+    return isinstance(e, requests.RequestException)
 
 
 class Registry(RequestClientMixin, PaaSUtils):
     headers = {'Accept': 'application/vnd.docker.distribution.manifest.v2+json'}
+    rate_limiter = None
+    # items per page when listing repos and tags, registries may cap this
+    # anyway, pages are followed through the Link header
+    page_size = 1000
 
     def __init__(self, registry=None, **kwargs):
         if not registry:
@@ -29,10 +78,24 @@ class Registry(RequestClientMixin, PaaSUtils):
 
         self.dockerhub_password = kwargs.get('dockerhub_password')
         self.dockerhub_username = kwargs.get('dockerhub_username')
+        self.page_size = kwargs.get('registry_page_size') or self.page_size
 
     def prepare_token(self, scope):
+        """headers carrying the docker hub bearer token for scope, tokens
+        are cached until they expire"""
         if not all([self.dockerhub_password, self.dockerhub_username]):
-            return
+            return self.headers
+        key = (self.dockerhub_username, scope)
+        with DOCKERHUB_TOKENS_LOCK:
+            access_token, expires_at = DOCKERHUB_TOKENS.get(key, (None, 0))
+            if expires_at <= time():
+                access_token, expires_at = self.fetch_token(scope)
+                DOCKERHUB_TOKENS[key] = (access_token, expires_at)
+
+        return {**self.headers, 'Authorization': f'Bearer {access_token}'}
+
+    def fetch_token(self, scope):
+        started_at = time()
         res = requests.post(
             'https://auth.docker.io/token',
             data={
@@ -44,43 +107,190 @@ class Registry(RequestClientMixin, PaaSUtils):
                 'password': self.dockerhub_password,
             },
         )
-        access_token = res.json()['access_token']
-        self.headers['Authorization'] = f'Bearer {access_token}'
+        responson = res.json()
+        # leave some room, so that a token won't expire between pages
+        expires_in = responson.get('expires_in', 300) - 30
+        return responson['access_token'], started_at + expires_in
 
     def request(self, *args, **kwargs):
+        if self.rate_limiter:
+            self.rate_limiter.wait()
         res = super().request(*args, **kwargs)
+        if not res.content:
+            # HEAD, and DELETE responses come without body
+            if res.status_code >= 400:
+                raise RegistryError(
+                    f'registry error: {res.status_code} {res.reason}',
+                    status_code=res.status_code,
+                )
+            return res
         try:
             responson = res.json()
         except JSONDecodeError as e:
-            raise ValueError(f'bad registry response: {res.text}') from e
+            raise RegistryError(
+                f'bad registry response: {res.text}', status_code=res.status_code
+            ) from e
         if not isinstance(responson, dict):
             return res
         errors = responson.get('errors')
         if errors:
-            raise ValueError(f'registry error: headers {res.headers}, errors {errors}')
+            raise RegistryError(
+                f'registry error: headers {res.headers}, errors {errors}',
+                status_code=res.status_code,
+            )
         return res
 
-    def list_repos(self):
-        path = '/v2/_catalog'
-        responson = self.get(path, params={'n': 9999}, timeout=90).json()
-        return responson.get('repositories', [])
+    def iter_pages(self, path, key, page_size=None, **kwargs):
+        """yield items under key of every page, following the Link header"""
+        params = {'n': page_size or self.page_size}
+        while True:
+            res = self.get(path, params=params, **kwargs)
+            yield from res.json().get(key) or []
+            next_url = res.links.get('next', {}).get('url')
+            if not next_url:
+                return
+            # Link is usually relative, but may carry a host as well
+            parts = urlsplit(next_url)
+            path, params = parts.path, dict(parse_qsl(parts.query))
 
-    @retry(reraise=True, wait=wait_fixed(2), stop=stop_after_attempt(6))
-    def delete_image(self, repo, tag=None):
-        path = f'/v2/{repo}/manifests/{tag}'
-        headers = self.head(path).headers
-        docker_content_digest = headers.get('Docker-Content-Digest')
-        if not docker_content_digest:
-            return
-        path = f'/v2/{repo}/manifests/{docker_content_digest}'
-        return self.delete(path, timeout=20)  # 不知道为啥删除操作就是很慢, 只好在这里单独放宽
+    def list_repos(self, page_size=None, timeout=90):
+        return self.iter_pages(
+            '/v2/_catalog', 'repositories', page_size=page_size, timeout=timeout
+        )
 
     def list_tags(self, repo_name, n=None, timeout=90):
         repo = f'{self.namespace}/{repo_name}' if self.namespace else repo_name
-        path = f'/v2/{repo}/tags/list'
-        self.prepare_token(scope=f'repository:{repo}:pull,push')
-        responson = self.get(path, params={'n': 99999}, timeout=timeout).json()
-        if 'tags' not in responson:
+        return self.sort_and_filter(self.iter_tags(repo, timeout=timeout), n=n)
+
+    def iter_tags(self, repo, page_size=None, timeout=90):
+        """every tag of repo (as listed in the catalog), unsorted and
+        unfiltered"""
+        headers = self.prepare_token(scope=f'repository:{repo}:pull,push')
+        return self.iter_pages(
+            f'/v2/{repo}/tags/list',
+            'tags',
+            page_size=page_size,
+            headers=headers,
+            timeout=timeout,
+        )
+
+    def tell_digest(self, repo, tag):
+        path = f'/v2/{repo}/manifests/{tag}'
+        headers = {**self.headers, 'Accept': MANIFEST_TYPES}
+        return self.head(path, headers=headers).headers.get('Docker-Content-Digest')
+
+    @retry(
+        reraise=True,
+        retry=retry_if_exception(is_transient_error),
+        wait=wait_fixed(2),
+        stop=stop_after_attempt(6),
+    )
+    def delete_manifest(self, repo, digest):
+        """returns False if the manifest is already gone"""
+        path = f'/v2/{repo}/manifests/{digest}'
+        try:
+            # 不知道为啥删除操作就是很慢, 只好在这里单独放宽
+            self.delete(path, timeout=20)
+        except RegistryError as e:
+            if e.status_code == 404:
+                return False
+            raise
+        return True
+
+
+def build_cleanup_plan(registry, keep_tags=frozenset(), keep_recent=20, max_workers=8):
+    """phase one of admin cleanup-registry: list every repo, and decide what
+    to delete. every tag is resolved to its manifest digest, tags that share
+    a digest are deleted together, and digests also referred to by a kept
+    tag are left alone, because deleting a manifest deletes all its tags"""
+
+    def plan_repo(repo):
+        tags = set(registry.iter_tags(repo))
+        # prepare images are never deleted
+        candidates = {t for t in tags if not t.startswith('prepare')}
+        recent = set(registry.sort_and_filter(candidates, n=keep_recent))
+        doomed = candidates - recent - keep_tags - {'latest'}
+        if not doomed:
             return []
-        tags = self.sort_and_filter(responson.get('tags') or [], n=n)
-        return tags
+        digests = {}
+        for tag in sorted(tags):
+            try:
+                digests[tag] = registry.tell_digest(repo, tag)
+            except RegistryError as e:
+                if e.status_code != 404:
+                    raise
+                debug(f'{repo}:{tag} is already gone')
+
+        kept_digests = {digests.get(t) for t in tags - doomed}
+        manifests = defaultdict(list)
+        for tag in sorted(doomed):
+            digest = digests.get(tag)
+            if not digest:
+                continue
+            if digest in kept_digests:
+                debug(f'{repo}:{tag} shares its manifest with a kept tag, skip')
+                continue
+            manifests[digest].append(tag)
+
+        return [
+            {'repo': repo, 'digest': digest, 'tags': doomed_tags}
+            for digest, doomed_tags in sorted(manifests.items())
+        ]
+
+    repos = [r for r in registry.list_repos() if not registry.is_protected_repo(r)]
+    manifests = []
+    for repo, future in iter_parallel(plan_repo, repos, max_workers=max_workers):
+        repo_manifests = future.result()
+        debug(f'{repo}: {len(repo_manifests)} manifests to delete')
+        manifests.extend(repo_manifests)
+
+    manifests.sort(key=itemgetter('repo', 'digest'))
+    return {
+        'registry': registry.registry,
+        'created_at': datetime.now(timezone.utc).isoformat(),
+        'manifests': manifests,
+    }
+
+
+def execute_cleanup_plan(registry, plan, progress_path, max_workers=8):
+    """phase two of admin cleanup-registry: delete manifests in plan,
+    every deleted manifest is appended to progress_path, and skipped next
+    time, so an interrupted cleanup can be resumed. returns the manifests
+    that couldn't be deleted"""
+    done = set()
+    if exists(progress_path):
+        with open(progress_path) as f:
+            done = {line.strip() for line in f if line.strip()}
+
+    todo = []
+    for manifest in plan['manifests']:
+        key = f'{manifest["repo"]}@{manifest["digest"]}'
+        if key not in done:
+            done.add(key)
+            todo.append(key)
+
+    if not todo:
+        return []
+    echo(f'{len(todo)} manifests to delete, {len(done) - len(todo)} done before')
+
+    def delete(key):
+        repo, digest = key.split('@', 1)
+        return registry.delete_manifest(repo, digest)
+
+    failures = []
+    with open(progress_path, 'a') as progress:
+        results = iter_parallel(delete, todo, max_workers=max_workers)
+        for n, (key, future) in enumerate(results, 1):
+            try:
+                future.result()
+            except (RegistryError, requests.RequestException) as e:
+                failures.append(key)
+                warn(f'cannot delete {key}: {e}')
+                continue
+            progress.write(f'{key}\n')
+            progress.flush()
+
+            if n % 100 == 0 or n == len(todo):
+                echo(f'{n}/{len(todo)} processed')
+
+    return failures
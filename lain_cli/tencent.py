@@ -9,6 +9,7 @@ from tencentcloud.tcr.v20190924 import models as tcr_models
 from tencentcloud.tcr.v20190924.tcr_client import TcrClient
 
 from lain_cli.utils import (
+    VM_STATES,
     PaaSUtils,
     debug,
     error,
@@ -22,7 +23,7 @@ class TencentPaaS(PaaSUtils):
 
     """https://cloud.tencent.com/document/product/1141/41605"""
 
-    VM_STATES = {'on', 'off'}
+    VM_STATES = VM_STATES
 
     def __init__(
         self, registry=None, access_key_id=None, access_key_secret=None, **kwargs
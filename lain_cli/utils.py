@@ -1,23 +1,32 @@
-import asyncio
+import atexit
 import base64
+import gzip
+import heapq
 import inspect
 import itertools
 import json
 import math
 import os
+import pickle
 import platform
+import queue
 import re
 import shlex
 import shutil
 import subprocess
 import sys
+import threading
+import traceback
 from collections import defaultdict
 from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from contextlib import contextmanager, suppress
 from copy import deepcopy
+from datetime import datetime, timezone
 from functools import lru_cache, partial
 from glob import glob
 from hashlib import blake2b
+from importlib import import_module
 from inspect import cleandoc
 from io import BytesIO
 from numbers import Number
@@ -26,14 +35,13 @@ from os import getcwd as cwd
 from os import getppid, makedirs, readlink, remove, unlink
 from os.path import abspath, basename, dirname, exists, expanduser, isdir, isfile, join
 from tempfile import TemporaryDirectory, mkstemp
-from time import sleep, time
+from time import perf_counter, sleep, time
 
 import click
 import psutil
 import requests
 from click import BadParameter
-from cryptography import x509
-from cryptography.hazmat.backends import default_backend
+from click.globals import pop_context, push_context
 from humanfriendly import (
     CombinedUnit,
     SizeUnit,
@@ -41,18 +49,12 @@ from humanfriendly import (
     parse_timespan,
     round_number,
 )
-from humanfriendly.text import tokenize
 from jinja2 import Environment, FileSystemLoader
 from marshmallow import INCLUDE, Schema, ValidationError, post_load, validates
 from marshmallow.fields import Dict, Field, Function, Int, List, Nested, Raw, Str
 from marshmallow.schema import SchemaMeta
-from marshmallow.validate import NoneOf, OneOf
+from marshmallow.validate import NoneOf, OneOf, Range
 from packaging import version
-from pip._internal.index.collector import LinkCollector
-from pip._internal.index.package_finder import PackageFinder
-from pip._internal.models.search_scope import SearchScope
-from pip._internal.models.selection_prefs import SelectionPreferences
-from pip._internal.network.session import PipSession
 from requests.exceptions import RequestException
 from ruamel.yaml import YAML
 from ruamel.yaml.parser import ParserError
@@ -61,9 +63,15 @@ from ruamel.yaml.scalarstring import LiteralScalarString
 from lain_cli import __version__, package_name
 
 yaml = YAML()
+# C based (when ruamel.yaml.clib is available) and returns plain python
+# objects, for yaml that doesn't need to be dumped back for human editing
+safe_yaml = YAML(typ='safe')
 ENV = os.environ.copy()
 # safe to delete when release is in this state
 HELM_STUCK_STATE = {'pending-install', 'pending-upgrade', 'uninstalling'}
+# helm 3 stores every release revision in a secret named
+# sh.helm.release.v1.<release name>.v<revision>, see decode_helm_release
+HELM_RELEASE_SECRET_TYPE = 'helm.sh/release.v1'
 CLI_DIR = dirname(abspath(__file__))
 TEMPLATE_DIR = join(CLI_DIR, 'templates')
 CHART_TEMPLATE_DIR = join(CLI_DIR, 'chart_template')
@@ -81,10 +89,16 @@ CHART_DIR_NAME = 'chart'
 CHART_VERSION = version.parse('0.1.11')
 LOOKOUT_ENV = {'http_proxy', 'https_proxy', 'HTTP_PROXY', 'HTTPS_PROXY'}
 KUBECONFIG_DIR = expanduser('~/.kube')
+CACHE_DIR = ENV.get('LAIN_CACHE_DIR') or join(
+    ENV.get('XDG_CACHE_HOME') or expanduser('~/.cache'), package_name
+)
 HELM_MIN_VERSION_STR = 'v3.8.0'
 HELM_MIN_VERSION = version.parse(HELM_MIN_VERSION_STR)
 STERN_MIN_VERSION_STR = '1.11.0'
 STERN_MIN_VERSION = version.parse(STERN_MIN_VERSION_STR)
+# server version may change when cluster is upgraded, so tool versions cannot
+# be cached forever
+TOOL_VERSION_TTL = 3600
 TIMESTAMP_PATTERN = re.compile(r'\d+')
 LAIN_META_PATTERN = re.compile(r'\d{10,}-\w{40}$')
 KUBERNETES_MIN_MEMORY = parse_size('4MiB', binary=True)
@@ -97,7 +111,19 @@ GITIGNORE_NAME = '.gitignore'
 BUILD_STAGES = {'prepare', 'build', 'release'}
 PROTECTED_REPO_KEYWORDS = ('centos',)
 RECENT_TAGS_COUNT = 10
+VM_STATES = {'on', 'off'}
 BIG_DEPLOY_REPLICA_COUNT = 3
+# these commands change global state (like ~/.kube/config), lain_ runs them in
+# a separate process, rather than inside the current one
+LAIN_SUBPROCESS_COMMANDS = {'use'}
+# lain_ passes these to the child context, so they aren't computed again
+LAIN_INHERITED_OBJ_KEYS = (
+    'read_cache',
+    'pristine_values',
+    'cluster_values',
+    'extra_values',
+    'cluster_config',
+)
 INGRESS_CANARY_ANNOTATIONS = {
     'nginx.ingress.kubernetes.io/canary-by-header',
     'nginx.ingress.kubernetes.io/canary-by-header-value',
@@ -108,18 +134,6 @@ INGRESS_CANARY_ANNOTATIONS = {
 DEFAULT_BACKEND_RESPONSE = 'default backend - 404'
 
 
-def parse_multi_timespan(s):
-    """
-    >>> parse_multi_timespan('3s')
-    3.0
-    >>> parse_multi_timespan('3h3s')
-    10800.0
-    """
-    tokens = tokenize(s)
-    s = ''.join((str(c) for c in tokens[:2]))
-    return parse_timespan(s)
-
-
 def click_parse_timespan(ctx, param, value):
     if not value:
         return
@@ -349,40 +363,266 @@ def tell_ingress_urls():
     return list(part1) + list(part2)
 
 
-def parse_ready(ready_str):
+def parse_kube_timestamp(s):
     """
-    >>> parse_ready('0/1')
-    False
-    >>> parse_ready('1/1')
-    True
+    >>> parse_kube_timestamp('2021-01-01T00:00:00Z')
+    1609459200.0
     """
-    left, right = ready_str.split('/')
-    if left != right:
-        return False
-    return True
+    if not s:
+        return time()
+    return (
+        datetime.strptime(s, '%Y-%m-%dT%H:%M:%SZ')
+        .replace(tzinfo=timezone.utc)
+        .timestamp()
+    )
+
 
+def format_age(seconds):
+    """same as the AGE column of kubectl get
 
-def parse_podline(s):
+    >>> [format_age(n) for n in (39, 366, 3 * 3600 + 360, 40 * 3600, 3 * 86400 + 7200, 30 * 86400)]
+    ['39s', '6m6s', '3h6m', '40h', '3d2h', '30d']
+    >>> format_age(2116 * 86400)
+    '5y291d'
     """
-    >>> new = 'dummy-web-8d9c66df6-8wffw   0/1     RunContainerError   1 (18s ago)   39s   172.17.0.4   minikube   <none>           <none>'
-    >>> parse_podline(new)
-    ['dummy-web-8d9c66df6-8wffw', '0/1', 'RunContainerError', '1', '39s', '172.17.0.4', 'minikube', '<none>', '<none>']
-    >>> old = 'dummy-web-8d9c66df6-8wffw   0/1     RunContainerError   1   39s   172.17.0.4   minikube   <none>           <none>'
-    >>> parse_podline(old)
-    ['dummy-web-8d9c66df6-8wffw', '0/1', 'RunContainerError', '1', '39s', '172.17.0.4', 'minikube', '<none>', '<none>']
+    seconds = max(int(seconds), 0)
+    minutes, hours, days = seconds // 60, seconds // 3600, seconds // 86400
+    years = days // 365
+    if seconds < 120:
+        return f'{seconds}s'
+    if minutes < 10:
+        return f'{minutes}m{seconds % 60}s' if seconds % 60 else f'{minutes}m'
+    if hours < 3:
+        return f'{minutes}m'
+    if hours < 8:
+        return f'{hours}h{minutes % 60}m' if minutes % 60 else f'{hours}h'
+    if hours < 48:
+        return f'{hours}h'
+    if hours < 24 * 8:
+        return f'{days}d{hours % 24}h' if hours % 24 else f'{days}d'
+    if years < 2:
+        return f'{days}d'
+    if years < 8:
+        return f'{years}y{days % 365}d' if days % 365 else f'{years}y'
+    return f'{years}y'
+
+
+class PodRecord:
+    """the parts of a pod lain cares about, decoded from kubectl get po
+    -ojson, see get_pod_records
+
+    >>> pod = {'metadata': {'name': 'dummy-web-8d9c66df6-8wffw'}, 'spec': {'containers': [{}]}}
+    >>> pod['status'] = {'phase': 'Pending', 'containerStatuses': [{'ready': False, 'restartCount': 1, 'state': {'waiting': {'reason': 'ContainerCreating'}}}]}
+    >>> record = PodRecord.from_pod(pod)
+    >>> record.status, record.state, record.ready_str, record.restarts
+    ('ContainerCreating', 'containercreating', '0/1', 1)
+    >>> pod['status'] = {'phase': 'Running', 'containerStatuses': [{'ready': False, 'state': {'running': {}}}]}
+    >>> PodRecord.from_pod(pod).state
+    'notready'
+    >>> pod['metadata']['deletionTimestamp'] = '2021-01-01T00:00:00Z'
+    >>> PodRecord.from_pod(pod).status
+    'Terminating'
+    """
+
+    __slots__ = (
+        'name',
+        'phase',
+        'status',
+        'ready',
+        'total',
+        'restarts',
+        'created_at',
+        'node',
+        'ip',
+        'reasons',
+        'owner',
+    )
+
+    def __init__(
+        self,
+        name,
+        phase,
+        status,
+        ready,
+        total,
+        restarts=0,
+        created_at=None,
+        node=None,
+        ip=None,
+        reasons=(),
+        owner=None,
+    ):
+        self.name = name
+        self.phase = phase
+        self.status = status
+        self.ready = ready
+        self.total = total
+        self.restarts = restarts
+        self.created_at = created_at or time()
+        self.node = node
+        self.ip = ip
+        self.reasons = reasons
+        self.owner = owner
+
+    def __repr__(self):
+        return f'<PodRecord {self.name} {self.status} {self.ready_str}>'
+
+    @classmethod
+    def from_pod(cls, pod):
+        metadata = pod.get('metadata') or {}
+        spec = pod.get('spec') or {}
+        status = pod.get('status') or {}
+        phase = status.get('phase') or 'Unknown'
+        # STATUS column of kubectl get po
+        display = status.get('reason') or phase
+        reasons = []
+        init_statuses = status.get('initContainerStatuses') or []
+        init_done = True
+        for n, cs in enumerate(init_statuses):
+            state = cs.get('state') or {}
+            terminated = state.get('terminated')
+            if terminated and terminated.get('exitCode') == 0:
+                continue
+            init_done = False
+            waiting_reason = (state.get('waiting') or {}).get('reason')
+            if terminated:
+                display = f'Init:{terminated.get("reason") or "Error"}'
+            elif waiting_reason and waiting_reason != 'PodInitializing':
+                display = f'Init:{waiting_reason}'
+            else:
+                display = f'Init:{n}/{len(init_statuses)}'
+            break
+
+        ready = restarts = 0
+        for cs in status.get('containerStatuses') or []:
+            state = cs.get('state') or {}
+            ready += bool(cs.get('ready'))
+            restarts += cs.get('restartCount') or 0
+            reason = (state.get('waiting') or state.get('terminated') or {}).get(
+                'reason'
+            )
+            if reason:
+                reasons.append(reason)
+                if init_done:
+                    display = reason
+
+        if metadata.get('deletionTimestamp'):
+            display = 'Terminating'
+
+        owner = None
+        for ref in metadata.get('ownerReferences') or []:
+            if ref.get('controller'):
+                owner = (ref.get('kind'), ref.get('name'))
+
+        return cls(
+            metadata.get('name'),
+            phase,
+            display,
+            ready,
+            len(spec.get('containers') or []),
+            restarts=restarts,
+            created_at=parse_kube_timestamp(metadata.get('creationTimestamp')),
+            node=spec.get('nodeName'),
+            ip=status.get('podIP'),
+            reasons=tuple(reasons),
+            owner=owner,
+        )
+
+    @property
+    def ready_str(self):
+        return f'{self.ready}/{self.total}'
+
+    @property
+    def is_ready(self):
+        return self.ready == self.total
+
+    @property
+    def age(self):
+        return time() - self.created_at
+
+    @property
+    def state(self):
+        """status lower cased, running pods that aren't ready are considered
+        notready, used by wait_for_pod_up"""
+        state = self.status.lower()
+        if state == 'running' and not self.is_ready:
+            return 'notready'
+        return state
+
+    @property
+    def is_bad(self):
+        if self.status == 'Completed':
+            # job pods will be ignored
+            return False
+        # 本来时不时就会重启节点, 造成容器重启, 因此设置个小阈值, 过滤噪声
+        return not self.is_ready or self.status != 'Running' or self.restarts > 10
+
+    def to_row(self):
+        return (
+            self.name,
+            self.ready_str,
+            self.status,
+            str(self.restarts),
+            format_age(self.age),
+            self.ip or '<none>',
+            self.node or '<none>',
+        )
+
+
+class KubeReadError(Exception):
+    def __init__(self, message, code=1):
+        super().__init__(message)
+        self.code = code
+
+
+def format_pod_table(records, headers=True):
+    """render pods like kubectl get po -owide"""
+    rows = [record.to_row() for record in records]
+    if headers:
+        rows.insert(0, ('NAME', 'READY', 'STATUS', 'RESTARTS', 'AGE', 'IP', 'NODE'))
+    return format_table(rows)
+
+
+def format_table(rows):
+    """align columns like kubectl does, returns lines
+
+    >>> format_table([('NAME', 'RESULT'), ('dummy-web-xxx', 'ok')])
+    ['NAME            RESULT', 'dummy-web-xxx   ok']
     """
-    parentheses_removed = re.sub(r'\([^()]*\)', '', s)
-    return parentheses_removed.split()
+    if not rows:
+        return []
+    widths = [max(len(row[n]) for row in rows) for n in range(len(rows[0]))]
+    return [
+        '   '.join(col.ljust(width) for col, width in zip(row, widths)).rstrip()
+        for row in rows
+    ]
+
+
+def get_pod_records(selector=None, refresh=False):
+    """one kubectl get po -ojson for each selector, decoded into PodRecord,
+    memoized within a command, pass refresh=True to fetch again. raises
+    KubeReadError"""
+    ctx = context(silent=True)
+    memo = ctx.obj.setdefault('pod_records', {}) if ctx else {}
+    if refresh or selector not in memo:
+        responson = fetch_kube_object('pod', selector=selector, cache=not refresh)
+        memo[selector] = [PodRecord.from_pod(pod) for pod in responson['items']]
+
+    return memo[selector]
+
+
+def forget_pod_records():
+    """call this after pods are deleted"""
+    ctx = context(silent=True)
+    if ctx:
+        ctx.obj.pop('pod_records', None)
 
 
 def get_pods(
-    appname=None, selector=None, headers=False, show_only_bad_pods=None, check=False
+    appname=None, selector=None, show_only_bad_pods=None, check=False, refresh=False
 ):
-    cmd = [
-        'get',
-        'pod',
-        '-o=wide',
-    ]
+    """returns a list of PodRecord, bad pods are sorted to the top when
+    show_only_bad_pods"""
     if appname and selector:
         raise ValueError(
             f'cannot use appname and selector together, got {appname}, {selector}'
@@ -390,86 +630,46 @@ def get_pods(
     if appname:
         selector = f'app.kubernetes.io/name={appname}'
 
-    if selector:
-        cmd.append(f'-l{selector}')
-
-    res = kubectl(*cmd, capture_output=True, check=check)
-    pods = ensure_str(res.stdout).splitlines()
+    try:
+        records = get_pod_records(selector, refresh=refresh)
+    except KubeReadError as e:
+        error(str(e), exit=check and e.code)
+        return []
     if not show_only_bad_pods:
-        if headers:
-            return res, pods
-        return res, pods[1:]
-    header = pods.pop(0)
+        return records
     bad_pods = []
-    for podline in pods:
-        # ['deploy-x-x', '1/1', 'Running', '0', '6h6m', '192.168.0.13', 'node-1', '<none>', '1/1']
-        _, ready_str, status, restarts, *_ = podline.split()
-        if status == 'Completed':
-            # job pods will be ignored
+    for record in records:
+        if not record.is_bad:
             continue
-        if not parse_ready(ready_str):
-            bad_pods.append(podline)
-            continue
-        if status not in {'Running', 'Completed'}:
+        if record.is_ready and record.status != 'Running':
             # 状态异常的 pods 是我们最为关心的, 因此塞到头部方便取用
-            bad_pods.insert(1, podline)
-            continue
-        if int(restarts) > 10:
-            # 本来时不时就会重启节点, 造成容器重启, 因此设置个小阈值, 过滤噪声
-            bad_pods.append(podline)
-            continue
+            bad_pods.insert(0, record)
+        else:
+            bad_pods.append(record)
 
-    if headers:
-        return res, [header] + bad_pods
-    return res, bad_pods
+    return bad_pods
 
 
 def pick_pod(proc_name=None, phase=None, containerStatuses=None, selector=None):
     release_name = tell_release_name()
-    cmd = ['get', 'pod', '-o=json']
     if proc_name:
-        cmd.extend(['-l', f'app.kubernetes.io/instance={release_name}-{proc_name}'])
-    elif selector:
-        cmd.extend(['-l', selector])
-    else:
-        cmd.extend(['-l', f'helm.sh/chart={release_name}'])
+        selector = f'app.kubernetes.io/instance={release_name}-{proc_name}'
+    elif not selector:
+        selector = f'helm.sh/chart={release_name}'
 
+    records = get_pods(selector=selector)
     if phase:
-        cmd.extend([f'--field-selector=status.phase=={phase}'])
+        records = [r for r in records if r.phase == phase]
 
-    res = kubectl(*cmd, capture_output=True, check=False)
-    stdout = res.stdout
-    if not stdout or rc(res):
-        return
-    responson = jalo(res.stdout)
     if containerStatuses:
         if not isinstance(containerStatuses, set):
             containerStatuses = {containerStatuses}
 
-        # 这个数据的 parsing 真不用看, 随便 k get po -ojson
-        # 看眼结构就知道怎么做 parsing 了, 不用怪我不封装
-        items = [
-            item
-            for item in responson['items']
-            if containerStatuses.intersection(
-                set(
-                    (
-                        status['state'].get('waiting', {})
-                        or status['state'].get('terminated', {})
-                    ).get('reason')
-                    for status in item['status'].get('containerStatuses', [])
-                )
-            )
-        ]
-    else:
-        items = responson['items']
+        records = [r for r in records if containerStatuses.intersection(r.reasons)]
 
-    items = sorted(items, key=lambda d: d['metadata']['creationTimestamp'])
-    podnames = [item['metadata']['name'] for item in items]
-    try:
-        return podnames[-1]
-    except IndexError:
+    if not records:
         return
+    return max(records, key=lambda r: r.created_at).name
 
 
 def tell_best_deploy():
@@ -490,39 +690,150 @@ def tell_best_deploy():
     return chosen
 
 
-def delete_pod(selector, graceful=False):
-    _, pods = get_pods(selector=selector, check=True)
+def delete_pod(selector, graceful=False, max_unavailable=1):
+    pods = get_pods(selector=selector, check=True)
     if not pods:
         error(f'no pods found with {selector}', exit=1)
 
+    forget_pod_records()
     if not graceful:
         return kubectl('delete', 'pod', '-l', selector, timeout=None)
-    for line in pods:
-        pod_name = line.split(None, 1)[0]
-        res = kubectl(
-            'delete',
-            'pod',
-            '--wait=true',
-            pod_name,
-            timeout=None,
-            tee=True,
-            check=False,
-        )
-        if code := rc(res):
-            stderr = ensure_str(res.stderr)
-            if 'NotFound' in stderr:
-                warn(f'{pod_name} is already gone, ignore')
-            else:
-                error(f'cannot continue due to error: {stderr}', exit=code)
+    recycle_pods(selector, pods, max_unavailable=max_unavailable)
+
+
+def tell_max_unavailable(value, total):
+    """count or percentage of total, rounded down like kubernetes does, but
+    at least 1
+
+    >>> tell_max_unavailable('25%', 10)
+    2
+    >>> tell_max_unavailable('5%', 10)
+    1
+    >>> tell_max_unavailable('3', 10)
+    3
+    """
+    value = str(value).strip()
+    if value.endswith('%'):
+        count = total * int(value[:-1]) // 100
+    else:
+        count = int(value)
+
+    return max(count, 1)
+
+
+def recycle_pods(selector, pods, max_unavailable=1, tries=40):
+    """delete pods one window at a time, at most max_unavailable pods are
+    recycling at once, a slot frees up as soon as a replacement pod is
+    ready. exit when a replacement goes bad, or nothing moves for tries *
+    POD_POLL_INTERVAL seconds, which must outlast termination grace period
+    plus readiness of a single pod"""
+    window = tell_max_unavailable(max_unavailable, len(pods))
+    # statefulset pods come back with the same name
+    old_pods = {(record.name, record.created_at) for record in pods}
+    todo = [record.name for record in pods]
+    deleted = []
+    gone = set()
+    ready = set()
+    records = pods
+    interval = 1 if tell_kube_client() else POD_POLL_INTERVAL
+    stall_timeout = tries * POD_POLL_INTERVAL
+    last_progress = None
+    last_progress_at = perf_counter()
+    while True:
+        fresh = [r for r in records if (r.name, r.created_at) not in old_pods]
+        bad = [r for r in fresh if r.state in POD_BAD_STATES]
+        if bad:
+            table = '\n'.join(format_pod_table(bad, headers=False))
+            error(f'replacement pod in bad state, abort restart:\n{table}', exit=1)
+
+        remaining = {r.name for r in records if (r.name, r.created_at) in old_pods}
+        for name in set(deleted).difference(remaining, gone):
+            gone.add(name)
+            echo(f'{name} is gone')
+
+        for record in fresh:
+            if record.is_ready and record.name not in ready:
+                ready.add(record.name)
+                echo(f'{record.name} is ready')
+
+        unavailable = len(deleted) - len(ready)
+        batch = todo[: max(window - unavailable, 0)]
+        if batch:
+            del todo[: len(batch)]
+            deleted.extend(batch)
+            echo(f'recycling {" ".join(batch)}')
+            res = kubectl(
+                'delete',
+                'pod',
+                '--wait=false',
+                *batch,
+                capture_output=True,
+                check=False,
+            )
+            if code := rc(res):
+                stderr = ensure_str(res.stderr)
+                if 'NotFound' in stderr:
+                    warn(f'some pods are already gone, ignore: {stderr}')
+                else:
+                    error(f'cannot continue due to error: {stderr}', exit=code)
+
+        if not todo and not remaining and is_pods_up({r.state for r in records}):
+            return [r.name for r in records]
+        progress = (len(deleted), len(gone), len(ready))
+        if progress != last_progress:
+            last_progress = progress
+            last_progress_at = perf_counter()
+        elif perf_counter() - last_progress_at >= stall_timeout:
+            table = '\n'.join(format_pod_table(records))
+            error(f'restart got stuck, here\'s the pods:\n{table}', exit=1)
+
+        sleep(interval)
+        records = get_pods(selector=selector, refresh=True)
+
+
+def rollout_restart(selector):
+    """kubectl rollout restart, but for every deployment and statefulset whose
+    pods match selector (key=value only), and wait for them to converge.
+    controllers will respect their own update strategy"""
+    labels = {}
+    for clause in selector.split(','):
+        key, sep, value = clause.partition('=')
+        if not sep or value.startswith('=') or key.endswith('!'):
+            error(
+                f'--rollout only supports key=value selectors, got {selector}', exit=1
+            )
+        labels[key.strip()] = value.strip()
 
-        wait_for_pod_up(selector=selector)
+    now = datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+    patch = {
+        'spec': {
+            'template': {
+                'metadata': {'annotations': {'kubectl.kubernetes.io/restartedAt': now}}
+            }
+        }
+    }
+    targets = []
+    for kind in ('deployment', 'statefulset'):
+        for obj in kube_read(kind, cache=False)['items']:
+            template_labels = obj['spec']['template']['metadata'].get('labels') or {}
+            if labels.items() <= template_labels.items():
+                targets.append((kind, obj['metadata']['name']))
+
+    if not targets:
+        error(f'no deployment or statefulset has pods matching {selector}', exit=1)
+    parallel_map(lambda target: kube_patch(*target, patch), targets)
+    names = [name for _, name in targets]
+    echo(f'restarting {" ".join(names)}')
+    if wait_for_rollout(None, names=names) is None:
+        error(f'{" ".join(names)} did not finish restarting in time', exit=1)
 
 
 def storage_class_can_reattach(sc_name):
     """this is an over-simplified check, if pvc name is not random, the
     generated pv is deemed as re-attachable"""
-    res = kubectl('get', 'sc', '-ojson', sc_name, capture_output=True)
-    spec = jalo(res.stdout)
+    spec = kube_read('sc', sc_name)
+    if not spec:
+        error(f'storage class not found: {sc_name}', exit=1)
     if spec.get('reclaimPolicy') != 'Retain':
         return False
     parameters = spec['parameters']
@@ -549,21 +860,14 @@ def update_canary_annotations(release_name, canary_group_name=None):
     else:
         canary_dic = {'nginx.ingress.kubernetes.io/canary-weight': '0'}
 
-    ings_res = kubectl(
-        'get',
-        'ing',
-        '-ojson',
-        '-l',
-        f'helm.sh/chart={release_name}',
-        capture_output=True,
-    )
-    ings = jalo(ings_res.stdout)
+    ings = kube_read('ing', selector=f'helm.sh/chart={release_name}')
     for ing in ings['items']:
         annotations = ing['metadata']['annotations']
-        clean_canary_ingress_annotations(annotations)
-        annotations.update(canary_dic)
-
-    kubectl_apply(ings, validate=False)
+        # merge patch deletes keys with null values
+        patch = {k: None for k in INGRESS_CANARY_ANNOTATIONS if k in annotations}
+        patch.update(canary_dic)
+        name = ing['metadata']['name']
+        kube_patch('ing', name, {'metadata': {'annotations': patch}})
 
 
 def deploy_toast(canary=False, re_creation_headsup=False):
@@ -651,10 +955,30 @@ def template_update_toast():
     goodjob(template_update_done_str)
 
 
+class RateLimiter:
+    """at most rate calls per second, shared by all threads"""
+
+    def __init__(self, rate):
+        self.interval = 1 / rate
+        self.lock = threading.Lock()
+        self.next_slot = 0
+
+    def wait(self):
+        with self.lock:
+            now = perf_counter()
+            delay = self.next_slot - now
+            self.next_slot = max(now, self.next_slot) + self.interval
+
+        if delay > 0:
+            sleep(delay)
+
+
 class RequestClientMixin:
     endpoint = None
     headers = {}
     timeout = 5
+    # set a requests.Session to reuse connections
+    session = None
 
     def request(self, method, path=None, params=None, data=None, **kwargs):
         if not path:
@@ -665,9 +989,12 @@ class RequestClientMixin:
             raise ValueError('no endpoint specified')
 
         kwargs.setdefault('timeout', self.timeout)
-        res = requests.request(
-            method, url, headers=self.headers, params=params, data=data, **kwargs
-        )
+        kwargs.setdefault('headers', self.headers)
+        requester = self.session or requests
+        with TRACER.span(f'{method} {url}', 'http', method=method, url=url) as span:
+            res = requester.request(method, url, params=params, data=data, **kwargs)
+            span['status'] = res.status_code
+
         return res
 
     def post(self, path=None, **kwargs):
@@ -703,11 +1030,17 @@ class PaaSUtils:
 
     @staticmethod
     def sort_and_filter(tags, n=None):
+        """newest n tags, tags can be a generator, only n tags are held in
+        memory while it's consumed
+
+        >>> PaaSUtils.sort_and_filter(iter(['2', 'prepare', '3', '1']), n=2)
+        ['3', '2']
+        """
         n = n or RECENT_TAGS_COUNT
-        cleaned = sorted((s for s in tags if not s.startswith('prepare')), reverse=True)
+        cleaned = (s for s in tags if not s.startswith('prepare'))
         if n:
-            return cleaned[:n]
-        return cleaned
+            return heapq.nlargest(n, cleaned)
+        return sorted(cleaned, reverse=True)
 
     def make_image(self, tag, repo=None):
         ctx = context()
@@ -733,6 +1066,9 @@ class PaaSUtils:
 
     @staticmethod
     def tell_certificate_upload_name(crt):
+        from cryptography import x509
+        from cryptography.hazmat.backends import default_backend
+
         cert = x509.load_pem_x509_certificate(crt.encode('utf-8'), default_backend())
         cn_string = cert.subject.rfc4514_string()
         expire_date = cert.not_valid_after
@@ -810,17 +1146,13 @@ def tell_secret(secret_name, init=None):
     """return k8s secret object in python dict, all b64decoded.
     can optionally initialize a secret by providing the init argument"""
 
-    res = kubectl(
-        'get', 'secret', '-oyaml', secret_name, capture_output=True, check=False
-    )
-    if code := rc(res):
-        stderr = ensure_str(res.stderr)
-        if 'not found' in stderr and init:
+    dic = kube_read('secret', secret_name)
+    if dic is None:
+        if init:
             init_kubernetes_secret(secret_name, init=init)
             return tell_secret(secret_name, init=init)
-        error(f'get secret error: {stderr}', exit=code)
+        error(f'secret not found: {secret_name}', exit=1)
 
-    dic = yalo(res.stdout)
     clean_kubernetes_manifests(dic)
     dic.setdefault('data', {})
     for fname, s in dic['data'].items():
@@ -865,12 +1197,12 @@ def kubectl_edit(f, capture_output=False, notify_diff=True, **kwargs):
 
         webhook = tell_webhook_client()
         if webhook:
-            old = yalo(f)
+            old = yalo(f, round_trip=True)
 
     current_cluster = tell_cluster()
     edit_file(f)
     try:
-        secret_dic = yalo(f)
+        secret_dic = yalo(f, round_trip=True)
         if notify_diff:
             new = deepcopy(secret_dic)
 
@@ -903,6 +1235,16 @@ def kubectl_edit(f, capture_output=False, notify_diff=True, **kwargs):
     return res
 
 
+def dump_manifest(dic):
+    """kubectl reads json just fine, and json is a lot faster to dump than
+    yaml"""
+    fd, name = mkstemp(suffix='.json')
+    with fdopen(fd, 'w') as f:
+        json.dump(dic, f, default=str)
+
+    return name
+
+
 def kubectl_apply(
     anything,
     validate=True,
@@ -911,7 +1253,7 @@ def kubectl_apply(
     backup=False,
     **kwargs,
 ):
-    """dump content into a temp yaml file, and then k apply.
+    """dump content into a temp json file, and then k apply.
     also if this thing is kubernetes secret, will try to b64encode"""
     if isinstance(anything, str):
         dic = yalo(anything)
@@ -933,8 +1275,7 @@ def kubectl_apply(
 
     debug('dumping kubernetes manifest:')
     debug(dic)
-    fd, name = mkstemp(suffix='.yaml')
-    yadu(dic, fd)
+    name = dump_manifest(dic)
     validate = jadu(validate)
     try:
         res = kubectl(
@@ -966,8 +1307,7 @@ def backup_kubernetes_resource(dic):
     resource_name = dic['metadata']['name']
     ts = int(time())
     dic['metadata']['name'] = f'{resource_name}-backup-{ts}'
-    backup_fd, backup_name = mkstemp(suffix='.yaml')
-    yadu(dic, backup_fd)
+    backup_name = dump_manifest(dic)
     try:
         kubectl(
             'apply',
@@ -1067,11 +1407,6 @@ def tell_helm_options(kvpairs=None, deduce_image=True, canary=False, extra=()):
     return options
 
 
-def clean_canary_ingress_annotations(annotations):
-    for k in INGRESS_CANARY_ANNOTATIONS:
-        annotations.pop(k, None)
-
-
 def make_canary_name(appname):
     return f'{appname}-canary'
 
@@ -1149,13 +1484,34 @@ def tell_image_tag(image_tag=None):
 
 
 def lain_(*args, exit=None, **kwargs):
+    """run another lain command, in this very process if possible, so that
+    values, cluster config and tool version checks are not done all over
+    again"""
     ctx = context()
+    subcommand = args[0] if args else None
     extra_values_file = ctx.obj.get('extra_values_file')
     if extra_values_file:
         args = ['--values', extra_values_file.name, *args]
 
-    cmd = ['lain', *args]
     kwargs.setdefault('check', True)
+    if (
+        set(kwargs) - {'check'}
+        or subcommand in LAIN_SUBPROCESS_COMMANDS
+        or ENV.get('LAIN_NO_INPROCESS')
+    ):
+        completed = lain_subprocess(*args, **kwargs)
+    else:
+        completed = lain_invoke(*args, **kwargs)
+
+    if exit:
+        context().exit(rc(completed))
+
+    return completed
+
+
+def lain_subprocess(*args, **kwargs):
+    ctx = context()
+    cmd = ['lain', *args]
     kwargs.setdefault('env', ENV)
     if ctx.obj.get('ignore_lint'):
         kwargs['env']['LAIN_IGNORE_LINT'] = 'true'
@@ -1163,11 +1519,66 @@ def lain_(*args, exit=None, **kwargs):
     if ctx.obj.get('remote_docker'):
         kwargs['env']['LAIN_REMOTE_DOCKER'] = 'true'
 
-    completed = subprocess_run(cmd, **kwargs)
-    if exit:
-        context().exit(rc(completed))
+    if TRACER.path:
+        # child shows up as a single span in our trace, do not let it
+        # overwrite the trace file
+        kwargs['env'] = {k: v for k, v in kwargs['env'].items() if k != 'LAIN_TRACE'}
 
-    return completed
+    return subprocess_run(cmd, **kwargs)
+
+
+def lain_invoke(*args, check=True):
+    """invoke lain command inside a child click context, exit code is
+    collected the same way as if it were run in a subprocess"""
+    from lain_cli.lain import lain
+
+    ctx = context()
+    flags = []
+    if ctx.obj.get('ignore_lint'):
+        flags.append('--ignore-lint')
+
+    if ctx.obj.get('remote_docker'):
+        flags.append('--remote-docker')
+
+    span_name = tell_trace_name(['lain', *args])
+    args = [*flags, *args]
+    excall(['lain', *args])
+    obj = {k: ctx.obj[k] for k in LAIN_INHERITED_OBJ_KEYS if k in ctx.obj}
+    obj['nested'] = True
+    with TRACER.span(span_name, 'lain', cmd=subprocess.list2cmdline(args)) as span:
+        code = run_lain_in_context(lain, args, obj)
+        span['exit_code'] = code
+
+    # the child may well have upgraded helm releases
+    forget_helm_releases()
+    if check and code:
+        ctx.exit(code)
+
+    return subprocess.CompletedProcess(['lain', *args], code)
+
+
+def run_lain_in_context(lain, args, obj):
+    try:
+        with lain.make_context('lain', list(args), obj=obj) as child_ctx:
+            lain.invoke(child_ctx)
+        code = 0
+    except click.exceptions.Exit as e:
+        code = e.exit_code
+    except click.ClickException as e:
+        e.show()
+        code = e.exit_code
+    except click.Abort:
+        error('Aborted!')
+        code = 1
+    except SystemExit as e:
+        code = e.code if isinstance(e.code, int) else int(e.code is not None)
+    except Exception:
+        # a crashed child process used to mean a non-zero exit code, rather
+        # than crashing the parent
+        traceback.print_exc()
+        code = 1
+
+    return code
 
 
 def lain_image(stage='release'):
@@ -1239,6 +1650,87 @@ def ensure_resource_initiated(chart=False, secret=False):
     return True
 
 
+class Tracer:
+    """collects a timeline of subprocesses, http requests and nested lain
+    commands, dumped as Chrome trace events (the json array format), which can
+    be viewed in chrome://tracing or https://ui.perfetto.dev"""
+
+    def __init__(self):
+        self.path = None
+        self.events = []
+        self.started_at = None
+
+    def start(self, path):
+        self.path = path
+        self.events = []
+        self.started_at = perf_counter()
+
+    def tell_ts(self, t):
+        return round((t - self.started_at) * 1e6)
+
+    def add(self, name, cat, start, end, args):
+        self.events.append(
+            {
+                'name': name,
+                'cat': cat,
+                'ph': 'X',
+                'ts': self.tell_ts(start),
+                'dur': round((end - start) * 1e6),
+                'pid': os.getpid(),
+                'tid': threading.get_native_id(),
+                'args': args,
+            }
+        )
+
+    @contextmanager
+    def span(self, name, cat, **args):
+        """yields args, so that results (exit code, status) can be added
+        after the traced operation is done"""
+        if not self.path:
+            yield args
+            return
+        start = perf_counter()
+        try:
+            yield args
+        finally:
+            self.add(name, cat, start, perf_counter(), args)
+
+    def dump(self, name='lain', **args):
+        if not self.path:
+            return
+        self.add(name, 'lain', self.started_at, perf_counter(), args)
+        # sort by start time, longer spans first, so that viewers nest
+        # them correctly
+        events = sorted(self.events, key=lambda e: (e['ts'], -e['dur']))
+        try:
+            with open(self.path, 'w') as f:
+                json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+        except OSError as e:
+            warn(f'cannot write trace to {self.path}: {e}')
+        else:
+            debug(f'trace written to {self.path}')
+        finally:
+            self.path = None
+
+
+TRACER = Tracer()
+
+
+def tell_trace_name(cmd):
+    if isinstance(cmd, str):
+        cmd = cmd.split()
+
+    words = [basename(cmd[0])]
+    for arg in cmd[1:]:
+        if arg.startswith('-'):
+            break
+        words.append(arg)
+        if len(words) == 3:
+            break
+
+    return ' '.join(words)
+
+
 def subprocess_run(
     *args, silent=None, dry_run=False, tee=False, abort_on_fail=False, **kwargs
 ):
@@ -1277,18 +1769,22 @@ def subprocess_run(
     excall(*args, silent=silent)
     if dry_run:
         return
-    try:
-        res = subprocess.run(*args, **kwargs)
-    except subprocess.TimeoutExpired:
-        timeout = kwargs['timeout']
-        stderr = (
-            f'this command reached its {timeout}s timeout:\n '
-            + subprocess.list2cmdline(args[0])
-        )
-        if not silent:
-            error(stderr)
+    cmd = args[0]
+    cmd_str = cmd if isinstance(cmd, str) else subprocess.list2cmdline(cmd)
+    with TRACER.span(tell_trace_name(cmd), 'subprocess', cmd=cmd_str) as span:
+        try:
+            res = subprocess.run(*args, **kwargs)
+        except subprocess.TimeoutExpired:
+            timeout = kwargs['timeout']
+            stderr = f'this command reached its {timeout}s timeout:\n ' + cmd_str
+            if not silent:
+                error(stderr)
 
-        res = subprocess.CompletedProcess(args[0], 1, stdout=stderr, stderr=stderr)
+            res = subprocess.CompletedProcess(cmd, 1, stdout=stderr, stderr=stderr)
+
+        span['exit_code'] = res.returncode
+        span['stdout_bytes'] = None if res.stdout is None else len(res.stdout)
+        span['stderr_bytes'] = None if res.stderr is None else len(res.stderr)
 
     stdout = res.stdout
     stderr = res.stderr
@@ -1316,17 +1812,170 @@ def subprocess_run(
     return res
 
 
+# idempotent commands (by their first word), whose results are reused within
+# a single lain command, see ReadCache
+READ_COMMANDS = {
+    'kubectl': frozenset(('get', 'version', 'api-resources', 'api-versions')),
+    'helm': frozenset(('status', 'get', 'history', 'list', 'ls', 'version')),
+    'git': frozenset(('log', 'remote', 'rev-parse', 'describe')),
+}
+# commands that don't change anything either, but aren't worth caching
+HARMLESS_COMMANDS = {
+    'kubectl': frozenset(
+        ('logs', 'describe', 'top', 'explain', 'auth', 'cluster-info')
+    ),
+    'helm': frozenset(('lint', 'template', 'show', 'search')),
+    'git': frozenset(('status', 'diff', 'show', 'ls-files', 'check-ignore')),
+}
+
+
+class ReadCache:
+    """results of kubectl / helm / git read commands within a single lain
+    command (lain_invoke included), keyed by argv, cwd and kubeconfig.
+    mutating commands invalidate the entries they may affect"""
+
+    def __init__(self):
+        # key: (bin, kubernetes resource or None, CompletedProcess)
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+        # reads may run in parallel, see parallel_map
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def tell_words(cmd):
+        return [a for a in cmd[1:] if not a.startswith('-')]
+
+    def tell_verb(self, cmd):
+        words = self.tell_words(cmd)
+        return words[0] if words else None
+
+    def is_read(self, cmd):
+        return self.tell_verb(cmd) in READ_COMMANDS.get(cmd[0], ())
+
+    def is_harmless(self, cmd):
+        return self.is_read(cmd) or self.tell_verb(cmd) in HARMLESS_COMMANDS.get(
+            cmd[0], ()
+        )
+
+    def tell_resource(self, cmd):
+        """kubernetes resource a kubectl command works on, None if unknown
+
+        >>> cache = ReadCache()
+        >>> cache.tell_resource(['kubectl', 'delete', 'po', 'dummy-web-xxx'])
+        'pods'
+        >>> cache.tell_resource(['kubectl', 'apply', '-f', '/tmp/dummy.json'])
+        """
+        from lain_cli.kube import KubeUnsupported, tell_kube_resource
+
+        if cmd[0] != 'kubectl':
+            return
+        words = self.tell_words(cmd)
+        if len(words) < 2:
+            return
+        try:
+            return tell_kube_resource(words[1].split('/')[0])[1]
+        except KubeUnsupported:
+            return
+
+    @staticmethod
+    def tell_key(cmd):
+        return (tuple(cmd), cwd(), tell_kubeconfig_key())
+
+    def get(self, cmd):
+        key = self.tell_key(cmd)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry:
+                self.hits += 1
+                return entry[2]
+            self.misses += 1
+
+    def put(self, cmd, res):
+        entry = (cmd[0], self.tell_resource(cmd), res)
+        key = self.tell_key(cmd)
+        with self.lock:
+            self.entries[key] = entry
+
+    def invalidate(self, cmd):
+        """forget reads that cmd may have changed"""
+        bin = cmd[0]
+        if bin == 'git':
+            affected = {'git'}
+        elif bin == 'helm':
+            # helm changes both the release and its kubernetes resources
+            affected = {'helm', 'kubectl'}
+        else:
+            affected = set()
+        resource = self.tell_resource(cmd)
+        with self.lock:
+            for key, (entry_bin, entry_resource, _) in list(self.entries.items()):
+                if entry_bin in affected:
+                    self.entries.pop(key)
+                elif bin == 'kubectl':
+                    if entry_bin == 'kubectl' and resource in (None, entry_resource):
+                        self.entries.pop(key)
+                    # helm stores releases in secrets
+                    elif entry_bin == 'helm' and resource in (None, 'secrets'):
+                        self.entries.pop(key)
+
+    def report(self):
+        debug(
+            f'read cache saved {self.hits} of {self.hits + self.misses} read commands'
+        )
+
+
+def tell_read_cache():
+    ctx = context(silent=True)
+    if not ctx:
+        return
+    return ctx.obj.get('read_cache')
+
+
+def run_tool(cmd, check=True, cache=True, **kwargs):
+    """subprocess_run for kubectl / helm / git, captured reads are served by
+    ReadCache when possible, polling loops must pass cache=False"""
+    read_cache = tell_read_cache()
+    if not read_cache or kwargs.get('dry_run'):
+        return subprocess_run(cmd, env=ENV, check=check, **kwargs)
+    if not read_cache.is_harmless(cmd):
+        read_cache.invalidate(cmd)
+    if not read_cache.is_read(cmd):
+        return subprocess_run(cmd, env=ENV, check=check, **kwargs)
+    cacheable = (
+        cache
+        and kwargs.get('capture_output')
+        and not kwargs.get('tee')
+        and 'input' not in kwargs
+    )
+    if cacheable:
+        res = read_cache.get(cmd)
+        if res:
+            debug(f'cached: {subprocess.list2cmdline(cmd)}')
+            return res
+    res = subprocess_run(cmd, env=ENV, check=check, **kwargs)
+    # failures may well be transient
+    if cacheable and not rc(res):
+        read_cache.put(cmd, res)
+
+    return res
+
+
+def probe_stern_version():
+    version_res = subprocess_run(
+        ['stern', '--version'],
+        capture_output=True,
+        env=ENV,
+        check=True,
+        silent=True,
+    )
+    return version_res.stdout.decode('utf-8').split()[-1]
+
+
 @lru_cache(maxsize=None)
 def stern_version_challenge():
     try:
-        version_res = subprocess_run(
-            ['stern', '--version'],
-            capture_output=True,
-            env=ENV,
-            check=True,
-            silent=True,
-        )
-        version_str = version_res.stdout.decode('utf-8').split()[-1]
+        version_str = cached_tool_version('stern', probe_stern_version)
     except FileNotFoundError:
         download_stern()
         return stern_version_challenge()
@@ -1357,17 +2006,21 @@ def stern(*args, check=True, **kwargs):
     return completed
 
 
+def probe_helm_version():
+    version_res = subprocess_run(
+        ['helm', 'version', '--short'],
+        capture_output=True,
+        env=ENV,
+        check=True,
+        silent=True,
+    )
+    return version_res.stdout.decode('utf-8')
+
+
 @lru_cache(maxsize=None)
 def helm_version_challenge():
     try:
-        version_res = subprocess_run(
-            ['helm', 'version', '--short'],
-            capture_output=True,
-            env=ENV,
-            check=True,
-            silent=True,
-        )
-        version_str = version_res.stdout.decode('utf-8')
+        version_str = cached_tool_version('helm', probe_helm_version)
     except FileNotFoundError:
         download_helm()
         return helm_version_challenge()
@@ -1395,7 +2048,11 @@ def download_helm():
 def helm(*args, check=True, exit=False, **kwargs):
     helm_version_challenge()
     cmd = ['helm', *args]
-    completed = subprocess_run(cmd, env=ENV, check=check, **kwargs)
+    words = ReadCache.tell_words(cmd)
+    if words and words[0] not in READ_COMMANDS['helm'] | HARMLESS_COMMANDS['helm']:
+        forget_helm_releases()
+
+    completed = run_tool(cmd, check=check, **kwargs)
     if exit:
         context().exit(rc(completed))
 
@@ -1421,20 +2078,10 @@ def helm_delete(*args, exit=False):
 
 
 def tell_release_image(release_name, revision=None, silent=False):
-    revision_clause = [f'--revision={revision}'] if revision else []
-    res = helm(
-        'get',
-        'values',
-        release_name,
-        *revision_clause,
-        '-ojson',
-        capture_output=True,
-        check=not silent,
-    )
-    if silent and rc(res):
+    values = tell_release_values(release_name, revision=revision, check=not silent)
+    if values is None:
         return
 
-    values = jalo(res.stdout)
     image_tag = values.get('imageTag')
     if image_tag:
         ctx = context()
@@ -1523,6 +2170,8 @@ def docker_tag(old, new):
 def banyun(image, registry=None, overwrite_latest_tag=False, pull=False, exit=None):
     """搬运镜像到别人家里"""
     if registry and not isinstance(registry, str):
+        import asyncio
+
         loop = asyncio.new_event_loop()
         tasks = []
         for r in registry:
@@ -1636,6 +2285,11 @@ def asdf_global(bin, v):
             return asdf_global(bin, v)
         error(f'weird asdf error: {stderr}', exit=code)
 
+    if bin == 'kubectl':
+        # asdf shims stay the same after switching versions
+        forget_tool_version(bin)
+        kubectl_version_challenge.cache_clear()
+
     if not kubectl_version_challenge(autofix=False):
         cmd_str = ' '.join(cmd)
         error(f'kubectl version still do not match after asdf {cmd_str}')
@@ -1645,7 +2299,7 @@ def asdf_global(bin, v):
 
 def git(*args, exit=None, check=True, **kwargs):
     cmd = ['git', *args]
-    completed = subprocess_run(cmd, env=ENV, check=check, **kwargs)
+    completed = run_tool(cmd, check=check, **kwargs)
     if exit:
         context().exit(rc(completed))
 
@@ -1653,8 +2307,7 @@ def git(*args, exit=None, check=True, **kwargs):
 
 
 def git_remote(**kwargs):
-    cmd = ['git', 'remote', '-v']
-    completed = subprocess_run(cmd, env=ENV, capture_output=True, check=True, **kwargs)
+    completed = git('remote', '-v', capture_output=True, **kwargs)
     output = ensure_str(completed.stdout)
     for line in output.splitlines():
         _, url, *_ = line.split()
@@ -1662,18 +2315,95 @@ def git_remote(**kwargs):
     return ''
 
 
-def try_to_label_nodes():
-    ctx = context()
-    appname = ctx.obj['appname']
-    procs = ctx.obj['values']['procs']
+def tell_node_label_patches(node_labels, appname, procs):
+    """node labels for procs with nodes specified, as the merge patch for
+    every node that actually needs to change.
+
+    >>> node_labels = {'n1': {'dummy-web': 'true'}, 'n2': {}, 'n3': {'dummy-web': 'true'}}
+    >>> procs = {'web': {'nodes': ['n1', 'n2']}, 'worker': {}}
+    >>> tell_node_label_patches(node_labels, 'dummy', procs)
+    {'n2': {'metadata': {'labels': {'dummy-web': 'true'}}}, 'n3': {'metadata': {'labels': {'dummy-web': None}}}}
+    """
+    patches = defaultdict(dict)
     for proc_name, proc in procs.items():
         nodes = proc.get('nodes')
         if not nodes:
             continue
         label_name = f'{appname}-{proc_name}'
-        kubectl('label', 'node', '--all', f'{label_name}-', '--overwrite')
-        for node in nodes:
-            kubectl('label', 'node', f'{node}', f'{label_name}=true', '--overwrite')
+        for node, labels in node_labels.items():
+            if node in nodes:
+                if labels.get(label_name) != 'true':
+                    patches[node][label_name] = 'true'
+            elif label_name in labels:
+                patches[node][label_name] = None
+
+    return {node: {'metadata': {'labels': labels}} for node, labels in patches.items()}
+
+
+def in_current_context(func):
+    """wrap func so that it runs within the current click context, for
+    threads"""
+    ctx = context(silent=True)
+    if not ctx:
+        return func
+
+    def wrapped(*args, **kwargs):
+        push_context(ctx)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            pop_context()
+
+    return wrapped
+
+
+def parallel_map(func, iterable, max_workers=8):
+    """map, but func runs in threads, within the current click context.
+    results come in order, the first exception (ctx.exit included) is
+    raised"""
+    items = list(iterable)
+    if len(items) < 2:
+        return [func(item) for item in items]
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(items))) as executor:
+        return list(executor.map(in_current_context(func), items))
+
+
+def iter_parallel(func, iterable, max_workers=8):
+    """yields (item, future) as soon as func(item) is done, func runs in
+    threads, within the current click context. stop iterating, and pending
+    items will be cancelled"""
+    items = list(iterable)
+    if not items:
+        return
+    executor = ThreadPoolExecutor(max_workers=min(max_workers, len(items)))
+    run = in_current_context(func)
+    try:
+        futures = {executor.submit(run, item): item for item in items}
+        for future in as_completed(futures):
+            yield futures[future], future
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def try_to_label_nodes():
+    ctx = context()
+    appname = ctx.obj['appname']
+    procs = ctx.obj['values']['procs']
+    wanted_nodes = set()
+    for proc in procs.values():
+        wanted_nodes.update(proc.get('nodes') or [])
+
+    if not wanted_nodes:
+        return
+    node_labels = {
+        node['metadata']['name']: node['metadata'].get('labels') or {}
+        for node in kube_read('node')['items']
+    }
+    if missing := wanted_nodes - set(node_labels):
+        error(f'nodes not found: {", ".join(sorted(missing))}', exit=1)
+
+    patches = tell_node_label_patches(node_labels, appname, procs)
+    parallel_map(lambda node: kube_patch('node', node, patches[node]), patches)
 
 
 def tell_job_names(appname_prefix=True):
@@ -1700,13 +2430,19 @@ def try_to_cleanup_job(job_name=None):
     else:
         job_names = tell_job_names()
 
-    for jn in job_names:
-        res = kubectl('delete', 'job', jn, capture_output=True, check=False)
-        if rc(res):
-            stderr = ensure_str(res.stderr)
-            if 'not found' not in stderr:
-                error(f'weird error when deleting job {jn}:')
-                error(stderr, exit=1)
+    if not job_names:
+        return
+    res = kubectl(
+        'delete',
+        'job',
+        '--ignore-not-found',
+        *job_names,
+        capture_output=True,
+        check=False,
+    )
+    if rc(res):
+        error(f'weird error when deleting jobs {job_names}:')
+        error(ensure_str(res.stderr), exit=1)
 
 
 def fix_kubectl(cv=None, sv=None):
@@ -1719,27 +2455,40 @@ def fix_kubectl(cv=None, sv=None):
         warn('use asdf to manage kubectl: https://asdf-vm.com/')
 
 
-@lru_cache(maxsize=None)
-def kubectl_version_challenge(check=True, autofix=True):
+def probe_kubectl_version(check=True):
+    """returns client and server version string"""
+    res = subprocess_run(
+        ['kubectl', 'version', '--short'],
+        capture_output=True,
+        env=ENV,
+        silent=True,
+        check=check,
+    )
+    if rc(res):
+        err = ensure_str(res.stderr).strip()
+        error('kubectl version check failed:')
+        error(f'{err}')
+        return
+    # https://kubernetes.io/releases/version-skew-policy/#kubectl
+    # output may contain kustomize version, we need to ignore
+    cr, *_, sr = ensure_str(res.stdout).splitlines()
+    return cr.rsplit(None, 1)[-1], sr.rsplit(None, 1)[-1]
+
+
+@lru_cache(maxsize=None)
+def kubectl_version_challenge(check=True, autofix=True):
     try:
-        res = subprocess_run(
-            ['kubectl', 'version', '--short'],
-            capture_output=True,
-            env=ENV,
-            silent=True,
-            check=check,
+        versions = cached_tool_version(
+            'kubectl',
+            partial(probe_kubectl_version, check=check),
+            extra_key=tell_kubeconfig_key(),
         )
-        if rc(res):
-            err = ensure_str(res.stderr).strip()
-            error('kubectl version check failed:')
-            error(f'{err}')
+        if not versions:
             return
-        # https://kubernetes.io/releases/version-skew-policy/#kubectl
-        # output may contain kustomize version, we need to ignore
-        cr, *_, sr = ensure_str(res.stdout).splitlines()
-        cv = version.parse(cr.rsplit(None, 1)[-1])
+        cr, sr = versions
+        cv = version.parse(cr)
         # looks like v1.18.4-tke.13 / v1.20.4-aliyun.1
-        sv = version.parse(sr.rsplit(None, 1)[-1].split('-', 1)[0])
+        sv = version.parse(sr.split('-', 1)[0])
     except FileNotFoundError:
         error('kubectl not found, trying to fix...')
         fix_kubectl()
@@ -1760,24 +2509,164 @@ def kubectl(*args, exit=None, check=True, dry_run=False, **kwargs):
     kubectl_version_challenge(check=check)
     cmd = ['kubectl', *args]
     kwargs.setdefault('timeout', 20)
-    completed = subprocess_run(cmd, env=ENV, check=check, dry_run=dry_run, **kwargs)
+    completed = run_tool(cmd, check=check, dry_run=dry_run, **kwargs)
     if exit:
         context().exit(rc(completed))
 
     return completed
 
 
+def tell_kubeconfig_path():
+    from lain_cli.kube import tell_kubeconfig_path as tell_path
+
+    return tell_path(ENV.get('KUBECONFIG'))
+
+
+# api client by tell_kubeconfig_key(), None means kubectl must be used
+kube_clients = {}
+
+
+def tell_kube_client():
+    """Kubernetes api client for the current kubeconfig, returns None if this
+    kubeconfig isn't supported, or LAIN_NO_KUBE_CLIENT is set"""
+    if ENV.get('LAIN_NO_KUBE_CLIENT'):
+        return
+    from lain_cli.kube import KubeClient, KubeUnsupported
+
+    try:
+        path = tell_kubeconfig_path()
+    except KubeUnsupported as e:
+        debug(f'cannot use kubernetes api client, fallback to kubectl: {e}')
+        return
+    mtime = None
+    with suppress(OSError):
+        mtime = os.stat(path).st_mtime
+
+    # nested lain commands run in the same process and share clients, a
+    # kubeconfig rewritten in between (e.g. rotated token) must not be served
+    # by a stale client
+    key = (tell_kubeconfig_key(), mtime)
+    if key not in kube_clients:
+        try:
+            kube_clients[key] = KubeClient.from_kubeconfig(path)
+        except KubeUnsupported as e:
+            debug(f'cannot use kubernetes api client, fallback to kubectl: {e}')
+            kube_clients[key] = None
+
+    return kube_clients[key]
+
+
+def fetch_kube_object(kind, name=None, selector=None, field_selector=None, cache=True):
+    """same as kubectl get -ojson, but served by the api client when possible.
+    returns None if the named object doesn't exist, raises KubeReadError"""
+    client = tell_kube_client()
+    if client:
+        from lain_cli.kube import KubeApiError, KubeUnsupported
+
+        try:
+            return client.read(
+                kind, name=name, selector=selector, field_selector=field_selector
+            )
+        except KubeUnsupported as e:
+            debug(f'fallback to kubectl: {e}')
+        except KubeApiError as e:
+            if e.status_code == 404:
+                return
+            raise KubeReadError(f'kubernetes api error: {e}') from e
+        except RequestException as e:
+            debug(f'fallback to kubectl: {e}')
+
+    cmd = ['get', kind, '-ojson']
+    if name:
+        cmd.append(name)
+
+    if selector:
+        cmd.extend(['-l', selector])
+
+    if field_selector:
+        cmd.append(f'--field-selector={field_selector}')
+
+    res = kubectl(*cmd, capture_output=True, check=False, cache=cache)
+    if code := rc(res):
+        stderr = ensure_str(res.stderr)
+        if 'NotFound' in stderr or 'not found' in stderr:
+            return
+        raise KubeReadError(stderr, code=code)
+    return jalo(res.stdout)
+
+
+def kube_read(
+    kind, name=None, selector=None, field_selector=None, check=True, cache=True
+):
+    """fetch_kube_object, but print error, and exit if check"""
+    try:
+        return fetch_kube_object(
+            kind,
+            name=name,
+            selector=selector,
+            field_selector=field_selector,
+            cache=cache,
+        )
+    except KubeReadError as e:
+        error(str(e), exit=check and e.code)
+
+
+def kube_patch(kind, name, body):
+    """json merge patch, served by the api client when possible"""
+    client = tell_kube_client()
+    if client:
+        from lain_cli.kube import KubeApiError, KubeUnsupported
+
+        try:
+            res = client.patch(kind, name, body)
+            read_cache = tell_read_cache()
+            read_cache and read_cache.invalidate(['kubectl', 'patch', kind, name])
+            return res
+        except KubeUnsupported as e:
+            debug(f'fallback to kubectl: {e}')
+        except KubeApiError as e:
+            error(f'cannot patch {kind} {name}: {e}', exit=1)
+        except RequestException as e:
+            debug(f'fallback to kubectl: {e}')
+
+    res = kubectl(
+        'patch',
+        kind,
+        name,
+        '--type=merge',
+        '-ojson',
+        '-p',
+        jadu(body),
+        capture_output=True,
+    )
+    return jalo(res.stdout)
+
+
+def find_values(dic, key):
+    """
+    >>> list(find_values({'a': [{'exitCode': 1}, {'b': {'exitCode': 0}}]}, 'exitCode'))
+    [1, 0]
+    """
+    if isinstance(dic, dict):
+        for k, v in dic.items():
+            if k == key:
+                yield v
+            else:
+                yield from find_values(v, key)
+    elif isinstance(dic, list):
+        for item in dic:
+            yield from find_values(item, key)
+
+
 def get_pod_rc(pod_name, tries=5):
     while tries:
         tries -= 1
-        res = kubectl(
-            'get', 'po', pod_name, '-o=jsonpath={..exitCode}', capture_output=True
-        )
-        rc_str = ensure_str(res.stdout)
-        if not rc_str:
+        pod = kube_read('po', pod_name, cache=False)
+        # same as kubectl get po -o=jsonpath={..exitCode}
+        codes = list(find_values(pod, 'exitCode'))
+        if not codes:
             sleep(2)
             continue
-        codes = [int(s) for s in rc_str.split()]
         return max(codes)
 
     error(f'cannot get exitCode for {pod_name}', exit=True)
@@ -1831,21 +2720,117 @@ def wait_for_svc_up(tries=20):
 
 
 def get_youngest_pod_ages(selector=None):
-    res = kubectl(
-        'get',
-        'po',
-        '-l',
-        selector,
-        '--no-headers=true',
-        capture_output=True,
-    )
-    ages = []
-    podlines = ensure_str(res.stdout).splitlines()
-    for podline in podlines:
-        _, _, _, _, age, *_ = parse_podline(podline)
-        ages.append(parse_multi_timespan(age))
+    pods = get_pods(selector=selector, check=True, refresh=True)
+    return min(record.age for record in pods)
 
-    return min(ages)
+
+POD_BAD_STATES = frozenset(('imagepullbackoff',))
+POD_WAITING_STATES = frozenset(
+    ('pending', 'containercreating', 'notready', 'terminating')
+)
+POD_POLL_INTERVAL = 3
+# when watching, pods must stay up for this long before we call it a day,
+# because controllers may not have created the new pods yet
+POD_SETTLE_SECONDS = 0.5
+
+
+def is_pods_up(states):
+    """returns True if pods are up, False if they're still on the way, exit
+    if any of them is in bad state"""
+    if states.intersection(POD_BAD_STATES):
+        return None
+    return not states.intersection(POD_WAITING_STATES)
+
+
+def watch_for_pod_up(client, selector, timeout):
+    """wait for pods using a watch stream, returns pod names, or None if pods
+    never got up"""
+    start = perf_counter()
+    deadline = start + timeout
+    responson = client.read('pod', selector=selector)
+    pods = {p['metadata']['name']: p for p in responson['items']}
+    resource_version = responson['metadata'].get('resourceVersion')
+    events = queue.Queue()
+
+    def pump(resource_version):
+        # watch streams block, read them in the background so that we can
+        # wait on events with a timeout
+        try:
+            for event in client.watch(
+                'pod',
+                selector=selector,
+                resource_version=resource_version,
+                timeout_seconds=max(math.ceil(deadline - perf_counter()), 1),
+            ):
+                events.put(event)
+        except Exception as e:
+            events.put(('EXCEPTION', e))
+        else:
+            events.put(('CLOSED', None))
+
+    threading.Thread(target=pump, args=(resource_version,), daemon=True).start()
+    settle_deadline = None
+    while True:
+        now = perf_counter()
+        states = {name: PodRecord.from_pod(pod).state for name, pod in pods.items()}
+        up = is_pods_up(set(states.values()))
+        if up is None:
+            lines = '\n'.join(f'{name} {state}' for name, state in states.items())
+            error(f'pod in bad state:\n{lines}', exit=1)
+        wait_until = settle_deadline or deadline
+        if not pods:
+            # pods may not have been created yet, give them one poll
+            # interval, just like poll_for_pod_up does
+            grace_deadline = start + POD_POLL_INTERVAL
+            if now >= grace_deadline:
+                return []
+            up = False
+            wait_until = grace_deadline
+
+        if not up:
+            settle_deadline = None
+        elif not settle_deadline:
+            settle_deadline = wait_until = now + POD_SETTLE_SECONDS
+        elif now >= settle_deadline:
+            return list(pods)
+        if now >= deadline:
+            return
+
+        try:
+            event_type, obj = events.get(timeout=min(deadline, wait_until) - now)
+        except queue.Empty:
+            continue
+        if event_type == 'EXCEPTION':
+            raise obj
+        if event_type == 'CLOSED':
+            threading.Thread(target=pump, args=(resource_version,), daemon=True).start()
+            continue
+        resource_version = obj['metadata'].get('resourceVersion', resource_version)
+        if event_type == 'BOOKMARK':
+            continue
+        name = obj['metadata']['name']
+        debug(f'{event_type} {name} {PodRecord.from_pod(obj).status}')
+        if event_type == 'DELETED':
+            pods.pop(name, None)
+        else:
+            pods[name] = obj
+
+
+def poll_for_pod_up(selector, tries):
+    """returns pod names, or None if pods never got up"""
+    while tries:
+        tries -= 1
+        sleep(POD_POLL_INTERVAL)
+        pods = get_pods(selector=selector, refresh=True)
+        table = '\n'.join(format_pod_table(pods, headers=False))
+        up = is_pods_up({record.state for record in pods})
+        if up is None:
+            error(f'pod in bad state:\n{table}', exit=1)
+
+        if up:
+            return [record.name for record in pods]
+        debug(table)
+        continue
 
 
 def wait_for_pod_up(selector=None, tries=40):
@@ -1854,48 +2839,162 @@ def wait_for_pod_up(selector=None, tries=40):
         appname = ctx.obj['appname']
         selector = f'app.kubernetes.io/name={appname}'
 
-    bad_state = frozenset(('imagepullbackoff',))
-    waiting_state = frozenset(
-        ('pending', 'containercreating', 'notready', 'terminating')
-    )
-    while tries:
-        tries -= 1
-        sleep(3)
-        res = kubectl(
-            'get',
-            'po',
-            '-l',
-            selector,
-            '--no-headers=true',
-            capture_output=True,
-            check=False,
-        )
-        stdout = ensure_str(res.stdout)
-        pod_lines = stdout.splitlines()
-        current_states = set()
-        pod_names = []
-        for line in pod_lines:
-            debug(line)
-            pod_name, ready_pair, state, *_ = line.split()
-            state = state.lower()
-            if state == 'running':
-                n_ready, n_all = ready_pair.split('/')
-                if n_ready != n_all:
-                    state = 'notready'
-
-            current_states.add(state.lower())
-            pod_names.append(pod_name)
-
-        if current_states.intersection(bad_state):
-            error(f'pod in bad state:\n{stdout}', exit=1)
-
-        if not current_states.intersection(waiting_state):
-            return pod_names
-        debug(stdout)
-        continue
+    pod_names = None
+    client = tell_kube_client()
+    if client:
+        from lain_cli.kube import KubeApiError, KubeUnsupported
+
+        try:
+            pod_names = watch_for_pod_up(
+                client, selector, timeout=tries * POD_POLL_INTERVAL
+            )
+        except (KubeApiError, KubeUnsupported, RequestException) as e:
+            # e.g. watch is forbidden by rbac
+            debug(f'cannot watch pods, fallback to polling: {e}')
+            client = None
+
+    if not client:
+        pod_names = poll_for_pod_up(selector, tries)
+
+    if pod_names is not None:
+        return pod_names
+    pods = get_pods(selector=selector, refresh=True)
+    pod_name = pods[-1].name if pods else None
     error('job container never got up, here\'s what\'s wrong:')
-    kubectl('describe', 'po', pod_name, check=False)
-    kubectl('logs', pod_name, check=False)
+    if pod_name:
+        kubectl('describe', 'po', pod_name, check=False)
+        kubectl('logs', pod_name, check=False)
+
+
+ROLLOUT_KINDS = ('deployment', 'statefulset', 'job')
+
+
+def tell_rollout_progress(obj):
+    """returns None if this deployment / statefulset / job has converged,
+    otherwise a message describing what we're waiting for, this follows
+    kubectl rollout status
+
+    >>> deploy = {'kind': 'Deployment', 'metadata': {'name': 'dummy-web', 'generation': 2}, 'spec': {'replicas': 3}}
+    >>> deploy['status'] = {'observedGeneration': 2, 'replicas': 4, 'updatedReplicas': 2, 'readyReplicas': 3, 'availableReplicas': 3}
+    >>> tell_rollout_progress(deploy)
+    '2/3 replicas updated'
+    >>> deploy['status'].update({'updatedReplicas': 3, 'availableReplicas': 2})
+    >>> tell_rollout_progress(deploy)
+    '1 old replicas pending termination'
+    >>> deploy['status'].update({'replicas': 3, 'readyReplicas': 3, 'availableReplicas': 3})
+    >>> tell_rollout_progress(deploy)
+    >>> job = {'kind': 'Job', 'metadata': {'name': 'dummy-migrate'}, 'spec': {}, 'status': {'active': 1}}
+    >>> tell_rollout_progress(job)
+    '0/1 completed'
+    """
+    kind = obj['kind']
+    name = obj['metadata']['name']
+    spec = obj.get('spec') or {}
+    status = obj.get('status') or {}
+    conditions = {c['type']: c for c in status.get('conditions') or []}
+    if kind == 'Job':
+        if conditions.get('Complete', {}).get('status') == 'True':
+            return
+        if conditions.get('Failed', {}).get('status') == 'True':
+            # reported by wait_for_rollout
+            return
+        completions = spec.get('completions') or 1
+        return f'{status.get("succeeded") or 0}/{completions} completed'
+
+    if obj['metadata'].get('generation', 0) > status.get('observedGeneration', 0):
+        return 'waiting for rollout to be observed'
+    replicas = spec.get('replicas', 1)
+    updated = status.get('updatedReplicas') or 0
+    ready = status.get('readyReplicas') or 0
+    if kind == 'Deployment':
+        progressing = conditions.get('Progressing', {})
+        if progressing.get('reason') == 'ProgressDeadlineExceeded':
+            error(f'deployment {name} exceeded its progress deadline', exit=1)
+        available = status.get('availableReplicas') or 0
+        if updated < replicas:
+            return f'{updated}/{replicas} replicas updated'
+        if status.get('replicas', 0) > updated:
+            return f'{status["replicas"] - updated} old replicas pending termination'
+        if available < updated:
+            return f'{available}/{replicas} replicas available'
+        return
+    # StatefulSet
+    if ready < replicas:
+        return f'{ready}/{replicas} replicas ready'
+    update_strategy = spec.get('updateStrategy') or {}
+    if update_strategy.get('type', 'RollingUpdate') != 'RollingUpdate':
+        return
+    partition = (update_strategy.get('rollingUpdate') or {}).get('partition') or 0
+    if partition:
+        if updated < replicas - partition:
+            return f'{updated}/{replicas - partition} replicas updated'
+        return
+    if status.get('updateRevision') != status.get('currentRevision'):
+        return f'{updated}/{replicas} replicas updated'
+
+
+def tell_job_failure(job):
+    """message of the Failed condition, None if job hasn't failed
+
+    >>> tell_job_failure({'status': {'conditions': [{'type': 'Failed', 'status': 'True', 'message': 'BackoffLimitExceeded'}]}})
+    'BackoffLimitExceeded'
+    >>> tell_job_failure({'status': {'active': 1}})
+    """
+    for condition in (job.get('status') or {}).get('conditions') or []:
+        if condition['type'] == 'Failed' and condition.get('status') == 'True':
+            return condition.get('message') or condition.get('reason') or 'failed'
+
+
+def is_cronjob_run(job):
+    owners = job['metadata'].get('ownerReferences') or []
+    return any(owner.get('kind') == 'CronJob' for owner in owners)
+
+
+def wait_for_rollout(selector, tries=40, names=None):
+    """wait for every deployment, statefulset and job matching selector (and
+    named in names, if given) to converge, using their status rather than
+    scraping pods. returns names of the workloads, or None if they didn't
+    converge in time. an empty list means nothing matches selector"""
+    # api server lists are cheap, kubectl calls are not
+    interval = 1 if tell_kube_client() else POD_POLL_INTERVAL
+    deadline = perf_counter() + tries * POD_POLL_INTERVAL
+    reported = {}
+    failed_jobs = set()
+    while True:
+        progress = {}
+        for kind in ROLLOUT_KINDS:
+            responson = kube_read(kind, selector=selector, check=False, cache=False)
+            if not responson:
+                # e.g. service account inside helm test pods cannot list
+                # workloads
+                warn(f'cannot list {kind}, fallback to waiting for pods')
+                return []
+            for obj in responson['items']:
+                name = obj['metadata']['name']
+                if names is not None and name not in names:
+                    continue
+                if kind == 'job':
+                    # cronjob runs carry the same labels, but they come and
+                    # go on their own schedule, and aren't part of the rollout
+                    if is_cronjob_run(obj):
+                        continue
+                    failure = tell_job_failure(obj)
+                    if failure and name not in failed_jobs:
+                        failed_jobs.add(name)
+                        warn(f'job {name} failed: {failure}')
+
+                progress[name] = tell_rollout_progress(obj)
+
+        for name, message in progress.items():
+            if message and reported.get(name) != message:
+                echo(f'{name}: {message}')
+
+        reported = progress
+        if not any(progress.values()):
+            return list(progress)
+        if perf_counter() >= deadline:
+            return
+        sleep(interval)
 
 
 def wait_for_cluster_up(tries=1):
@@ -2016,22 +3115,28 @@ def edit_file(f):
     subprocess.call([ENV.get('EDITOR', 'vim'), f], env=os.environ)
 
 
-def yalo(f, many=False):
-    if hasattr(f, 'read'):
-        f.seek(0)
-        content = f.read()
+def yalo(f, many=False, round_trip=False):
+    """load yaml from file object, path or string.
 
+    Args:
+        round_trip (bool): preserve comments and formatting, use this only if
+            the result will be dumped for human editing, it's much slower.
+    """
     # tempfile buffer content could be different from the actual disk file
     if hasattr(f, 'name'):
         with open(f.name) as file_again:
             content = file_again.read()
+    elif hasattr(f, 'read'):
+        f.seek(0)
+        content = f.read()
     elif isfile(f):
         with open(f) as file_:
             content = file_.read()
     else:
         content = f
 
-    load = yaml.load_all if many else yaml.load
+    loader = yaml if round_trip else safe_yaml
+    load = loader.load_all if many else loader.load
     return load(content)
 
 
@@ -2056,6 +3161,140 @@ def jadu(dic):
     return json.dumps(dic, separators=(',', ':'))
 
 
+def file_digest(path):
+    with open(path, 'rb') as f:
+        return blake2b(f.read(), digest_size=16).hexdigest()
+
+
+def file_fingerprint(path):
+    """mtime alone is not reliable (git checkout, cp -p), so content hash is
+    included as well, meant for small config files"""
+    st = os.stat(path)
+    return (abspath(path), st.st_mtime_ns, file_digest(path))
+
+
+def tell_cache_path(name):
+    return join(CACHE_DIR, f'{name}.pickle')
+
+
+def load_cache(name, default=None):
+    """cache is merely an optimization, any failure when reading it is
+    treated as a cache miss"""
+    try:
+        with open(tell_cache_path(name), 'rb') as f:
+            return pickle.load(f)
+    except Exception:
+        return default
+
+
+def dump_cache(name, data):
+    """write to a tempfile then rename, so that concurrent lain processes
+    never see a half written cache"""
+    with suppress(OSError):
+        makedirs(CACHE_DIR, exist_ok=True)
+        fd, tmp_path = mkstemp(dir=CACHE_DIR, prefix=f'.{name}-')
+        try:
+            with fdopen(fd, 'wb') as f:
+                pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+            os.replace(tmp_path, tell_cache_path(name))
+        except Exception:
+            with suppress(OSError):
+                unlink(tmp_path)
+            raise
+
+
+def update_cache(name, key, value, max_entries=16):
+    """add an entry to a dict cache, oldest entries are dropped when there's
+    more than max_entries"""
+    with cache_lock(name):
+        cache = load_cache(name, default={})
+        if not isinstance(cache, dict):
+            cache = {}
+
+        cache[key] = value
+        while len(cache) > max_entries:
+            cache.pop(next(iter(cache)))
+
+        dump_cache(name, cache)
+
+
+@contextmanager
+def cache_lock(name):
+    """exclusive lock for read-modify-write on a cache file, shared among
+    concurrent lain processes. platforms without fcntl simply go without
+    locking, worst case is a lost cache update"""
+    try:
+        import fcntl
+    except ImportError:
+        yield
+        return
+    try:
+        makedirs(CACHE_DIR, exist_ok=True)
+        lock_file = open(join(CACHE_DIR, f'.{name}.lock'), 'a')
+    except OSError:
+        yield
+        return
+    with lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def tell_tool_fingerprint(bin):
+    """resolved binary path and its mtime, so that upgrading / switching a
+    tool naturally invalidates its cached version"""
+    path = shutil.which(bin, path=ENV.get('PATH'))
+    if not path:
+        return
+    realpath = os.path.realpath(path)
+    try:
+        return (realpath, os.stat(realpath).st_mtime_ns)
+    except OSError:
+        return
+
+
+def tell_kubeconfig_key():
+    """kubectl server version depends on which cluster we're talking to"""
+    target = None
+    with suppress(OSError):
+        target = readlink(join(KUBECONFIG_DIR, 'config'))
+
+    return (target, ENV.get('KUBECONFIG'))
+
+
+def cached_tool_version(bin, probe, extra_key=(), ttl=TOOL_VERSION_TTL):
+    """call probe() to find out version of bin, result is cached on disk and
+    shared among lain processes, until ttl expires or the binary changes.
+    None results are not cached"""
+    fingerprint = tell_tool_fingerprint(bin)
+    if not fingerprint:
+        return probe()
+    key = (bin, *fingerprint, *extra_key)
+    now = time()
+    entry = load_cache('tool_versions', default={}).get(key)
+    if entry and entry['expires_at'] > now:
+        return entry['value']
+    value = probe()
+    if value is not None:
+        with cache_lock('tool_versions'):
+            cache = load_cache('tool_versions', default={})
+            cache = {k: v for k, v in cache.items() if v['expires_at'] > now}
+            cache[key] = {'value': value, 'expires_at': now + ttl}
+            dump_cache('tool_versions', cache)
+
+    return value
+
+
+def forget_tool_version(bin):
+    with cache_lock('tool_versions'):
+        cache = load_cache('tool_versions', default={})
+        cache = {k: v for k, v in cache.items() if k[0] != bin}
+        dump_cache('tool_versions', cache)
+
+
 def jalo(s):
     """stupid json doesn't even tell you why anything fails"""
     try:
@@ -2278,6 +3517,7 @@ class ClusterConfigSchema(LenientSchema):
     extra_docs = Str()
     secrets_env = Dict(keys=Str(), values=Raw(), required=False, allow_none=True)
     hostAliases = List(Nested(HostAliasSchema), required=False)
+    registry_page_size = Int(validate=Range(min=1))
 
     @post_load
     def finalize(self, data, **kwargs):
@@ -2286,29 +3526,39 @@ class ClusterConfigSchema(LenientSchema):
 
         if self.context.get('is_current', False):
             # only read secrets env when dealing with the current cluster
-            secrets_env = data.pop('secrets_env', None) or {}
-            for dest, env in secrets_env.items():
-                # env clause can either be a str or dict
-                if isinstance(env, str):
-                    env_name = env
-                    hint = ''
-                    required = True
-                else:
-                    env_name = env['env_name']
-                    hint = env['hint']
-                    required = env.get('required', True)
-
-                if env_name in ENV:
-                    data[dest] = ENV[env_name]
-                elif required:
-                    error(
-                        f'environment variable {env_name} is missing, hint: {hint}',
-                        exit=1,
-                    )
+            resolve_secrets_env(data)
 
         return data
 
 
+def resolve_secrets_env(data, strict=True):
+    """pop secrets_env out of cluster config, and fill in the actual values
+    from environment variables. when strict, missing variables will abort the
+    command, otherwise only a warning is printed"""
+    secrets_env = data.pop('secrets_env', None) or {}
+    for dest, env in secrets_env.items():
+        # env clause can either be a str or dict
+        if isinstance(env, str):
+            env_name = env
+            hint = ''
+            required = True
+        else:
+            env_name = env['env_name']
+            hint = env['hint']
+            required = env.get('required', True)
+
+        if env_name in ENV:
+            data[dest] = ENV[env_name]
+        elif required:
+            msg = f'environment variable {env_name} is missing, hint: {hint}'
+            if strict:
+                error(msg, exit=1)
+            else:
+                warn(msg)
+
+    return data
+
+
 class HelmValuesSchema(LenientSchema):
     """app config lies in chart/values.yaml, all config can be overridden in
     chart/values.yaml or chart/values-[CLUSTER].yaml
@@ -2434,7 +3684,10 @@ def validate_proc_name(ctx, param, value):
     return value
 
 
-def update_extra_values(values, cluster=None, ignore_extra=False):
+def update_extra_values(values, cluster=None, ignore_extra=False, use_context=True):
+    """merge cluster values and extra values into values, when use_context is
+    False, ctx.obj is neither read nor written, this is for compiling cluster
+    config that doesn't belong to the current invocation"""
     internal_values_file = tell_cluster_values_file(cluster=cluster, internal=True)
     if internal_values_file:
         recursive_update(
@@ -2444,7 +3697,7 @@ def update_extra_values(values, cluster=None, ignore_extra=False):
         )
 
     cluster_values_file = tell_cluster_values_file(cluster=cluster)
-    ctx = context(silent=True)
+    ctx = context(silent=True) if use_context else None
     if cluster_values_file:
         dic = yalo(open(cluster_values_file))
         if not isinstance(dic, dict):
@@ -2479,13 +3732,11 @@ def update_extra_values(values, cluster=None, ignore_extra=False):
             ctx.obj['extra_values'] = extra_values
 
 
-def load_helm_values(values_yaml=f'./{CHART_DIR_NAME}/values.yaml'):
-    if hasattr(values_yaml, 'read'):
-        values = yalo(values_yaml)
-    else:
-        with open(values_yaml) as f:
-            values = yalo(f)
+# pickled helm values by cache key, see load_helm_values
+helm_values_memo = {}
+
 
+def compile_helm_values(values):
     update_extra_values(values)
     schema = HelmValuesSchema()
     try:
@@ -2497,6 +3748,89 @@ def load_helm_values(values_yaml=f'./{CHART_DIR_NAME}/values.yaml'):
     return loaded
 
 
+def tell_values_link_targets(paths):
+    """chart/values-[CLUSTER].yaml can be a link to any file inside the chart
+    (see update_extra_values), returns the files linked to by paths"""
+    targets = []
+    for path in paths:
+        with suppress(OSError):
+            # links are one liners, actual values files aren't worth reading
+            if os.path.getsize(path) > 1024:
+                continue
+            with open(path) as f:
+                target = f.read().strip().strip('\'"')
+            if target and '\n' not in target:
+                linked_file = join(CHART_DIR_NAME, target)
+                if isfile(linked_file):
+                    targets.append(linked_file)
+
+    return targets
+
+
+def tell_helm_values_cache_key(values_yaml, cluster, extra_values_file=None):
+    """content hash of every file that contributes to helm values"""
+    paths = [values_yaml]
+    internal_values_file = tell_cluster_values_file(cluster=cluster, internal=True)
+    if internal_values_file:
+        paths.append(internal_values_file)
+
+    chart_values_files = sorted(glob(join(CHART_DIR_NAME, '*.yaml')))
+    paths.extend(chart_values_files)
+    paths.extend(tell_values_link_targets(chart_values_files))
+    if extra_values_file:
+        paths.append(extra_values_file.name)
+
+    h = blake2b(digest_size=16)
+    h.update(f'{__version__}:{cluster}'.encode())
+    for path in paths:
+        h.update(f'{abspath(path)}:{file_digest(path)}'.encode())
+
+    return h.hexdigest()
+
+
+def load_helm_values(values_yaml=f'./{CHART_DIR_NAME}/values.yaml'):
+    """load, merge and validate helm values.
+
+    when called inside a lain command, results are cached (in process, and on
+    disk), by content hash of every contributing file, cached results are
+    pickled, so that every call gets a fresh copy to mess with"""
+    ctx = context(silent=True)
+    extra_values_file = ctx and ctx.obj.get('extra_values_file')
+    if hasattr(values_yaml, 'read'):
+        return compile_helm_values(yalo(values_yaml))
+    if not ctx or extra_values_file and not isfile(extra_values_file.name):
+        with open(values_yaml) as f:
+            return compile_helm_values(yalo(f))
+
+    key = tell_helm_values_cache_key(values_yaml, tell_cluster(), extra_values_file)
+    blob = helm_values_memo.get(key)
+    if blob is None:
+        cache = load_cache('helm_values', default={})
+        blob = cache.get(key) if isinstance(cache, dict) else None
+
+    if blob is None:
+        with open(values_yaml) as f:
+            loaded = compile_helm_values(yalo(f))
+
+        # update_extra_values records these in ctx.obj, save them as well
+        blob = pickle.dumps(
+            (loaded, ctx.obj.get('cluster_values'), ctx.obj.get('extra_values')),
+            protocol=pickle.HIGHEST_PROTOCOL,
+        )
+        update_cache('helm_values', key, blob)
+
+    helm_values_memo.clear()
+    helm_values_memo[key] = blob
+    loaded, cluster_values, extra_values = pickle.loads(blob)
+    if cluster_values is not None:
+        ctx.obj['cluster_values'] = cluster_values
+
+    if extra_values is not None:
+        ctx.obj['extra_values'] = extra_values
+
+    return loaded
+
+
 def ensure_helm_initiated():
     """gather basic information about the current app.
     If cluster info is provided, will try to fetch app status from Kubernetes"""
@@ -2513,7 +3847,13 @@ def ensure_helm_initiated():
     obj['chart_version'] = CHART_VERSION
     values_yaml = f'./{CHART_DIR_NAME}/values.yaml'
     try:
-        values = load_helm_values(values_yaml)
+        if 'pristine_values' in obj:
+            # inherited from parent lain command, see lain_invoke
+            values = deepcopy(obj['pristine_values'])
+        else:
+            values = load_helm_values(values_yaml)
+            obj['pristine_values'] = deepcopy(values)
+
         appname = obj['appname'] = values['appname']
         obj['values'] = values
         obj['secret_name'] = f'{appname}-secret'
@@ -2537,7 +3877,139 @@ def ensure_helm_initiated():
     obj['urls'] = tell_ingress_urls()
 
 
+def decode_helm_release(secret):
+    """secret data is base64 encoded, and the release inside is base64
+    encoded gzipped json, on top of that"""
+    data = base64.b64decode(base64.b64decode(secret['data']['release']))
+    if data[:2] == b'\x1f\x8b':
+        data = gzip.decompress(data)
+
+    return json.loads(data)
+
+
+def fetch_helm_releases(release_names=None, cache=True):
+    """read releases straight from helm 3 release secrets, using one list
+    request for all release_names (or every release in this namespace).
+    returns {release name: [release, ...]}, sorted by revision, or None when
+    release secrets cannot be read, callers should use helm instead.
+    decoded releases are memoized within a command, pass cache=False to
+    fetch again"""
+    driver = ENV.get('HELM_DRIVER') or 'secret'
+    if driver not in {'secret', 'secrets'}:
+        return
+    ctx = context(silent=True)
+    memo = ctx.obj.setdefault('helm_releases', {}) if ctx else {}
+    key = tuple(sorted(set(release_names))) if release_names else None
+    if cache and key in memo:
+        return memo[key]
+    memo[key] = releases = decode_helm_releases(release_names, cache=cache)
+    return releases
+
+
+def forget_helm_releases():
+    """call this after helm changed anything"""
+    ctx = context(silent=True)
+    if ctx:
+        ctx.obj.pop('helm_releases', None)
+
+
+def decode_helm_releases(release_names=None, cache=True):
+    selector = 'owner=helm'
+    if release_names:
+        selector += f',name in ({",".join(sorted(set(release_names)))})'
+
+    try:
+        responson = fetch_kube_object('secret', selector=selector, cache=cache)
+    except KubeReadError as e:
+        debug(f'cannot read helm release secrets, fallback to helm: {e}')
+        return
+    releases = defaultdict(list)
+    for secret in (responson or {}).get('items') or []:
+        if secret.get('type') != HELM_RELEASE_SECRET_TYPE:
+            continue
+        try:
+            release = decode_helm_release(secret)
+        except (KeyError, ValueError, OSError) as e:
+            debug(f'bad helm release secret {secret["metadata"]["name"]}: {e}')
+            return
+        releases[release['name']].append(release)
+
+    for history in releases.values():
+        history.sort(key=lambda r: r['version'])
+
+    return dict(releases)
+
+
+def pick_helm_release(history, revision=None):
+    """pick the latest release (or the specified revision) from
+    fetch_helm_releases results, returns None if not found"""
+    if not history:
+        return
+    if not revision:
+        return history[-1]
+    for release in history:
+        if release['version'] == int(revision):
+            return release
+
+
+def tell_release_values(release_name, revision=None, check=True):
+    """same as helm get values -ojson, returns None if release not found"""
+    releases = fetch_helm_releases([release_name])
+    if releases is not None:
+        release = pick_helm_release(releases.get(release_name), revision=revision)
+        if not release:
+            if check:
+                error(f'release {release_name} not found', exit=1)
+            return
+        return release.get('config') or {}
+    revision_clause = [f'--revision={revision}'] if revision else []
+    res = helm(
+        'get',
+        'values',
+        release_name,
+        *revision_clause,
+        '-ojson',
+        capture_output=True,
+        check=check,
+    )
+    if rc(res):
+        return
+    return jalo(res.stdout) or {}
+
+
+def helm_history(release_name):
+    """same as helm history -ojson"""
+    releases = fetch_helm_releases([release_name])
+    if releases is None:
+        res = helm('history', release_name, '-ojson', capture_output=True)
+        return jalo(res.stdout)
+    history = []
+    for release in releases.get(release_name) or []:
+        info = release['info']
+        chart_meta = (release.get('chart') or {}).get('metadata') or {}
+        history.append(
+            {
+                'revision': release['version'],
+                'updated': info.get('last_deployed'),
+                'status': info['status'],
+                'chart': f'{chart_meta.get("name")}-{chart_meta.get("version")}',
+                'app_version': chart_meta.get('appVersion', ''),
+                'description': info.get('description', ''),
+            }
+        )
+
+    if not history:
+        error(f'release {release_name} not found', exit=1)
+    return history
+
+
 def helm_status(release_name):
+    releases = fetch_helm_releases([release_name])
+    if releases is not None:
+        release = pick_helm_release(releases.get(release_name))
+        if not release or release['info']['status'] == 'uninstalled':
+            return
+        return release
     res = helm('status', release_name, '-o', 'json', capture_output=True, check=False)
     code = rc(res)
     if not code:
@@ -2575,6 +4047,39 @@ class KVPairType(click.ParamType):
             )
 
 
+class LazyGroup(click.Group):
+    """subcommands registered in lazy_subcommands are imported only when
+    invoked (or when listed by --help), so that heavy dependencies like cloud
+    SDKs won't slow down every single lain command.
+
+        lazy_subcommands={'admin': 'lain_cli.admin:admin'}
+    """
+
+    def __init__(self, *args, lazy_subcommands=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.lazy_subcommands = lazy_subcommands or {}
+
+    def list_commands(self, ctx):
+        return sorted(set(super().list_commands(ctx)) | set(self.lazy_subcommands))
+
+    def get_command(self, ctx, cmd_name):
+        if cmd_name in self.lazy_subcommands:
+            return self.load_lazy_command(cmd_name)
+        return super().get_command(ctx, cmd_name)
+
+    def load_lazy_command(self, cmd_name):
+        module_name, attr = self.lazy_subcommands[cmd_name].split(':', 1)
+        cmd = getattr(import_module(module_name), attr)
+        if not isinstance(cmd, click.Command):
+            raise ValueError(
+                f'lazy subcommand {cmd_name} is not a click command, got {cmd}'
+            )
+        # subsequent lookups no longer need to go through importlib
+        self.add_command(cmd, cmd_name)
+        del self.lazy_subcommands[cmd_name]
+        return cmd
+
+
 def is_values_file(fname):
     """
     >>> is_values_file('foo/bar/values.yaml')
@@ -2897,33 +4402,126 @@ def make_job_name(command):
     return job_name
 
 
+PYPI_SIMPLE_ACCEPT = 'application/vnd.pypi.simple.v1+json, text/html;q=0.1'
+PYPI_HTML_ANCHOR_PATTERN = re.compile(r'<a\s([^>]*)>([^<]+)</a>', re.IGNORECASE)
+VERSION_CHECK_TTL = 3600
+# the background version check thread, at most one per process
+version_check = {'thread': None}
+
+
+def tell_dist_version(filename, name=package_name):
+    """
+    >>> tell_dist_version('lain-4.11.4.tar.gz')
+    '4.11.4'
+    >>> tell_dist_version('lain-4.11.4-py3-none-any.whl')
+    '4.11.4'
+    >>> tell_dist_version('lain_cli-4.11.4.zip', name='lain-cli')
+    '4.11.4'
+    >>> tell_dist_version('lainx-4.11.4.tar.gz')
+    """
+    name_pattern = '[-_.]+'.join(re.escape(w) for w in re.split(r'[-_.]+', name))
+    m = re.match(
+        rf'(?i)^{name_pattern}-([^-]+?)(-[^-]+)*\.(tar\.gz|tar\.bz2|zip|whl)$',
+        filename,
+    )
+    if m:
+        return m.group(1)
+
+
+def parse_simple_index(content, content_type=''):
+    """parse PEP 691 (json) or PEP 503 (html) simple index response, returns
+    versions that are neither yanked nor prerelease
+
+    >>> parse_simple_index('<a href="lain-4.11.3.tar.gz#sha256=x">lain-4.11.3.tar.gz</a><a href="lain-4.12.0.tar.gz" data-yanked="">lain-4.12.0.tar.gz</a><a href="lain-5.0.0a1.tar.gz">lain-5.0.0a1.tar.gz</a>')
+    [<Version('4.11.3')>]
+    >>> parse_simple_index('{"files": [{"filename": "lain-4.11.4-py3-none-any.whl", "yanked": false}, {"filename": "lain-4.12.0.tar.gz", "yanked": "broken"}]}', 'application/vnd.pypi.simple.v1+json')
+    [<Version('4.11.4')>]
+    """
+    filenames = []
+    if 'json' in content_type:
+        for dist in jalo(content).get('files', []):
+            if not dist.get('yanked'):
+                filenames.append(dist['filename'])
+    else:
+        for attrs, text in PYPI_HTML_ANCHOR_PATTERN.findall(content):
+            if 'data-yanked' not in attrs:
+                filenames.append(text.strip())
+
+    versions = set()
+    for filename in filenames:
+        version_str = tell_dist_version(filename)
+        if not version_str:
+            continue
+        try:
+            v = version.parse(version_str)
+        except version.InvalidVersion:
+            continue
+        if not v.is_prerelease:
+            versions.add(v)
+
+    return sorted(versions)
+
+
+def lookup_latest_version(pypi_index, timeout=2):
+    url = f'{pypi_index.rstrip("/")}/{package_name}/'
+    res = requests.get(url, headers={'Accept': PYPI_SIMPLE_ACCEPT}, timeout=timeout)
+    res.raise_for_status()
+    versions = parse_simple_index(res.text, res.headers.get('Content-Type', ''))
+    if versions:
+        return str(versions[-1])
+
+
+def refresh_latest_version(pypi_index):
+    """runs in a background thread, must not print anything"""
+    try:
+        latest = lookup_latest_version(pypi_index)
+    except (RequestException, ValueError):
+        latest = None
+    with cache_lock('pypi_versions'):
+        cache = load_cache('pypi_versions', default={})
+        # failed lookups are recorded as well, or an unreachable index gets
+        # retried by every single lain command, last known version is kept
+        last_known = (cache.get(pypi_index) or {}).get('version')
+        cache[pypi_index] = {'version': latest or last_known, 'checked_at': time()}
+        dump_cache('pypi_versions', cache)
+
+
+def wait_for_version_check(timeout=1):
+    """give the background version check a chance to finish (and write its
+    cache) before the interpreter exits, but never wait for long"""
+    thread = version_check['thread']
+    if thread:
+        thread.join(timeout)
+
+
 def version_challenge():
+    """latest version is looked up in a background thread and cached on disk,
+    so lain only blocks when the cached result says it's outdated"""
     ctx = context()
     if ctx.obj['ignore_lint']:
         return
-    session = PipSession()
-    session.timeout = 2
     cc = tell_cluster_config()
     if not cc:
         return
     pypi_index = cc['pypi_index']
-    search_scope = SearchScope.create(find_links=[], index_urls=[pypi_index])
-    link_collector = LinkCollector(session=session, search_scope=search_scope)
-    selection_prefs = SelectionPreferences(
-        allow_yanked=False,
-        allow_all_prereleases=False,
-    )
-    finder = PackageFinder.create(
-        link_collector=link_collector,
-        selection_prefs=selection_prefs,
-    )
-    best_candidate = finder.find_best_candidate(package_name).best_candidate
-    debug(f'best candidate: {best_candidate}')
-    if not best_candidate:
-        warn(f'fail to lookup latest version from {pypi_index}')
+    ttl = cc.get('version_check_ttl') or VERSION_CHECK_TTL
+    if isinstance(ttl, str):
+        ttl = parse_timespan(ttl)
+
+    cached = load_cache('pypi_versions', default={}).get(pypi_index)
+    if not cached or time() - cached['checked_at'] > ttl:
+        if not version_check['thread']:
+            version_check['thread'] = thread = threading.Thread(
+                target=refresh_latest_version, args=(pypi_index,), daemon=True
+            )
+            thread.start()
+            atexit.register(wait_for_version_check)
+
+    debug(f'cached latest version: {cached}')
+    if not cached or not cached['version']:
         return
     now = version.parse(__version__)
-    new = best_candidate.version
+    new = version.parse(cached['version'])
     if any([now.major > new.major, now.minor > new.minor]):
         return
     if not all(
@@ -2943,8 +4541,7 @@ def version_challenge():
 
 def user_challenge(release_name):
     """用户必须与 helm values 记载的 user 匹配, 才能继续"""
-    res = helm('get', 'values', release_name, '-ojson', capture_output=True)
-    values = jalo(res.stdout)
+    values = tell_release_values(release_name)
     written_user = values.get('user')
     if not written_user:
         return
@@ -3052,54 +4649,179 @@ def tell_cluster_config(cluster=None, is_current=None):
         if ctx:
             ctx.obj['cluster_config'] = cc
 
-        host_aliases = cc.get('hostAliases', []) or []
-        if host_aliases:
-            hosts_dic = get_hosts_dict()
-            for h in host_aliases:
-                ip = h['ip']
-                existing_names = hosts_dic[ip]
-                for name in h['hostnames']:
-                    if name not in existing_names:
-                        error(f'you should add this to /etc/hosts: {ip} {name}')
+        check_host_aliases(cc)
 
     return cc
 
 
-def tell_all_clusters():
-    ccs = {}
+def check_host_aliases(cc):
+    host_aliases = cc.get('hostAliases', []) or []
+    if host_aliases:
+        hosts_dic = get_hosts_dict()
+        for h in host_aliases:
+            ip = h['ip']
+            existing_names = hosts_dic[ip]
+            for name in h['hostnames']:
+                if name not in existing_names:
+                    error(f'you should add this to /etc/hosts: {ip} {name}')
+
+
+def compile_cluster_config(cluster):
+    """cluster config without secrets_env resolved, safe to be cached on disk,
+    use ClusterRegistry (a.k.a. CLUSTERS) instead of calling this directly"""
+    values_file = tell_cluster_values_file(cluster=cluster, internal=True)
+    if not values_file:
+        return {}
+    data = yalo(open(values_file))
+    # cluster values can be overriden in values.yaml
+    update_extra_values(data, cluster=cluster, ignore_extra=True, use_context=False)
+    schema = ClusterConfigSchema(context={'is_current': False})
+    try:
+        return schema.load(data)
+    except ValidationError as e:
+        error(f'cluster config of {cluster} did not pass schema check:')
+        error(e, exit=1)
+
+
+def tell_wanted_cluster():
     argv = sys.argv
-    wanted_cluster = None
     if len(argv) == 3 and argv[1] == 'use' and argv[0].rsplit('/', 1)[-1] == 'lain':
-        wanted_cluster = argv[-1]
-    else:
-        with suppress(OSError):
-            wanted_cluster = tell_cluster()
+        return argv[-1]
+    with suppress(OSError):
+        return tell_cluster()
 
-    for f in glob(join(KUBECONFIG_DIR, '*')):
-        if not isfile(f):
-            continue
-        fname = basename(f)
-        if not fname.startswith('kubeconfig-'):
-            continue
-        cluster_name = fname.split('-', 1)[-1]
-        is_current = cluster_name == wanted_cluster
-        cc = tell_cluster_config(cluster_name, is_current=is_current)
-        if not cc:
-            continue
-        ccs[cluster_name] = cc
 
-    if not ccs:
-        error('no cluster values found at all, you should first set things up')
+class ClusterRegistry(Mapping):
+    """all clusters that has both kubeconfig and cluster values file.
+
+    cluster config is compiled on first access, and cached on disk, cache key
+    consists of mtime and content hash of every kubeconfig file and cluster
+    values file (including the ones inside the app chart), so any change to
+    these files will trigger a recompile. secrets_env is never cached, and
+    only resolved for the current cluster"""
+
+    cache_name = 'clusters'
+    max_cache_entries = 16
 
-    for f in glob(join(CLUSTER_VALUES_DIR, 'values-*')):
-        fname = basename(f)
-        cluster_name = fname.split('-', 1)[-1].split('.', 1)[0]
-        if cluster_name not in ccs:
+    def __init__(self):
+        # compiled config by cache key, survives reset(), which is what a
+        # long running process (lain daemon) does before serving a command
+        self._memo = {}
+        self.reset()
+
+    def reset(self):
+        self._names = None
+        self._compiled = None
+        self._wanted = None
+        self._resolved = {}
+
+    @staticmethod
+    def cluster_name_from_path(path):
+        fname = basename(path)
+        return fname.split('-', 1)[-1].split('.', 1)[0]
+
+    def scan(self):
+        kubeconfig_clusters = {
+            basename(f).split('-', 1)[-1]
+            for f in glob(join(KUBECONFIG_DIR, 'kubeconfig-*'))
+            if isfile(f)
+        }
+        values_clusters = {
+            self.cluster_name_from_path(f)
+            for f in glob(join(CLUSTER_VALUES_DIR, 'values-*'))
+        }
+        names = []
+        for cluster in sorted(kubeconfig_clusters):
+            if tell_cluster_values_file(cluster=cluster, internal=True):
+                names.append(cluster)
+            else:
+                warn(
+                    f'cluster values not found for {cluster} inside {CLUSTER_VALUES_DIR}'
+                )
+
+        if not names:
+            error('no cluster values found at all, you should first set things up')
+
+        for cluster in sorted(values_clusters - kubeconfig_clusters):
             warn(
-                f'~/.kube/kubeconfig-{cluster_name} not found, you should get it from your system administrator'
+                f'~/.kube/kubeconfig-{cluster} not found, you should get it from your system administrator'
             )
 
-    return ccs
+        return names
+
+    @property
+    def names(self):
+        if self._names is None:
+            self._names = self.scan()
+        return self._names
+
+    def tell_cache_key(self):
+        paths = [join(KUBECONFIG_DIR, f'kubeconfig-{c}') for c in self.names]
+        paths.extend(glob(join(CLUSTER_VALUES_DIR, 'values-*')))
+        # app can override cluster config in chart/values-[CLUSTER].yaml,
+        # which in turn can be a link to other files inside the chart
+        chart_values_files = glob(join(CHART_DIR_NAME, '*.yaml'))
+        paths.extend(chart_values_files)
+        paths.extend(tell_values_link_targets(chart_values_files))
+        h = blake2b(digest_size=16)
+        h.update(__version__.encode())
+        for path in sorted(paths):
+            with suppress(OSError):
+                h.update(repr(file_fingerprint(path)).encode())
+
+        return h.hexdigest()
+
+    @property
+    def wanted(self):
+        if self._wanted is None:
+            self._wanted = tell_wanted_cluster() or ''
+        return self._wanted
+
+    @property
+    def compiled(self):
+        if self._compiled is not None:
+            return self._compiled
+        key = self.tell_cache_key()
+        compiled = self._memo.get(key)
+        if compiled is None:
+            cache = load_cache(self.cache_name, default={})
+            compiled = cache.get(key) if isinstance(cache, dict) else None
+
+        if compiled is None:
+            compiled = {c: compile_cluster_config(c) for c in self.names}
+            update_cache(
+                self.cache_name, key, compiled, max_entries=self.max_cache_entries
+            )
+
+        self._memo = {key: compiled}
+        self._compiled = compiled
+        return compiled
+
+    def __getitem__(self, cluster):
+        if cluster not in self.names:
+            raise KeyError(cluster)
+        if cluster in self._resolved:
+            return self._resolved[cluster]
+        cc = self.compiled[cluster]
+        if cluster == self.wanted:
+            cc = resolve_secrets_env(deepcopy(cc), strict=False)
+            check_host_aliases(cc)
+            self._resolved[cluster] = cc
+
+        return cc
+
+    def __contains__(self, cluster):
+        return cluster in self.names
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __len__(self):
+        return len(self.names)
+
+
+def tell_all_clusters():
+    return dict(ClusterRegistry())
 
 
 def lain_docs(path):
@@ -3111,4 +4833,4 @@ def lain_docs(path):
     return url
 
 
-CLUSTERS = tell_all_clusters()
+CLUSTERS = ClusterRegistry()
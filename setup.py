@@ -6,7 +6,6 @@ from setuptools import find_packages, setup
 from lain_cli import __version__, package_name
 
 requirements = [
-    'pip>=22.2',
     'ruamel.yaml>=0.17.10',
     'requests',
     'humanfriendly>=4.16.1',
@@ -49,7 +48,7 @@ setup(
     version=__version__,
     packages=find_packages(),
     include_package_data=True,
-    entry_points={'console_scripts': ['lain=lain_cli.lain:main']},
+    entry_points={'console_scripts': ['lain=lain_cli.client:main']},
     install_requires=requirements,
     zip_safe=False,
     extras_require={
@@ -1,3 +1,4 @@
+import os
 import sys
 import traceback
 from os import chdir, environ, getcwd
@@ -250,6 +251,34 @@ def registry(request):
     return tell_registry_client(cc)
 
 
+STUB_KUBECTL = '''#!/bin/sh
+echo "Client Version: v1.20.4"
+echo "Server Version: v1.20.4"
+'''
+STUB_HELM = '''#!/bin/sh
+case "$1" in
+    version) echo "v3.9.0" ;;
+    get) echo '{"appname": "dummy"}' ;;
+esac
+'''
+
+
+@pytest.fixture()
+def stub_bin(tmp_path):
+    """stub kubectl / helm on PATH, for tests that must not touch a real
+    cluster"""
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    for name, script in [('kubectl', STUB_KUBECTL), ('helm', STUB_HELM)]:
+        path = bin_dir / name
+        path.write_text(script)
+        path.chmod(0o755)
+
+    env = environ.copy()
+    env['PATH'] = os.pathsep.join([str(bin_dir), env['PATH']])
+    return env
+
+
 def dic_contains(big, small):
     left = big.copy()
     left.update(small)
@@ -1,3 +1,5 @@
+import subprocess
+import sys
 from os.path import isfile, join
 
 import pytest
@@ -67,3 +69,23 @@ def test_lain_save():
 def exists_and_delete(path):
     assert isfile(path)
     ensure_absent(path)
+
+
+def test_lain_import_time():
+    """plain commands shouldn't pay for cloud SDKs or the prompt app, these are
+    imported only when the corresponding subcommands are invoked"""
+    res = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-m', 'lain_cli.lain', 'version'],
+        capture_output=True,
+        text=True,
+        check=False,
+    )
+    imported = {
+        line.rsplit('|', 1)[-1].strip()
+        for line in res.stderr.splitlines()
+        if line.startswith('import time:')
+    }
+    assert 'lain_cli.utils' in imported
+    heavy_modules = ('tencentcloud', 'aliyunsdkcore', 'gitlab', 'prompt_toolkit')
+    for mod in imported:
+        assert not mod.startswith(heavy_modules), f'{mod} imported by lain version'
@@ -0,0 +1,73 @@
+import socket
+import subprocess
+import sys
+from os.path import exists
+from time import sleep
+
+import pytest
+
+from lain_cli.client import run_in_daemon
+from tests.conftest import DUMMY_REPO
+
+
+@pytest.fixture()
+def lain_daemon(stub_bin, tmp_path):
+    socket_path = str(tmp_path / 'lain.sock')
+    env = dict(stub_bin, LAIN_DAEMON_SOCKET=socket_path)
+    proc = subprocess.Popen(
+        [sys.executable, '-m', 'lain_cli.lain', 'daemon', '--idle-timeout', '1m'],
+        env=env,
+    )
+    for _ in range(100):
+        if exists(socket_path):
+            break
+        sleep(0.1)
+
+    yield env
+    proc.terminate()
+    proc.wait()
+
+
+def lain_client(*args, env=None):
+    return subprocess.run(
+        [sys.executable, '-m', 'lain_cli.client', *args],
+        env=env,
+        cwd=DUMMY_REPO,
+        capture_output=True,
+        check=False,
+    )
+
+
+def test_lain_daemon(lain_daemon):
+    res = lain_client('--ignore-lint', 'get-values', 'dummy', env=lain_daemon)
+    assert res.returncode == 0
+    # output of the stub helm is written directly to our stdout
+    assert b'"appname": "dummy"' in res.stdout
+    res = lain_client('no-such-command', env=lain_daemon)
+    assert res.returncode == 2
+    assert b'No such command' in res.stderr
+
+
+def test_lain_daemon_absent(stub_bin, tmp_path):
+    assert run_in_daemon(['version'], path=str(tmp_path / 'nowhere.sock')) is None
+    env = dict(stub_bin, LAIN_DAEMON_SOCKET=str(tmp_path / 'nowhere.sock'))
+    res = lain_client('--ignore-lint', 'get-values', 'dummy', env=env)
+    assert res.returncode == 0
+    assert b'"appname": "dummy"' in res.stdout
+
+
+def test_lain_daemon_untrusted_socket(tmp_path):
+    # anyone could have planted a socket inside a shared directory
+    shared_dir = tmp_path / 'shared'
+    shared_dir.mkdir()
+    shared_dir.chmod(0o777)
+    socket_path = str(shared_dir / 'lain.sock')
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(socket_path)
+    server.listen(1)
+    server.settimeout(0.1)
+    with server:
+        assert run_in_daemon(['version'], path=socket_path) is None
+        # we didn't even connect
+        with pytest.raises(socket.timeout):
+            server.accept()
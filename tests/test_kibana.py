@@ -0,0 +1,89 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import click
+import pytest
+from humanfriendly import parse_timespan
+
+from lain_cli.kibana import Kibana
+
+
+class FakeKibanaHandler(BaseHTTPRequestHandler):
+    """stub of /internal/search/es, the first reply says the search is still
+    running, the next one has the aggregation, unless server.never_finish
+    is set"""
+
+    def do_POST(self):
+        length = int(self.headers['Content-Length'])
+        body = json.loads(self.rfile.read(length))
+        self.server.requests.append((self.path, body))
+        if 'id' in body and self.server.never_finish:
+            responson = {'id': body['id'], 'isRunning': True, 'loaded': 0, 'total': 1}
+        elif 'id' in body:
+            buckets = {host: {'doc_count': 42} for host in self.server.hosts}
+            responson = {
+                'id': body['id'],
+                'isRunning': False,
+                'loaded': 1,
+                'total': 1,
+                'rawResponse': {'aggregations': {'hosts': {'buckets': buckets}}},
+            }
+        else:
+            self.server.hosts = list(
+                body['params']['body']['aggs']['hosts']['filters']['filters']
+            )
+            responson = {'id': 'search-id', 'isRunning': True, 'loaded': 0, 'total': 1}
+
+        payload = json.dumps(responson).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture()
+def kibana(mocker):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeKibanaHandler)
+    server.requests = []
+    server.never_finish = False
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    host, port = server.server_address
+    mocker.patch(
+        'lain_cli.kibana.tell_cluster_config', return_value={'kibana': f'{host}:{port}'}
+    )
+    yield server, Kibana()
+    server.shutdown()
+
+
+def test_count_records_for_hosts(kibana):
+    server, client = kibana
+    hosts = ['dummy.example.com', 'dummy-dev.example.com']
+    counts = client.count_records_for_hosts(hosts, ingress_class='lain-external')
+    assert counts == {host: 42 for host in hosts}
+    # one search, then one more request for its results, no hits wanted
+    assert len(server.requests) == 2
+    path, body = server.requests[0]
+    assert path == '/internal/search/es'
+    assert body['params']['body']['size'] == 0
+    assert body['params']['index'] == 'nginx-external-*'
+    # kibana must answer before the http request times out
+    wait = body['params']['wait_for_completion_timeout']
+    assert parse_timespan(wait) < client.timeout
+    assert server.requests[1][1]['id'] == 'search-id'
+    assert client.count_records_for_host('dummy.example.com') == 42
+
+
+def test_count_records_unfinished_search(kibana):
+    server, client = kibana
+    server.never_finish = True
+    # rather than taking every host as unused
+    with click.Context(click.Command('list-unused-ingress'), obj={}):
+        with pytest.raises(click.exceptions.Exit):
+            client.count_records_for_hosts(['dummy.example.com'])
+
+    assert len(server.requests) == 4
@@ -0,0 +1,521 @@
+import json
+import threading
+from copy import deepcopy
+from os.path import dirname, join
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import perf_counter, sleep
+
+import click
+import pytest
+
+import lain_cli.utils
+from lain_cli.kube import KubeApiError, KubeClient, KubeUnsupported
+from lain_cli.logs import LogMultiplexer
+from lain_cli.utils import (
+    POD_POLL_INTERVAL,
+    rollout_restart,
+    fetch_helm_releases,
+    helm_history,
+    helm_status,
+    tell_release_values,
+    try_to_label_nodes,
+    wait_for_pod_up,
+    wait_for_rollout,
+    yadu,
+)
+
+TOKEN = 'dummy-token'
+POD = {
+    'kind': 'Pod',
+    'apiVersion': 'v1',
+    'metadata': {'name': 'dummy-web-abcde', 'labels': {'app': 'dummy'}},
+    'status': {'phase': 'Running'},
+}
+# release secrets the way helm 3 stores them, three revisions of the dummy
+# release, the last one being a rollback to the first
+with open(join(dirname(__file__), 'helm_release_secrets.json')) as f:
+    HELM_RELEASE_SECRETS = json.load(f)
+
+
+class FakeApiHandler(BaseHTTPRequestHandler):
+    """serves a single pod in the default namespace, and records every
+    request it gets. pod watch streams send server.watch_events, which are
+    (delay, event) pairs, or the next of server.watch_rounds, if set"""
+
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def reply(self, code, body):
+        payload = json.dumps(body).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def write_chunk(self, data):
+        self.wfile.write(f'{len(data):x}\r\n'.encode() + data + b'\r\n')
+
+    def stream_watch(self):
+        if self.server.watch_forbidden:
+            self.reply(
+                403,
+                {'kind': 'Status', 'reason': 'Forbidden', 'message': 'forbidden'},
+            )
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        events = self.server.watch_events
+        if self.server.watch_rounds:
+            events = self.server.watch_rounds.pop(0)
+        for delay, event in events:
+            sleep(delay)
+            self.write_chunk(json.dumps(event).encode('utf-8') + b'\n')
+
+        self.write_chunk(b'')
+
+    def stream_logs(self, pod_name):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        for line in self.server.logs.get(pod_name, []):
+            self.write_chunk(f'{line}\n'.encode('utf-8'))
+
+        self.write_chunk(b'')
+
+    def record(self, body=None):
+        self.server.requests.append(
+            {
+                'method': self.command,
+                'path': self.path,
+                'headers': dict(self.headers),
+                'body': body,
+            }
+        )
+
+    def do_GET(self):
+        self.record()
+        path = self.path.split('?')[0]
+        if path == '/api/v1/namespaces/default/pods':
+            if 'watch=true' in self.path:
+                self.stream_watch()
+                return
+            self.reply(
+                200,
+                {
+                    'kind': 'PodList',
+                    'apiVersion': 'v1',
+                    'metadata': {'resourceVersion': '1'},
+                    'items': [
+                        p for p in [self.server.pod, *self.server.extra_pods] if p
+                    ],
+                },
+            )
+        elif path in self.server.lists:
+            kind, items = self.server.lists[path]
+            self.reply(
+                200, {'kind': f'{kind}List', 'metadata': {}, 'items': items.pop(0)}
+            )
+        elif path.endswith('/log'):
+            self.stream_logs(path.split('/')[-2])
+        elif path == f'/api/v1/namespaces/default/pods/{POD["metadata"]["name"]}':
+            self.reply(200, self.server.pod)
+        elif path.startswith('/api/v1/'):
+            self.reply(
+                404,
+                {'kind': 'Status', 'reason': 'NotFound', 'message': 'not found'},
+            )
+        else:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+    def do_PATCH(self):
+        length = int(self.headers['Content-Length'])
+        body = json.loads(self.rfile.read(length))
+        self.record(body)
+        self.reply(200, body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture()
+def kube_api(tmp_path):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeApiHandler)
+    server.requests = []
+    server.pod = POD
+    server.extra_pods = []
+    # pod name: log lines
+    server.logs = {}
+    server.watch_events = []
+    server.watch_rounds = []
+    server.watch_forbidden = False
+    # path: (kind, list of items, one for each request)
+    server.lists = {}
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    host, port = server.server_address
+    kubeconfig = {
+        'apiVersion': 'v1',
+        'kind': 'Config',
+        'current-context': 'dummy',
+        'contexts': [{'name': 'dummy', 'context': {'cluster': 'c', 'user': 'u'}}],
+        'clusters': [{'name': 'c', 'cluster': {'server': f'http://{host}:{port}'}}],
+        'users': [{'name': 'u', 'user': {'token': TOKEN}}],
+    }
+    path = tmp_path / 'kubeconfig'
+    path.write_text(yadu(kubeconfig))
+    yield server, kubeconfig, str(path)
+    server.shutdown()
+
+
+def test_kube_client(kube_api):
+    server, _, path = kube_api
+    client = KubeClient.from_kubeconfig(path)
+    pod_name = POD['metadata']['name']
+    assert client.read('po', pod_name) == POD
+    pods = client.read(
+        'pods', selector='app=dummy', field_selector='status.phase==Running'
+    )
+    assert pods['items'][0]['metadata']['name'] == pod_name
+    req = server.requests[-1]
+    assert 'labelSelector=app%3Ddummy' in req['path']
+    assert 'fieldSelector=status.phase%3D%3DRunning' in req['path']
+    assert req['headers']['Authorization'] == f'Bearer {TOKEN}'
+    with pytest.raises(KubeApiError) as e:
+        client.read('secret', 'dummy-env')
+
+    assert e.value.status_code == 404
+    # not served by the api server, callers should use kubectl
+    with pytest.raises(KubeUnsupported):
+        client.read('ing')
+
+    patch = {'metadata': {'annotations': {'foo': None}}}
+    assert client.patch('ing', 'dummy', patch) == patch
+    req = server.requests[-1]
+    assert (
+        req['path'] == '/apis/networking.k8s.io/v1/namespaces/default/ingresses/dummy'
+    )
+    assert req['headers']['Content-Type'] == 'application/merge-patch+json'
+    assert req['body'] == patch
+
+
+def test_kube_client_unsupported(kube_api, tmp_path):
+    _, kubeconfig, _ = kube_api
+    kubeconfig['users'][0]['user'] = {'exec': {'command': 'aws'}}
+    path = tmp_path / 'exec-kubeconfig'
+    path.write_text(yadu(kubeconfig))
+    with pytest.raises(KubeUnsupported):
+        KubeClient.from_kubeconfig(str(path))
+
+    with pytest.raises(KubeUnsupported):
+        KubeClient.from_kubeconfig(str(tmp_path / 'nonexistent'))
+
+
+def test_wait_for_pod_up(kube_api, mocker):
+    server, _, path = kube_api
+    mocker.patch.dict(lain_cli.utils.ENV, {'KUBECONFIG': path})
+    pending = deepcopy(POD)
+    pending['metadata']['resourceVersion'] = '1'
+    pending['spec'] = {'containers': [{'name': 'web'}]}
+    pending['status'] = {
+        'phase': 'Pending',
+        'containerStatuses': [
+            {'ready': False, 'state': {'waiting': {'reason': 'ContainerCreating'}}}
+        ],
+    }
+    running = deepcopy(pending)
+    running['metadata']['resourceVersion'] = '2'
+    running['status'] = {
+        'phase': 'Running',
+        'containerStatuses': [{'ready': True, 'state': {'running': {}}}],
+    }
+    server.pod = pending
+    delay = 0.3
+    server.watch_events = [(delay, {'type': 'MODIFIED', 'object': running})]
+    start = perf_counter()
+    assert wait_for_pod_up(selector='app=dummy', tries=5) == [POD['metadata']['name']]
+    # reacts to the pod getting ready right away, rather than polling
+    reaction = perf_counter() - start - delay
+    assert reaction < 1 < POD_POLL_INTERVAL
+    watch_req = next(r for r in server.requests if 'watch=true' in r['path'])
+    assert 'resourceVersion=1' in watch_req['path']
+
+    # fallback to polling when watch isn't allowed
+    server.watch_forbidden = True
+    poll = mocker.patch(
+        'lain_cli.utils.poll_for_pod_up', return_value=['dummy-web-abcde']
+    )
+    assert wait_for_pod_up(selector='app=dummy', tries=5) == ['dummy-web-abcde']
+    poll.assert_called_once_with('app=dummy', 5)
+
+
+def test_wait_for_pod_up_no_pods(kube_api, mocker):
+    server, _, path = kube_api
+    mocker.patch.dict(lain_cli.utils.ENV, {'KUBECONFIG': path})
+    server.pod = None
+    bookmark = {'type': 'BOOKMARK', 'object': {'metadata': {'resourceVersion': '2'}}}
+    server.watch_events = [(POD_POLL_INTERVAL * 2, bookmark)]
+    start = perf_counter()
+    assert wait_for_pod_up(selector='app=nothing', tries=40) == []
+    # pods get one poll interval to show up, rather than the whole timeout
+    assert perf_counter() - start < POD_POLL_INTERVAL + 1
+
+
+def test_wait_for_rollout(kube_api, mocker):
+    server, _, path = kube_api
+    mocker.patch.dict(lain_cli.utils.ENV, {'KUBECONFIG': path})
+    mocker.patch('lain_cli.utils.sleep')
+    deploy = {
+        'metadata': {'name': 'dummy-web', 'generation': 2},
+        'spec': {'replicas': 2},
+        'status': {
+            'observedGeneration': 2,
+            'replicas': 3,
+            'updatedReplicas': 1,
+            'readyReplicas': 2,
+            'availableReplicas': 2,
+        },
+    }
+    converged = deepcopy(deploy)
+    converged['status'].update(
+        {'replicas': 2, 'updatedReplicas': 2, 'availableReplicas': 2}
+    )
+    job = {
+        'metadata': {'name': 'dummy-migrate'},
+        'spec': {},
+        'status': {'conditions': [{'type': 'Complete', 'status': 'True'}]},
+    }
+    failed_job = {
+        'metadata': {'name': 'dummy-init'},
+        'spec': {},
+        'status': {
+            'conditions': [
+                {'type': 'Failed', 'status': 'True', 'message': 'BackoffLimitExceeded'}
+            ]
+        },
+    }
+    # runs of a cronjob of the same app are not waited for
+    cronjob_run = {
+        'metadata': {
+            'name': 'dummy-backup-27000000',
+            'ownerReferences': [{'kind': 'CronJob', 'name': 'dummy-backup'}],
+        },
+        'spec': {},
+        'status': {'active': 1},
+    }
+    jobs = [job, failed_job, cronjob_run]
+    server.lists = {
+        '/apis/apps/v1/namespaces/default/deployments': (
+            'Deployment',
+            [[deploy], [converged]],
+        ),
+        '/apis/apps/v1/namespaces/default/statefulsets': ('StatefulSet', [[], []]),
+        '/apis/batch/v1/namespaces/default/jobs': ('Job', [jobs, jobs]),
+    }
+    warn = mocker.patch('lain_cli.utils.warn')
+    assert wait_for_rollout('app.kubernetes.io/name=dummy', tries=2) == [
+        'dummy-web',
+        'dummy-migrate',
+        'dummy-init',
+    ]
+    # exactly one list per kind, every round
+    assert all(not items for _, items in server.lists.values())
+    # failed jobs are reported once, rather than every round
+    warn.assert_called_once_with('job dummy-init failed: BackoffLimitExceeded')
+
+
+def test_helm_releases(kube_api, mocker):
+    server, _, path = kube_api
+    mocker.patch.dict(lain_cli.utils.ENV, {'KUBECONFIG': path})
+    helm = mocker.patch('lain_cli.utils.helm')
+    secrets_path = '/api/v1/namespaces/default/secrets'
+    server.lists = {secrets_path: ('Secret', [HELM_RELEASE_SECRETS] * 4 + [[]])}
+    releases = fetch_helm_releases(['dummy'])
+    assert [r['version'] for r in releases['dummy']] == [1, 2, 3]
+    req = server.requests[-1]
+    assert 'labelSelector=owner%3Dhelm%2Cname+in+%28dummy%29' in req['path']
+    status = helm_status('dummy')
+    assert status['info']['status'] == 'deployed'
+    assert status['version'] == 3
+    assert tell_release_values('dummy', revision=2)['imageTag'].endswith('b' * 40)
+    history = helm_history('dummy')
+    assert [h['status'] for h in history] == ['superseded', 'superseded', 'deployed']
+    assert history[-1]['description'] == 'Rollback to 1'
+    assert history[0]['chart'] == 'dummy-0.1.11'
+    # no release secrets, release not found
+    assert helm_status('dummy') is None
+    # not a single helm process
+    helm.assert_not_called()
+
+
+def test_helm_releases_memo(kube_api, mocker):
+    server, _, path = kube_api
+    mocker.patch.dict(lain_cli.utils.ENV, {'KUBECONFIG': path})
+    mocker.patch('lain_cli.utils.helm_version_challenge')
+    run_tool = mocker.patch('lain_cli.utils.run_tool')
+    secrets_path = '/api/v1/namespaces/default/secrets'
+    server.lists = {secrets_path: ('Secret', [HELM_RELEASE_SECRETS] * 2)}
+    with click.Context(click.Command('deploy'), obj={}):
+        assert helm_status('dummy')['version'] == 3
+        assert len(helm_history('dummy')) == 3
+        # helm reads leave the decoded releases alone
+        lain_cli.utils.helm('status', 'dummy')
+        assert fetch_helm_releases(['dummy'])['dummy'][-1]['version'] == 3
+        assert len(server.requests) == 1
+        lain_cli.utils.helm('upgrade', 'dummy', './chart')
+        assert helm_status('dummy')['version'] == 3
+        assert len(server.requests) == 2
+        assert run_tool.call_count == 2
+
+
+def test_try_to_label_nodes(kube_api, mocker):
+    server, _, path = kube_api
+    mocker.patch.dict(lain_cli.utils.ENV, {'KUBECONFIG': path})
+    nodes = [
+        {'metadata': {'name': 'node-1', 'labels': {'dummy-web': 'true'}}},
+        {'metadata': {'name': 'node-2', 'labels': {}}},
+        {'metadata': {'name': 'node-3', 'labels': {'dummy-web': 'true'}}},
+        {'metadata': {'name': 'node-4'}},
+    ]
+    server.lists = {'/api/v1/nodes': ('Node', [nodes])}
+    procs = {'web': {'nodes': ['node-1', 'node-2']}, 'worker': {}}
+    obj = {'appname': 'dummy', 'values': {'procs': procs}}
+    with click.Context(click.Command('deploy'), obj=obj):
+        try_to_label_nodes()
+
+    patches = {
+        r['path']: r['body']['metadata']['labels']
+        for r in server.requests
+        if r['method'] == 'PATCH'
+    }
+    # node-1 is already labelled, node-4 never was
+    assert patches == {
+        '/api/v1/nodes/node-2': {'dummy-web': 'true'},
+        '/api/v1/nodes/node-3': {'dummy-web': None},
+    }
+
+
+def test_rollout_restart(kube_api, mocker):
+    server, _, path = kube_api
+    mocker.patch.dict(lain_cli.utils.ENV, {'KUBECONFIG': path})
+    mocker.patch('lain_cli.utils.sleep')
+
+    def deploy(proc):
+        return {
+            'metadata': {'name': f'dummy-{proc}', 'generation': 1},
+            'spec': {
+                'replicas': 1,
+                'template': {
+                    'metadata': {
+                        'labels': {'app.kubernetes.io/instance': f'dummy-{proc}'}
+                    }
+                },
+            },
+            'status': {
+                'observedGeneration': 1,
+                'replicas': 1,
+                'updatedReplicas': 1,
+                'readyReplicas': 1,
+                'availableReplicas': 1,
+            },
+        }
+
+    deploys = [deploy('web'), deploy('worker')]
+    server.lists = {
+        '/apis/apps/v1/namespaces/default/deployments': ('Deployment', [deploys] * 2),
+        '/apis/apps/v1/namespaces/default/statefulsets': ('StatefulSet', [[]] * 2),
+        '/apis/batch/v1/namespaces/default/jobs': ('Job', [[]]),
+    }
+    rollout_restart('app.kubernetes.io/instance=dummy-web')
+    patches = [r for r in server.requests if r['method'] == 'PATCH']
+    assert [r['path'] for r in patches] == [
+        '/apis/apps/v1/namespaces/default/deployments/dummy-web'
+    ]
+    annotations = patches[0]['body']['spec']['template']['metadata']['annotations']
+    assert 'kubectl.kubernetes.io/restartedAt' in annotations
+
+
+def running_pod(name, containers=('web',), uid=None):
+    pod = deepcopy(POD)
+    pod['metadata']['name'] = name
+    pod['metadata']['uid'] = uid or f'{name}-uid'
+    pod['spec'] = {'containers': [{'name': c} for c in containers]}
+    pod['status']['containerStatuses'] = [
+        {'name': c, 'ready': True, 'restartCount': 0, 'state': {'running': {}}}
+        for c in containers
+    ]
+    return pod
+
+
+def test_log_multiplexer(kube_api, capsys):
+    server, _, path = kube_api
+    server.pod = running_pod('dummy-web-a')
+    server.extra_pods = [running_pod('dummy-web-b')]
+    new_pod = running_pod('dummy-web-c', containers=('web', 'sidecar'))
+    server.watch_events = [(0.1, {'type': 'ADDED', 'object': new_pod})]
+    server.logs = {
+        'dummy-web-a': ['2021-06-01T08:00:00Z one', '2021-06-01T08:00:02Z three'],
+        'dummy-web-b': ['2021-06-01T08:00:01.5Z two'],
+        'dummy-web-c': ['2021-06-01T08:00:03Z four'],
+    }
+    mux = LogMultiplexer(KubeClient.from_kubeconfig(path), 'app=dummy', tail=10)
+    threading.Timer(1, mux.stop).start()
+    mux.run()
+    lines = capsys.readouterr().out.splitlines()
+    # merged in timestamp order, new pods are picked up by the pod watch
+    assert lines[:3] == ['dummy-web-a one', 'dummy-web-b two', 'dummy-web-a three']
+    assert sorted(lines[3:]) == ['dummy-web-c sidecar four', 'dummy-web-c web four']
+    log_path = '/api/v1/namespaces/default/pods/dummy-web-a/log'
+    log_req = next(r for r in server.requests if r['path'].startswith(log_path))
+    assert 'tailLines=10' in log_req['path']
+    assert 'follow=true' in log_req['path']
+
+
+def test_log_multiplexer_recreated_pod(kube_api, capsys):
+    server, _, path = kube_api
+    # statefulset pods come back with the same name, and restart count
+    server.pod = running_pod('dummy-db-0', uid='old')
+    recreated = running_pod('dummy-db-0', uid='new')
+    server.watch_events = [
+        (0.1, {'type': 'DELETED', 'object': server.pod}),
+        (0.1, {'type': 'ADDED', 'object': recreated}),
+        # keep the watch open, rather than replaying the above
+        (2, {'type': 'BOOKMARK', 'object': {'metadata': {}}}),
+    ]
+    server.logs = {'dummy-db-0': ['2021-06-01T08:00:00Z hello']}
+    mux = LogMultiplexer(KubeClient.from_kubeconfig(path), 'app=dummy', tail=10)
+    threading.Timer(1, mux.stop).start()
+    mux.run()
+    lines = capsys.readouterr().out.splitlines()
+    assert lines == ['dummy-db-0 hello', 'dummy-db-0 hello']
+
+
+def test_log_multiplexer_expired_watch(kube_api, capsys):
+    server, _, path = kube_api
+    server.pod = running_pod('dummy-web-a')
+    new_pod = running_pod('dummy-web-b')
+    expired = {
+        'type': 'ERROR',
+        'object': {'kind': 'Status', 'code': 410, 'reason': 'Expired'},
+    }
+    bookmark = {'type': 'BOOKMARK', 'object': {'metadata': {}}}
+    # the first watch expires, pods are listed again, so the pod created in
+    # the meantime is followed
+    server.watch_rounds = [[(0.1, expired)], [(2, bookmark)]]
+    server.logs = {
+        'dummy-web-a': ['2021-06-01T08:00:00Z one'],
+        'dummy-web-b': ['2021-06-01T08:00:01Z two'],
+    }
+    mux = LogMultiplexer(KubeClient.from_kubeconfig(path), 'app=dummy', tail=10)
+    threading.Timer(0.05, server.extra_pods.append, [new_pod]).start()
+    threading.Timer(1, mux.stop).start()
+    mux.run()
+    lines = capsys.readouterr().out.splitlines()
+    assert lines == ['dummy-web-a one', 'dummy-web-b two']
+    watch_reqs = [r for r in server.requests if 'watch=true' in r['path']]
+    assert len(watch_reqs) == 2
+    assert all('allowWatchBookmarks=true' in r['path'] for r in watch_reqs)
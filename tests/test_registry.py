@@ -0,0 +1,156 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import pytest
+
+from lain_cli.registry import Registry, build_cleanup_plan, execute_cleanup_plan
+
+# tag: manifest digest, the newest three tags are kept, dummy:1600000001 shares
+# its manifest with the running tag, so it must not be deleted
+TAGS = {
+    '1600000000-aaaa': 'sha256:0',
+    '1600000001-bbbb': 'sha256:1',
+    '1600000002-cccc': 'sha256:1',
+    '1600000003-dddd': 'sha256:3',
+    '1600000004-eeee': 'sha256:3',
+    '1600000005-ffff': 'sha256:5',
+    '1600000006-gggg': 'sha256:6',
+    '1600000007-hhhh': 'sha256:7',
+    'prepare': 'sha256:p',
+}
+RUNNING_TAG = '1600000002-cccc'
+
+
+class FakeRegistryHandler(BaseHTTPRequestHandler):
+    """a v2 registry with a single repo"""
+
+    protocol_version = 'HTTP/1.1'
+
+    def reply(self, code, body=None, headers=None):
+        payload = json.dumps(body).encode('utf-8') if body is not None else b''
+        self.send_response(code)
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def paginate(self, key, items):
+        """pages of the distribution spec, items in lexical order"""
+        parts = urlsplit(self.path)
+        query = {k: v[0] for k, v in parse_qs(parts.query).items()}
+        self.server.pages.append((parts.path, query))
+        items = sorted(i for i in items if i > query.get('last', ''))
+        n = int(query.get('n') or len(items))
+        headers = {}
+        if len(items) > n:
+            next_url = f'{parts.path}?n={n}&last={items[n - 1]}'
+            headers['Link'] = f'<{next_url}>; rel="next"'
+
+        self.reply(200, {key: items[:n]}, headers=headers)
+
+    def do_GET(self):
+        path = self.path.split('?')[0]
+        if path == '/v2/_catalog':
+            self.paginate('repositories', ['dummy'])
+        elif path == '/v2/dummy/tags/list':
+            self.paginate('tags', self.server.tags)
+        else:
+            self.reply(404, {'errors': [{'code': 'NAME_UNKNOWN'}]})
+
+    def do_HEAD(self):
+        tag = self.path.rsplit('/', 1)[-1]
+        digest = self.server.tags.get(tag)
+        if digest:
+            self.reply(200, headers={'Docker-Content-Digest': digest})
+        else:
+            self.reply(404)
+
+    def do_DELETE(self):
+        digest = self.path.rsplit('/', 1)[-1]
+        self.server.deletes.append(digest)
+        if digest in self.server.fail_deletes:
+            self.reply(self.server.fail_deletes[digest])
+            return
+        tags = [t for t, d in self.server.tags.items() if d == digest]
+        if not tags:
+            self.reply(404)
+            return
+        for tag in tags:
+            self.server.tags.pop(tag)
+
+        self.reply(202)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture()
+def registry():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeRegistryHandler)
+    server.tags = dict(TAGS)
+    server.deletes = []
+    server.pages = []
+    # digest: status code
+    server.fail_deletes = {}
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    host, port = server.server_address
+    yield server, Registry(registry=f'{host}:{port}')
+    server.shutdown()
+
+
+def test_cleanup_registry(registry, tmp_path, mocker):
+    server, client = registry
+    plan = build_cleanup_plan(client, keep_tags={RUNNING_TAG}, keep_recent=3)
+    assert plan['manifests'] == [
+        {'repo': 'dummy', 'digest': 'sha256:0', 'tags': ['1600000000-aaaa']},
+        {
+            'repo': 'dummy',
+            'digest': 'sha256:3',
+            'tags': ['1600000003-dddd', '1600000004-eeee'],
+        },
+    ]
+    # the first attempt is interrupted by registry failures
+    mocker.patch('tenacity.nap.time')
+    server.fail_deletes = {'sha256:0': 405, 'sha256:3': 500}
+    progress_path = str(tmp_path / 'plan.json.progress')
+    failures = execute_cleanup_plan(client, plan, progress_path)
+    assert sorted(failures) == ['dummy@sha256:0', 'dummy@sha256:3']
+    # server errors are retried, but other client errors are permanent
+    assert server.deletes.count('sha256:3') == 6
+    assert server.deletes.count('sha256:0') == 1
+    server.fail_deletes = {}
+    server.deletes.clear()
+    # resume, only what's left is deleted, a single delete for both tags
+    assert execute_cleanup_plan(client, plan, progress_path) == []
+    assert sorted(server.deletes) == ['sha256:0', 'sha256:3']
+    assert set(server.tags) == set(TAGS) - {
+        '1600000000-aaaa',
+        '1600000003-dddd',
+        '1600000004-eeee',
+    }
+
+
+def test_list_tags(registry, mocker):
+    server, client = registry
+    client.dockerhub_username = 'dummy'
+    client.dockerhub_password = 'dummy'
+    post = mocker.patch('lain_cli.registry.requests.post')
+    post.return_value.json.return_value = {'access_token': 'xxx', 'expires_in': 300}
+    assert client.list_tags('dummy', n=2) == ['1600000007-hhhh', '1600000006-gggg']
+    assert client.list_tags('dummy', n=2) == ['1600000007-hhhh', '1600000006-gggg']
+    # the token is fetched once, and used for every page
+    assert post.call_count == 1
+    client.page_size = 4
+    server.pages.clear()
+    assert set(client.iter_tags('dummy')) == set(TAGS)
+    assert [query for _, query in server.pages] == [
+        {'n': '4'},
+        {'n': '4', 'last': '1600000003-dddd'},
+        {'n': '4', 'last': '1600000007-hhhh'},
+    ]
+    assert list(client.list_repos()) == ['dummy']
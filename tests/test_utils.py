@@ -1,27 +1,46 @@
+import json
+import os
 import shutil
+import subprocess
 from os.path import basename, exists, join
 from pathlib import Path
 from tempfile import NamedTemporaryFile, TemporaryDirectory
+from time import sleep
 
+import click
 import pytest
+import requests
 from ruamel.yaml.scalarstring import LiteralScalarString
 
+import lain_cli.utils
 from lain_cli.aliyun import AliyunPaaS
 from lain_cli.harbor import HarborRegistry
 from lain_cli.utils import (
     CLUSTER_VALUES_DIR,
     DOCKERIGNORE_NAME,
+    ClusterRegistry,
+    PodRecord,
+    ReadCache,
+    Tracer,
+    cached_tool_version,
     banyun,
     change_dir,
     context,
     ensure_absent,
     ensure_str,
     find,
+    iter_parallel,
+    load_cache,
+    lain_,
+    lain_invoke,
     lain_meta,
     load_helm_values,
     make_docker_ignore,
     make_image_str,
     make_job_name,
+    recycle_pods,
+    refresh_latest_version,
+    run_tool,
     subprocess_run,
     tell_all_clusters,
     tell_cluster,
@@ -78,6 +97,10 @@ def test_ya():
     s = yadu(multiline_content)
     # should dump multiline string in readable format
     assert ': |' in s
+    # round trip preserves comments, for documents meant for human editing
+    commented = '# keep me\nfoo: bar\n'
+    assert yalo(commented) == {'foo': 'bar'}
+    assert yadu(yalo(commented, round_trip=True)) == commented
 
 
 @pytest.mark.usefixtures('dummy_helm_chart')
@@ -158,6 +181,44 @@ def test_load_helm_values():
     assert values['jobs'] == dummy_jobs
 
 
+@pytest.mark.usefixtures('dummy_helm_chart')
+def test_load_helm_values_cache(mocker):
+    tempd = TemporaryDirectory()
+    mocker.patch('lain_cli.utils.CACHE_DIR', tempd.name)
+    mocker.patch.dict('lain_cli.utils.helm_values_memo', clear=True)
+    compile_ = mocker.spy(lain_cli.utils, 'compile_helm_values')
+    # ensure_helm_initiated loads values once, the second load hits memo
+    _, values = run_under_click_context(load_helm_values)
+    assert values['appname'] == DUMMY_APPNAME
+    assert compile_.call_count == 1
+    # a new process would hit the disk cache
+    lain_cli.utils.helm_values_memo.clear()
+    run_under_click_context(load_helm_values)
+    assert compile_.call_count == 1
+    # any change to values.yaml invalidates the cache
+    values_path = join(CHART_DIR_NAME, 'values.yaml')
+    values = yalo(values_path)
+    values['env'] = {'CACHE_BUSTER': RANDOM_STRING}
+    yadu(values, values_path)
+    _, values = run_under_click_context(load_helm_values)
+    assert values['env']['CACHE_BUSTER'] == RANDOM_STRING
+    assert compile_.call_count == 2
+    # so does any change to the file that values-[CLUSTER].yaml links to
+    Path(CHART_DIR_NAME, 'linked').mkdir()
+    linked_path = join(CHART_DIR_NAME, 'linked', 'values.yml')
+    yadu({'env': {'CACHE_BUSTER': 'linked'}}, linked_path)
+    cluster_values_path = join(CHART_DIR_NAME, f'values-{TEST_CLUSTER}.yaml')
+    Path(cluster_values_path).write_text('linked/values.yml\n')
+    _, values = run_under_click_context(load_helm_values)
+    assert values['env']['CACHE_BUSTER'] == 'linked'
+    assert compile_.call_count == 3
+    yadu({'env': {'CACHE_BUSTER': 'changed'}}, linked_path)
+    _, values = run_under_click_context(load_helm_values)
+    assert values['env']['CACHE_BUSTER'] == 'changed'
+    assert compile_.call_count == 4
+    tempd.cleanup()
+
+
 @pytest.mark.usefixtures('dummy_helm_chart')
 def test_tell_helm_options():
     _, options = run_under_click_context(
@@ -336,6 +397,112 @@ def test_tell_all_clusters(mocker):
     tempd.cleanup()
 
 
+def test_cluster_registry_cache(mocker):
+    tempd = TemporaryDirectory()
+    cluster_name = 'another'
+    values_path = join(tempd.name, f'values-{cluster_name}.yaml')
+    test_cluster_values = yalo(join(CLUSTER_VALUES_DIR, f'values-{TEST_CLUSTER}.yaml'))
+    test_cluster_values['registry'] = 'another.example.com'
+    yadu(test_cluster_values, values_path)
+    Path(join(tempd.name, f'kubeconfig-{cluster_name}')).write_text('')
+    mocker.patch('lain_cli.utils.KUBECONFIG_DIR', tempd.name)
+    mocker.patch('lain_cli.utils.CLUSTER_VALUES_DIR', tempd.name)
+    mocker.patch('lain_cli.utils.CACHE_DIR', join(tempd.name, 'cache'))
+    compile_ = mocker.spy(lain_cli.utils, 'compile_cluster_config')
+    ccs = ClusterRegistry()
+    assert list(ccs) == [cluster_name]
+    assert compile_.call_count == 0
+    assert ccs[cluster_name]['registry'] == 'another.example.com'
+    assert compile_.call_count == 1
+    # warm cache, nothing gets compiled
+    assert ClusterRegistry()[cluster_name]['registry'] == 'another.example.com'
+    assert compile_.call_count == 1
+    # any change in cluster values invalidates the cache
+    test_cluster_values['registry'] = 'changed.example.com'
+    yadu(test_cluster_values, values_path)
+    assert ClusterRegistry()[cluster_name]['registry'] == 'changed.example.com'
+    assert compile_.call_count == 2
+    tempd.cleanup()
+
+
+def test_cached_tool_version(mocker):
+    tempd = TemporaryDirectory()
+    fake_bin = Path(join(tempd.name, 'faketool'))
+    fake_bin.write_text('#!/bin/sh\n')
+    fake_bin.chmod(0o755)
+    mocker.patch('lain_cli.utils.CACHE_DIR', join(tempd.name, 'cache'))
+    mocker.patch.dict('lain_cli.utils.ENV', {'PATH': tempd.name})
+    probe = mocker.Mock(return_value='v1.0.0')
+    assert cached_tool_version('faketool', probe) == 'v1.0.0'
+    assert cached_tool_version('faketool', probe) == 'v1.0.0'
+    assert probe.call_count == 1
+    # different cache key, e.g. kubectl pointing to another cluster
+    cached_tool_version('faketool', probe, extra_key=('another',))
+    assert probe.call_count == 2
+    # upgrading the binary invalidates its cache
+    fake_bin.write_text('#!/bin/sh\n# upgraded\n')
+    stat = fake_bin.stat()
+    os.utime(fake_bin, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+    cached_tool_version('faketool', probe)
+    assert probe.call_count == 3
+    # expired entries are probed again
+    cached_tool_version('faketool', probe, extra_key=('expired',), ttl=-1)
+    cached_tool_version('faketool', probe, extra_key=('expired',))
+    assert probe.call_count == 5
+    tempd.cleanup()
+
+
+def test_refresh_latest_version(mocker):
+    tempd = TemporaryDirectory()
+    mocker.patch('lain_cli.utils.CACHE_DIR', tempd.name)
+    index = 'https://pypi.example.com/simple'
+    lookup = mocker.patch('lain_cli.utils.lookup_latest_version', return_value='4.11.4')
+    refresh_latest_version(index)
+    assert load_cache('pypi_versions')[index]['version'] == '4.11.4'
+    # failed lookups are recorded too, so they aren't retried every time,
+    # while the last known version is kept
+    lookup.side_effect = requests.ConnectionError
+    refresh_latest_version(index)
+    cached = load_cache('pypi_versions')[index]
+    assert cached['version'] == '4.11.4'
+    assert cached['checked_at']
+    tempd.cleanup()
+
+
+def test_tracer(mocker):
+    tempd = TemporaryDirectory()
+    trace_path = join(tempd.name, 'trace.json')
+    tracer = Tracer()
+    mocker.patch('lain_cli.utils.TRACER', tracer)
+    # not started, nothing is recorded
+    subprocess_run(['true'], silent=True)
+    tracer.start(trace_path)
+    with tracer.span('lain wait', 'lain') as span:
+        subprocess_run(['echo', 'hi'], capture_output=True, silent=True)
+        span['exit_code'] = 0
+
+    tracer.dump('lain deploy')
+    with open(trace_path) as f:
+        root, nested, sub = json.load(f)['traceEvents']
+
+    assert root['name'] == 'lain deploy'
+    assert nested['name'] == 'lain wait'
+    assert nested['args'] == {'exit_code': 0}
+    assert sub['name'] == 'echo hi'
+    assert sub['args'] == {
+        'cmd': 'echo hi',
+        'exit_code': 0,
+        'stdout_bytes': 3,
+        'stderr_bytes': 0,
+    }
+    # spans nest properly
+    for outer, inner in [(root, nested), (nested, sub)]:
+        assert outer['ts'] <= inner['ts']
+        assert inner['ts'] + inner['dur'] <= outer['ts'] + outer['dur']
+
+    tempd.cleanup()
+
+
 @pytest.mark.usefixtures('dummy_helm_chart')
 def test_tell_ingress_urls():
     _, urls = run_under_click_context(
@@ -351,3 +518,150 @@ def test_make_image_str():
         make_image_str, kwargs={'registry': 'private.com', 'image_tag': image_tag}
     )
     assert image == f'private.com/{DUMMY_APPNAME}:1.0'
+
+
+def test_read_cache(mocker):
+    read_cache = ReadCache()
+    spawn = mocker.patch(
+        'lain_cli.utils.subprocess_run',
+        return_value=subprocess.CompletedProcess([], 0, stdout=b'{}'),
+    )
+    get_values = ['helm', 'get', 'values', 'dummy', '-ojson']
+    get_secret = ['kubectl', 'get', 'secret', 'dummy-env', '-ojson']
+    with click.Context(click.Command('lain'), obj={'read_cache': read_cache}):
+        for _ in range(3):
+            run_tool(get_values, capture_output=True)
+
+        run_tool(get_secret, capture_output=True)
+        assert spawn.call_count == 2
+        assert read_cache.hits == 2
+        # deleting pods doesn't affect secrets
+        run_tool(['kubectl', 'delete', 'po', 'dummy-web-xxx'])
+        run_tool(get_secret, capture_output=True)
+        assert read_cache.hits == 3
+        # helm upgrade may change anything
+        run_tool(['helm', 'upgrade', 'dummy', './chart'])
+        run_tool(get_values, capture_output=True)
+        run_tool(get_secret, capture_output=True)
+        # polling loops must see fresh results
+        run_tool(get_secret, capture_output=True, cache=False)
+        assert read_cache.hits == 3
+        assert spawn.call_count == 7
+
+
+def test_lain_invoke(mocker):
+    seen = {}
+
+    @click.group()
+    @click.option('--ignore-lint', is_flag=True)
+    @click.option('--remote-docker', is_flag=True)
+    @click.option('--values', '-f', type=click.File('r'))
+    @click.pass_context
+    def fake_lain(ctx, ignore_lint, remote_docker, values):
+        seen.update(
+            ignore_lint=ignore_lint,
+            remote_docker=remote_docker,
+            values=values and values.name,
+            obj=ctx.obj,
+        )
+
+    @fake_lain.command('exit')
+    @click.argument('code', type=int)
+    def exit_(code):
+        context().exit(code)
+
+    @fake_lain.command()
+    def fail():
+        raise click.ClickException('nope')
+
+    @fake_lain.command()
+    def abort():
+        raise click.Abort()
+
+    @fake_lain.command()
+    def crash():
+        raise ValueError('oops')
+
+    mocker.patch('lain_cli.lain.lain', fake_lain)
+    read_cache = ReadCache()
+    obj = {'read_cache': read_cache, 'ignore_lint': True, 'silent': True}
+    with click.Context(click.Command('lain'), obj=obj) as ctx:
+        assert lain_invoke('exit', '0').returncode == 0
+        # the child shares values and caches with the parent
+        assert seen['obj']['read_cache'] is read_cache
+        assert seen['obj']['nested']
+        assert 'silent' not in seen['obj']
+        assert seen['ignore_lint']
+        assert not seen['remote_docker']
+        assert lain_invoke('exit', '3', check=False).returncode == 3
+        assert lain_invoke('fail', check=False).returncode == 1
+        assert lain_invoke('abort', check=False).returncode == 1
+        assert lain_invoke('crash', check=False).returncode == 1
+        # a failed child exits the parent, just like lain_subprocess
+        with pytest.raises(click.exceptions.Exit) as e:
+            lain_invoke('exit', '3')
+
+        assert e.value.exit_code == 3
+        ctx.obj['remote_docker'] = True
+        with NamedTemporaryFile(mode='w', suffix='.yaml') as f:
+            ctx.obj['extra_values_file'] = f
+            assert lain_('exit', '0').returncode == 0
+            assert seen['remote_docker']
+            assert seen['values'] == f.name
+
+
+def test_recycle_pods(mocker):
+    def pod(name, status='Running', created_at=1):
+        ready = int(status == 'Running')
+        return PodRecord(name, 'Running', status, ready, 1, created_at=created_at)
+
+    old_pods = [pod('dummy-web-0'), pod('dummy-web-1'), pod('dummy-web-2')]
+    rounds = [
+        # statefulset pods come back with the same name
+        [
+            pod('dummy-web-0', 'ContainerCreating', 2),
+            pod('dummy-web-1', created_at=2),
+            old_pods[2],
+        ],
+        [pod(f'dummy-web-{n}', created_at=2) for n in range(3)],
+    ]
+    mocker.patch('lain_cli.utils.sleep')
+    mocker.patch('lain_cli.utils.tell_kube_client', return_value=None)
+    mocker.patch('lain_cli.utils.get_pods', side_effect=rounds)
+    kubectl = mocker.patch(
+        'lain_cli.utils.kubectl', return_value=subprocess.CompletedProcess([], 0)
+    )
+    with click.Context(click.Command('restart')):
+        recycle_pods('app=dummy', old_pods, max_unavailable='2')
+
+    deletes = [c.args[3:] for c in kubectl.call_args_list]
+    # a slot frees up as soon as dummy-web-1 is replaced
+    assert deletes == [('dummy-web-0', 'dummy-web-1'), ('dummy-web-2',)]
+    # old pods may take a while to terminate gracefully, this isn't
+    # considered stuck, no matter how many rounds it takes
+    terminating = pod('dummy-web-0', 'Terminating')
+    rounds = [[terminating]] * 100 + [[pod('dummy-web-0', created_at=2)]]
+    mocker.patch('lain_cli.utils.get_pods', side_effect=rounds)
+    with click.Context(click.Command('restart')):
+        assert recycle_pods('app=dummy', old_pods[:1]) == ['dummy-web-0']
+    # replacement in bad state aborts the restart
+    mocker.patch(
+        'lain_cli.utils.get_pods',
+        return_value=[pod('dummy-web-0', 'ImagePullBackOff', 2), *old_pods[1:]],
+    )
+    with click.Context(click.Command('restart')):
+        with pytest.raises(click.exceptions.Exit):
+            recycle_pods('app=dummy', old_pods, max_unavailable='1')
+
+
+def test_iter_parallel():
+    def nap(seconds):
+        sleep(seconds)
+        return context().command.name
+
+    with click.Context(click.Command('x')):
+        results = iter_parallel(nap, [0.2, 0])
+        done = [(item, future.result()) for item, future in results]
+
+    # results come as soon as they're ready, within the click context
+    assert done == [(0, 'x'), (0.2, 'x')]
@@ -445,10 +445,10 @@ def test_override_release_name():
     # deploy a 'normal' version, to assure two releases do not interfere
     run(lain, args=['deploy', '--wait'])
     # get pods by appname, rather than releaseName
-    _, pods = get_pods(appname=DUMMY_APPNAME)
+    pods = get_pods(appname=DUMMY_APPNAME, refresh=True)
     deploys = set()
     for pod in pods:
-        pod_name, *_ = pod.split(None, 1)
+        pod_name = pod.name
         if pod_name.endswith('test'):
             # ignore test container
             continue